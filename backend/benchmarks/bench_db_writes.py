@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+SQLite write-throughput benchmark for try-on session writes.
+
+Each client thread repeatedly does what a try-on does to the database: insert a
+pending session, then mark it completed (two write transactions). Every
+configuration runs against a fresh database file at 1, 8 and 32 concurrent
+clients:
+- baseline: rollback journal, synchronous=FULL, one commit per write (the old setup)
+- wal: WAL journal, synchronous=NORMAL, one commit per write
+- wal_group_commit: WAL journal, writes batched by group_commit.GroupCommitWriter
+
+Reported per run: committed writes per second, median and p99 write latency,
+and writes that failed (e.g. "database is locked").
+
+Usage (from the backend directory):
+    python benchmarks/bench_db_writes.py
+    python benchmarks/bench_db_writes.py --writes-per-client 200 --output db_writes.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+# Benchmarks import the backend modules directly
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database import create_tables, TryOnSession
+from group_commit import GroupCommitWriter
+# Its after_flush hook updates the counters, so writes cost what they cost in the API
+import stats
+
+# (name, journal mode, synchronous, group commit)
+CONFIGURATIONS = [
+    ("baseline", "DELETE", "FULL", False),
+    ("wal", "WAL", "NORMAL", False),
+    ("wal_group_commit", "WAL", "NORMAL", True),
+]
+CLIENT_COUNTS = [1, 8, 32]
+# pysqlite's default lock wait, which the old engine used
+BASELINE_BUSY_TIMEOUT_MS = 5000
+
+def insert_session(db, client: int) -> int:
+    session = TryOnSession(user_id=client, product_id=1, input_user_photo_path="users/x.jpg",
+                           input_product_photo_path="products/x.jpg", status="pending")
+    db.add(session)
+    db.flush()
+    return session.id
+
+def complete_session(db, session_id: int):
+    session = db.get(TryOnSession, session_id)
+    session.status = "completed"
+    session.output_image_path = f"results/{session_id}/output.png"
+
+def direct_writer(session_factory):
+    """Each write in its own transaction, as the handlers used to do"""
+    def write(job, *args):
+        db = session_factory()
+        try:
+            result = job(db, *args)
+            db.commit()
+            return result
+        finally:
+            db.close()
+    return write
+
+def run_clients(write, clients: int, writes_per_client: int) -> dict:
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(clients + 1)
+
+    def client(index: int):
+        local_latencies = []
+        local_errors = 0
+        barrier.wait()
+        for _ in range(writes_per_client // 2):
+            try:
+                start = time.perf_counter()
+                session_id = write(insert_session, index)
+                local_latencies.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                write(complete_session, session_id)
+                local_latencies.append(time.perf_counter() - start)
+            except Exception:
+                local_errors += 1
+        with lock:
+            latencies.extend(local_latencies)
+            errors.append(local_errors)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "clients": clients,
+        "writes": len(latencies),
+        "errors": sum(errors),
+        "writes_per_s": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": statistics.median(latencies) * 1000 if latencies else None,
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000 if latencies else None,
+    }
+
+def run_configuration(name: str, journal_mode: str, synchronous: str, group_commit: bool,
+                      clients: int, writes_per_client: int) -> dict:
+    # database.configure_sqlite_connection reads these on every new connection
+    os.environ["SQLITE_JOURNAL_MODE"] = journal_mode
+    os.environ["SQLITE_SYNCHRONOUS"] = synchronous
+    os.environ["SQLITE_BUSY_TIMEOUT_MS"] = str(BASELINE_BUSY_TIMEOUT_MS if name == "baseline" else 30000)
+
+    with tempfile.TemporaryDirectory(prefix="tryon-db-writes-") as workdir:
+        engine = create_engine(f"sqlite:///{workdir}/tryon.db", connect_args={"check_same_thread": False},
+                               pool_size=clients + 1)
+        create_tables(engine)
+        session_factory = sessionmaker(bind=engine, autoflush=False)
+        # Start from built counters, as the API does at startup
+        with session_factory() as db:
+            stats.rebuild(db)
+        writer = None
+        if group_commit:
+            writer = GroupCommitWriter(session_factory)
+            write = lambda job, *args: writer.submit(job, *args).result()
+        else:
+            write = direct_writer(session_factory)
+        try:
+            result = run_clients(write, clients, writes_per_client)
+        finally:
+            if writer:
+                writer.stop()
+            engine.dispose()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="TryOn-POC SQLite write-throughput benchmark")
+    parser.add_argument("--writes-per-client", type=int, default=100, help="Writes per client thread (default: 100)")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    saved_env = {key: os.environ.get(key) for key in ("SQLITE_JOURNAL_MODE", "SQLITE_SYNCHRONOUS", "SQLITE_BUSY_TIMEOUT_MS")}
+    runs = []
+    print(f"{'configuration':<18} {'clients':>7} {'writes/s':>10} {'p50':>9} {'p99':>9} {'errors':>7}")
+    try:
+        for name, journal_mode, synchronous, group_commit in CONFIGURATIONS:
+            for clients in CLIENT_COUNTS:
+                result = run_configuration(name, journal_mode, synchronous, group_commit, clients, args.writes_per_client)
+                result["configuration"] = name
+                runs.append(result)
+                print(f"{name:<18} {clients:>7} {result['writes_per_s']:>10.0f} "
+                      f"{result['p50_ms']:>7.2f}ms {result['p99_ms']:>7.2f}ms {result['errors']:>7}")
+    finally:
+        for key, value in saved_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+    if args.output:
+        results = {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "writes_per_client": args.writes_per_client,
+            "runs": runs,
+        }
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+if __name__ == "__main__":
+    main()
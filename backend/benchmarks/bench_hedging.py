@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Tail-latency benchmark for hedged upstream calls.
+
+Runs the same sequence of calls against upstream.StubBackend, whose latency
+is lognormal (heavy-tailed), once unhedged and once per hedge percentile
+through upstream.HedgedBackend. The stub is seeded, so every configuration
+sees the same latency draws for its primaries.
+
+Reported per run: p50/p95/p99/max call latency, hedges fired and won, and
+extra upstream calls as a share of all calls (the hedging cost).
+
+Usage (from the backend directory):
+    python benchmarks/bench_hedging.py
+    python benchmarks/bench_hedging.py --calls 2000 --median-ms 20 --sigma 1.2 --output hedging.json
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+# Benchmarks import the backend modules directly
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import metrics
+from upstream import StubBackend, HedgedBackend
+
+PERCENTILES = [90, 95, 99]
+IMAGES = [{"mime_type": "image/jpeg", "data": b"person"}, {"mime_type": "image/jpeg", "data": b"product"}]
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def counter(name: str) -> float:
+    return metrics.snapshot()["counters"].get(name, 0)
+
+def run(backend, calls: int, clients: int) -> dict:
+    latencies = []
+    lock = threading.Lock()
+    remaining = iter(range(calls))
+
+    def client():
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    return
+            start = time.perf_counter()
+            backend.generate("prompt", IMAGES)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+
+    fired, won = counter("upstream_hedges_fired"), counter("upstream_hedges_won")
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    hedges = counter("upstream_hedges_fired") - fired
+    return {
+        "calls": len(latencies),
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": latencies[-1] * 1000,
+        "hedges_fired": int(hedges),
+        "hedges_won": int(counter("upstream_hedges_won") - won),
+        "extra_calls_pct": hedges / len(latencies) * 100,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="TryOn-POC hedged upstream call benchmark")
+    parser.add_argument("--calls", type=int, default=1000, help="Calls per configuration (default: 1000)")
+    parser.add_argument("--clients", type=int, default=8, help="Concurrent callers (default: 8)")
+    parser.add_argument("--median-ms", type=float, default=20, help="Stub median latency (default: 20)")
+    parser.add_argument("--sigma", type=float, default=1.0, help="Stub lognormal sigma; larger is heavier-tailed (default: 1.0)")
+    parser.add_argument("--budget", type=float, default=0.05, help="Hedges allowed per call (default: 0.05)")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    configurations = [("unhedged", None)] + [(f"hedged_p{p}", p) for p in PERCENTILES]
+    runs = []
+    print(f"{'configuration':<14} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9} {'hedges':>7} {'won':>5} {'extra':>7}")
+    for name, hedge_percentile in configurations:
+        backend = StubBackend(latency_seconds=args.median_ms / 1000, sigma=args.sigma, seed=1)
+        if hedge_percentile:
+            backend = HedgedBackend(backend, percentile=hedge_percentile, budget=args.budget)
+        result = run(backend, args.calls, args.clients)
+        result["configuration"] = name
+        runs.append(result)
+        print(f"{name:<14} {result['p50_ms']:>7.1f}ms {result['p95_ms']:>7.1f}ms {result['p99_ms']:>7.1f}ms "
+              f"{result['max_ms']:>7.1f}ms {result['hedges_fired']:>7} {result['hedges_won']:>5} {result['extra_calls_pct']:>6.1f}%")
+
+    if args.output:
+        results = {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "stub": {"median_ms": args.median_ms, "sigma": args.sigma},
+            "budget": args.budget,
+            "clients": args.clients,
+            "runs": runs,
+        }
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+if __name__ == "__main__":
+    main()
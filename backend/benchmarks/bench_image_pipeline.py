@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for the TryOn-POC image pipeline.
+
+Measures time per call, throughput and peak memory of the image helpers in
+storage.py and gemini_client.py over generated fixtures, saves the results as
+a JSON baseline, and compares two result files with a regression threshold.
+
+Usage (from the backend directory):
+    python benchmarks/bench_image_pipeline.py run --output benchmarks/baseline.json
+    python benchmarks/bench_image_pipeline.py run --output current.json
+    python benchmarks/bench_image_pipeline.py compare benchmarks/baseline.json current.json
+"""
+
+import argparse
+import ctypes
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+# Benchmarks import the backend modules directly
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import numpy as np
+import PIL
+from PIL import Image
+
+from storage import convert_to_supported_format, validate_image_file
+from gemini_client import GeminiClient
+from image_utils import enable_avif
+
+# The AVIF fixture is encoded before any backend code has opened an image
+enable_avif()
+
+# (name, size, mode, format)
+FIXTURES = [
+    ("small_jpeg", (640, 480), "RGB", "JPEG"),
+    ("large_jpeg", (6000, 4000), "RGB", "JPEG"),
+    ("png_alpha", (1200, 1600), "RGBA", "PNG"),
+    ("avif", (1500, 1500), "RGB", "AVIF"),
+    ("wide_jpeg", (4000, 800), "RGB", "JPEG"),
+    ("tall_png", (600, 3000), "RGB", "PNG"),
+]
+
+TARGET_SIZE = (1024, 1024)
+
+# mallopt() parameter number from glibc's malloc.h
+M_MMAP_THRESHOLD = -3
+
+def make_fixture_image(size: tuple, mode: str) -> Image.Image:
+    """Photo-like content: smooth gradients, a few shapes and mild sensor noise"""
+    width, height = size
+    rng = np.random.default_rng(42)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    r = 128 + 100 * np.sin(x / width * 6.0)
+    g = 128 + 100 * np.cos(y / height * 4.0)
+    b = 255 * (x + y) / (width + height)
+    pixels = np.stack([r, g, b], axis=-1)
+
+    # A dark rectangle in the middle stands in for the subject
+    pixels[height // 4:3 * height // 4, width // 3:2 * width // 3] *= 0.3
+    pixels += rng.normal(0, 6, pixels.shape)
+    img = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), "RGB")
+
+    if mode == "RGBA":
+        alpha = np.zeros((height, width), dtype=np.uint8)
+        alpha[height // 8:7 * height // 8, width // 8:7 * width // 8] = 255
+        img.putalpha(Image.fromarray(alpha, "L"))
+    return img
+
+def build_fixtures(directory: Path) -> dict:
+    """Write every supported fixture to directory and return {name: path}"""
+    fixtures = {}
+    for name, size, mode, fmt in FIXTURES:
+        path = directory / f"{name}.{fmt.lower()}"
+        try:
+            make_fixture_image(size, mode).save(path, format=fmt, quality=90)
+        except (KeyError, OSError) as e:
+            print(f"Skipping fixture {name}: {fmt} not supported ({e})")
+            continue
+        fixtures[name] = path
+    return fixtures
+
+def make_client() -> GeminiClient:
+    # The benchmarked helpers never touch the model, so skip the API key check
+    return GeminiClient.__new__(GeminiClient)
+
+def build_cases(fixtures: dict) -> list:
+    """Return (case_name, setup, call) tuples; setup runs once outside the timed loop"""
+    client = make_client()
+    cases = []
+    for name, path in fixtures.items():
+        def load_bytes(path=path):
+            return path.read_bytes()
+
+        def load_image(path=path):
+            return client._load_and_convert_image(str(path), target_size=TARGET_SIZE)
+
+        def load_optimized(path=path):
+            return client._optimize_image_for_tryon(load_image(path), target_size=TARGET_SIZE)
+
+        cases += [
+            (f"convert_to_supported_format[{name}]", load_bytes, convert_to_supported_format),
+            (f"validate_image_file[{name}]", load_bytes, validate_image_file),
+            (f"_load_and_convert_image[{name}]", lambda path=path: str(path),
+             lambda p: client._load_and_convert_image(p, target_size=TARGET_SIZE)),
+            (f"_optimize_image_for_tryon[{name}]", load_image,
+             lambda img: client._optimize_image_for_tryon(img, target_size=TARGET_SIZE)),
+            (f"_pil_to_bytes[{name}]", load_optimized,
+             lambda img: client._pil_to_bytes(img, format='JPEG', quality=95)),
+        ]
+
+    cases.append(("_create_error_image", lambda: "Try-on failed: upstream timeout after 60 seconds",
+                  client._create_error_image))
+    return cases
+
+def read_memory_status() -> dict:
+    """Current and peak resident set size in bytes from /proc/self/status"""
+    status = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "VmHWM"):
+                status[key] = int(value.split()[0]) * 1024
+    return status
+
+def release_freed_memory():
+    """Return freed heap pages to the OS so earlier cases don't hide later peaks"""
+    Image.core.set_blocks_max(0)  # Pillow's own cache of freed image blocks
+    try:
+        libc = ctypes.CDLL("libc.so.6")
+    except OSError:
+        return
+    # A fixed mmap threshold keeps glibc from raising it after large frees,
+    # so pixel buffers stay mmap-backed and are unmapped when released
+    libc.mallopt(M_MMAP_THRESHOLD, 128 * 1024)
+    libc.malloc_trim(0)
+
+def measure_peak_memory(setup, call):
+    """
+    Peak RSS growth during one call. Pillow allocates pixel buffers outside the
+    Python allocator, so tracemalloc can't see them; instead the kernel's RSS
+    high-water mark is reset (clear_refs) right before the call. Linux only.
+    """
+    try:
+        arg = setup()
+        release_freed_memory()
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        baseline = read_memory_status()["VmRSS"]
+        call(arg)
+        return max(0, read_memory_status()["VmHWM"] - baseline)
+    except OSError:
+        return None
+
+def time_case(setup, call, min_time: float, min_calls: int) -> dict:
+    arg = setup()
+    call(arg)  # warm-up (plugin registration, first-use caches)
+
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < min_calls or time.perf_counter() - started < min_time:
+        start = time.perf_counter()
+        call(arg)
+        timings.append(time.perf_counter() - start)
+
+    median = statistics.median(timings)
+    return {
+        "calls": len(timings),
+        "mean_s": statistics.fmean(timings),
+        "median_s": median,
+        "min_s": min(timings),
+        "throughput_per_s": 1.0 / median if median else None,
+    }
+
+def run_benchmarks(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        fixtures = build_fixtures(Path(tmp))
+        cases = build_cases(fixtures)
+        if args.filter:
+            cases = [case for case in cases if args.filter in case[0]]
+
+        # The pipeline prints progress on every call; keep the report readable
+        results = {}
+        for case_name, setup, call in cases:
+            with open(os.devnull, "w") as devnull:
+                stdout, sys.stdout = sys.stdout, devnull
+                try:
+                    stats = time_case(setup, call, args.min_time, args.min_calls)
+                    stats["peak_mem_bytes"] = measure_peak_memory(setup, call)
+                finally:
+                    sys.stdout = stdout
+            results[case_name] = stats
+            peak = stats["peak_mem_bytes"]
+            peak_text = f"{peak / 1e6:8.1f} MB" if peak is not None else "     n/a"
+            print(f"{case_name:55s} {stats['median_s'] * 1000:9.2f} ms  {stats['throughput_per_s']:9.1f}/s  {peak_text}")
+
+    report = {
+        "meta": {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+            "min_time": args.min_time,
+        },
+        "results": results,
+    }
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print(f"Results saved to: {args.output}")
+
+def compare_results(args) -> int:
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+    with open(args.current) as f:
+        current = json.load(f)["results"]
+
+    regressions = []
+    print(f"{'case':55s} {'baseline':>11s} {'current':>11s} {'change':>8s}")
+    for case_name in sorted(set(baseline) & set(current)):
+        before = baseline[case_name]
+        after = current[case_name]
+        time_change = after["median_s"] / before["median_s"] - 1.0
+        flag = ""
+        if time_change > args.threshold:
+            regressions.append(f"{case_name}: time +{time_change:.0%}")
+            flag = "  REGRESSION"
+
+        before_mem, after_mem = before.get("peak_mem_bytes"), after.get("peak_mem_bytes")
+        if before_mem and after_mem is not None:
+            mem_change = after_mem / before_mem - 1.0
+            # Ignore sub-megabyte noise in RSS sampling
+            if mem_change > args.memory_threshold and after_mem - before_mem > 1_000_000:
+                regressions.append(f"{case_name}: peak memory +{mem_change:.0%}")
+                flag = "  REGRESSION"
+
+        print(f"{case_name:55s} {before['median_s'] * 1000:8.2f} ms {after['median_s'] * 1000:8.2f} ms {time_change:+8.1%}{flag}")
+
+    for case_name in sorted(set(baseline) - set(current)):
+        print(f"{case_name:55s} missing from current results")
+
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) beyond threshold:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+
+    print("\nNo regressions beyond threshold")
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Image pipeline microbenchmarks")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument("--output", help="Write results as JSON to this file")
+    run_parser.add_argument("--filter", help="Only run cases whose name contains this string")
+    run_parser.add_argument("--min-time", type=float, default=1.0, help="Minimum seconds timed per case (default: 1.0)")
+    run_parser.add_argument("--min-calls", type=int, default=5, help="Minimum calls timed per case (default: 5)")
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two result files")
+    compare_parser.add_argument("baseline", help="Baseline JSON results")
+    compare_parser.add_argument("current", help="Current JSON results")
+    compare_parser.add_argument("--threshold", type=float, default=0.15,
+                                help="Allowed median time increase as a fraction (default: 0.15)")
+    compare_parser.add_argument("--memory-threshold", type=float, default=0.25,
+                                help="Allowed peak memory increase as a fraction (default: 0.25)")
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        run_benchmarks(args)
+    elif args.command == "compare":
+        sys.exit(compare_results(args))
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    main()
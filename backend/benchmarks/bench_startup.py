@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Cold-start benchmark for the TryOn-POC API.
+
+Each run starts from a fresh working directory (empty database and storage) and
+measures, in separate processes:
+- import: time to `import main`
+- listening: time from spawning uvicorn until it answers GET /health
+- first_request: time from spawning uvicorn until GET /products returns 200,
+  i.e. until startup has finished and the app serves real traffic
+
+Usage (from the backend directory):
+    python benchmarks/bench_startup.py --runs 5
+    python benchmarks/bench_startup.py --runs 10 --output startup.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+IMPORT_SNIPPET = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+POLL_INTERVAL = 0.005
+STARTUP_TIMEOUT = 60
+
+def backend_env() -> dict:
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [str(BACKEND_DIR), env.get("PYTHONPATH")]))
+    return env
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_for(url: str, deadline: float) -> bool:
+    """Poll url until it returns 200; False on timeout"""
+    while time.perf_counter() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=STARTUP_TIMEOUT) as response:
+                if response.status == 200:
+                    return True
+        except (urllib.error.URLError, ConnectionError):
+            pass
+        time.sleep(POLL_INTERVAL)
+    return False
+
+def measure_import(workdir: str) -> float:
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET],
+        cwd=workdir, env=backend_env(), capture_output=True, text=True, check=True,
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+def measure_server(workdir: str) -> dict:
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=workdir, env=backend_env(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = start + STARTUP_TIMEOUT
+        if not wait_for(f"{base_url}/health", deadline):
+            raise RuntimeError("server did not start listening")
+        listening = time.perf_counter() - start
+        if not wait_for(f"{base_url}/products", deadline):
+            raise RuntimeError("server never served GET /products")
+        first_request = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+    return {"listening": listening, "first_request": first_request}
+
+def summarize(samples: list) -> dict:
+    return {
+        "median_s": statistics.median(samples),
+        "min_s": min(samples),
+        "max_s": max(samples),
+        "runs": len(samples),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="TryOn-POC cold-start benchmark")
+    parser.add_argument("--runs", type=int, default=5, help="Cold starts to measure (default: 5)")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    samples = {"import": [], "listening": [], "first_request": []}
+    for run in range(1, args.runs + 1):
+        # A fresh directory per run, so nothing is reused from an earlier start
+        with tempfile.TemporaryDirectory(prefix="tryon-startup-") as workdir:
+            samples["import"].append(measure_import(workdir))
+        with tempfile.TemporaryDirectory(prefix="tryon-startup-") as workdir:
+            server = measure_server(workdir)
+        samples["listening"].append(server["listening"])
+        samples["first_request"].append(server["first_request"])
+        print(f"run {run}: import {samples['import'][-1]:.3f}s, "
+              f"listening {server['listening']:.3f}s, first request {server['first_request']:.3f}s")
+
+    results = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "benchmarks": {name: summarize(values) for name, values in samples.items()},
+    }
+
+    print(f"\n{'metric':<15} {'median':>9} {'min':>9} {'max':>9}")
+    for name, summary in results["benchmarks"].items():
+        print(f"{name:<15} {summary['median_s']:>8.3f}s {summary['min_s']:>8.3f}s {summary['max_s']:>8.3f}s")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+if __name__ == "__main__":
+    main()
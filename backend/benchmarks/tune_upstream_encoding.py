@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Tuner for the encoding of model inputs (UPSTREAM_IMAGE_* settings).
+
+Takes a random sample of the stored product images and user photos, runs
+each through the same preprocessing as a try-on (reduced decode, content
+crop, resize to the quality tier's input size), and encodes the result under
+every candidate setting. For each setting it reports:
+- encode_ms: median time to encode one image
+- bytes: mean payload size, and its share of the current default's
+- ssim: mean and minimum structural similarity of the decoded payload to the
+  preprocessed image (per RGB channel, 8x8 windows; 1.0 = identical)
+
+The recommendation is the setting with the smallest payload whose minimum
+SSIM stays at or above --min-ssim, with the env lines to apply it.
+
+Usage (from the backend directory, next to storage/):
+    python benchmarks/tune_upstream_encoding.py
+    python benchmarks/tune_upstream_encoding.py --sample 100 --tier preview --min-ssim 0.97
+    python benchmarks/tune_upstream_encoding.py --images a.jpg b.png --output encoding.json
+"""
+
+import argparse
+import io
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+# Benchmarks import the backend modules directly
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import numpy as np
+from PIL import Image
+
+from gemini_client import GeminiClient, UpstreamEncoding
+from quality import QUALITY_TIERS
+from storage import PRODUCTS_DIR, USERS_DIR
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp", ".avif"}
+# SSIM constants for 8-bit images, 8x8 windows
+SSIM_WINDOW = 8
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+
+def candidate_encodings() -> list:
+    """The current default first, then the grid"""
+    candidates = [UpstreamEncoding()]
+    for quality in (95, 90, 85, 80, 75, 70):
+        for subsampling in ("4:4:4", "4:2:0"):
+            for optimize in (True, False):
+                candidates.append(UpstreamEncoding("JPEG", quality, subsampling, optimize))
+    for quality in (90, 80, 70):
+        for optimize in (True, False):
+            candidates.append(UpstreamEncoding("WEBP", quality, None, optimize))
+    candidates.append(UpstreamEncoding("PNG", optimize=False))
+    # The default is also in the grid when it names its subsampling; keep the first
+    unique = []
+    for encoding in candidates:
+        if encoding not in unique:
+            unique.append(encoding)
+    return unique
+
+def find_images(sample: int, seed: int) -> list:
+    """(path, is_person) for a random sample of stored product images and user photos"""
+    products = [(path, False) for path in PRODUCTS_DIR.rglob("*") if path.suffix.lower() in IMAGE_SUFFIXES]
+    photos = [(path, True) for path in USERS_DIR.glob("*/photos/*") if path.suffix.lower() in IMAGE_SUFFIXES]
+    rng = random.Random(seed)
+    # Half of the sample from each kind when both are available
+    half = sample // 2
+    chosen = rng.sample(products, min(len(products), max(half, sample - len(photos))))
+    chosen += rng.sample(photos, min(len(photos), sample - len(chosen)))
+    return chosen
+
+def box_mean(x: np.ndarray) -> np.ndarray:
+    """Mean over every SSIM_WINDOW x SSIM_WINDOW window, via an integral image"""
+    integral = np.pad(x.cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+    w = SSIM_WINDOW
+    total = integral[w:, w:] - integral[:-w, w:] - integral[w:, :-w] + integral[:-w, :-w]
+    return total / (w * w)
+
+def ssim(reference: np.ndarray, candidate: np.ndarray) -> float:
+    """Mean SSIM over the RGB channels of two equally sized uint8 images"""
+    scores = []
+    for channel in range(3):
+        a = reference[..., channel].astype(np.float64)
+        b = candidate[..., channel].astype(np.float64)
+        mu_a, mu_b = box_mean(a), box_mean(b)
+        var_a = box_mean(a * a) - mu_a ** 2
+        var_b = box_mean(b * b) - mu_b ** 2
+        cov = box_mean(a * b) - mu_a * mu_b
+        ssim_map = ((2 * mu_a * mu_b + SSIM_C1) * (2 * cov + SSIM_C2)) / (
+            (mu_a ** 2 + mu_b ** 2 + SSIM_C1) * (var_a + var_b + SSIM_C2))
+        scores.append(float(ssim_map.mean()))
+    return sum(scores) / len(scores)
+
+def as_rgb(image: Image.Image) -> np.ndarray:
+    """Pixels as the model would see them: transparency flattened onto white, like the JPEG path"""
+    if image.mode in ("RGBA", "LA"):
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    return np.asarray(image.convert("RGB"))
+
+def preprocess(client: GeminiClient, path: Path, is_person: bool, target_size: tuple) -> Image.Image:
+    """The image generate_tryon_image would encode"""
+    image = client._load_and_convert_image(str(path), target_size=target_size)
+    return client._optimize_image_for_tryon(image, target_size=target_size, is_person=is_person, source_path=str(path))
+
+def measure(client: GeminiClient, encoding: UpstreamEncoding, images: list, repeat: int) -> dict:
+    times, sizes, scores = [], [], []
+    for image, reference in images:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            payload = client._pil_to_bytes(image, format=encoding.format, quality=encoding.quality,
+                                           subsampling=encoding.subsampling, optimize=encoding.optimize)
+            times.append(time.perf_counter() - start)
+        sizes.append(len(payload))
+        with Image.open(io.BytesIO(payload)) as decoded:
+            scores.append(ssim(reference, as_rgb(decoded)))
+    return {
+        "setting": encoding.describe(),
+        "format": encoding.format,
+        "quality": encoding.quality,
+        "subsampling": encoding.subsampling,
+        "optimize": encoding.optimize,
+        "encode_ms": statistics.median(times) * 1000,
+        "bytes": statistics.mean(sizes),
+        "ssim_mean": statistics.mean(scores),
+        "ssim_min": min(scores),
+    }
+
+def env_lines(encoding: UpstreamEncoding) -> list:
+    lines = [f"UPSTREAM_IMAGE_FORMAT={encoding.format}", f"UPSTREAM_IMAGE_QUALITY={encoding.quality}"]
+    if encoding.subsampling:
+        lines.append(f"UPSTREAM_IMAGE_SUBSAMPLING={encoding.subsampling}")
+    lines.append(f"UPSTREAM_IMAGE_OPTIMIZE={1 if encoding.optimize else 0}")
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune the encoding of try-on model inputs")
+    parser.add_argument("--images", nargs="*", type=Path, help="Images to use instead of sampling storage/")
+    parser.add_argument("--sample", type=int, default=40, help="Stored images to sample (default: 40)")
+    parser.add_argument("--seed", type=int, default=0, help="Sampling seed (default: 0)")
+    parser.add_argument("--tier", choices=sorted(QUALITY_TIERS), default="full", help="Input size to tune for (default: full)")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed encodes per image and setting (default: 3)")
+    parser.add_argument("--min-ssim", type=float, default=0.98, help="Lowest acceptable per-image SSIM (default: 0.98)")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    if args.images:
+        # Explicit files are treated as person photos unless they live under products/
+        sources = [(path, "products" not in path.parts) for path in args.images]
+    else:
+        sources = find_images(args.sample, args.seed)
+    if not sources:
+        print(f"No images found under {PRODUCTS_DIR} or {USERS_DIR}; pass --images or run next to storage/")
+        sys.exit(1)
+
+    # The tuned helpers never touch the model, so skip building a backend
+    client = GeminiClient.__new__(GeminiClient)
+    target_size = QUALITY_TIERS[args.tier]
+    images = []
+    for path, is_person in sources:
+        image = preprocess(client, path, is_person, target_size)
+        images.append((image, as_rgb(image)))
+    print(f"Tuning on {len(images)} images at the {args.tier} tier {target_size}\n")
+
+    encodings = candidate_encodings()
+    default = encodings[0]
+    runs = []
+    print(f"{'setting':<26} {'encode':>9} {'bytes':>9} {'vs default':>10} {'ssim mean':>10} {'ssim min':>9}")
+    for encoding in encodings:
+        result = measure(client, encoding, images, args.repeat)
+        runs.append(result)
+    baseline_bytes = runs[0]["bytes"]
+    for encoding, result in zip(encodings, runs):
+        result["bytes_vs_default"] = result["bytes"] / baseline_bytes
+        label = result["setting"] + (" (default)" if encoding == default else "")
+        print(f"{label:<26} {result['encode_ms']:>7.2f}ms {result['bytes']:>9.0f} {result['bytes_vs_default']:>9.0%} "
+              f"{result['ssim_mean']:>10.4f} {result['ssim_min']:>9.4f}")
+
+    acceptable = [(encoding, result) for encoding, result in zip(encodings, runs) if result["ssim_min"] >= args.min_ssim]
+    recommended = None
+    if acceptable:
+        encoding, result = min(acceptable, key=lambda item: (item[1]["bytes"], item[1]["encode_ms"]))
+        recommended = result["setting"]
+        print(f"\nSmallest payload with SSIM >= {args.min_ssim} on every image: {recommended} "
+              f"({result['bytes_vs_default']:.0%} of the default's bytes, {result['encode_ms']:.2f}ms per encode)")
+        print("\n".join(env_lines(encoding)))
+    else:
+        print(f"\nNo setting keeps SSIM >= {args.min_ssim} on every image")
+
+    if args.output:
+        results = {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "tier": args.tier,
+            "images": len(images),
+            "min_ssim": args.min_ssim,
+            "recommended": recommended,
+            "runs": runs,
+        }
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+In-process snapshot of the product catalog for GET /products and GET /products/{id}.
+
+The snapshot holds each response already serialized to JSON bytes, with a
+strong ETag (a hash of the bytes), so serving the catalog is a dict lookup
+and a conditional request whose If-None-Match still matches gets a 304
+without touching the database.
+
+Coherence: every flush that inserts, updates or deletes a Product bumps the
+"catalog" row of cache_versions in the same transaction. The worker that
+made the change drops its snapshot on commit; other workers compare their
+snapshot's version with the database at most every
+CATALOG_VERSION_CHECK_SECONDS and rebuild when it moved. Unknown product ids
+are answered from the snapshot too, so they can't force database reads. Bulk UPDATEs that
+bypass the ORM (format_database.py fix) bump the version themselves.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from typing import List
+
+from pydantic import TypeAdapter
+from sqlalchemy import event
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+import metrics
+from database import SessionLocal, Product, CacheVersion
+from models import ProductResponse
+
+CATALOG_VERSION = "catalog"
+DEFAULT_VERSION_CHECK_SECONDS = 1.0
+# Raw SQL equivalent of bump_version(), for scripts using sqlite3 directly
+BUMP_VERSION_SQL = (
+    "INSERT INTO cache_versions (name, version) VALUES ('catalog', 1) "
+    "ON CONFLICT(name) DO UPDATE SET version = version + 1"
+)
+
+_product_list = TypeAdapter(List[ProductResponse])
+
+def bump_version(conn):
+    stmt = insert(CacheVersion).values(name=CATALOG_VERSION, version=1)
+    conn.execute(stmt.on_conflict_do_update(
+        index_elements=[CacheVersion.name], set_={"version": CacheVersion.version + 1}
+    ))
+
+def read_version(db) -> int:
+    version = db.query(CacheVersion.version).filter(CacheVersion.name == CATALOG_VERSION).scalar()
+    return version or 0
+
+@event.listens_for(Session, "after_flush")
+def _bump_on_product_change(session, flush_context):
+    if any(isinstance(obj, Product) for obj in (*session.new, *session.dirty, *session.deleted)):
+        bump_version(session.connection())
+        session.info["catalog_changed"] = True
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_on_commit(session):
+    if session.info.pop("catalog_changed", False):
+        catalog_cache.invalidate()
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back_change(session):
+    session.info.pop("catalog_changed", None)
+
+def etag_for(body: bytes) -> str:
+    return f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match uses weak comparison, so W/ prefixes are ignored"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(candidate.strip().removeprefix("W/") == etag for candidate in if_none_match.split(","))
+
+class CatalogSnapshot:
+    """Serialized catalog at one version: (etag, body) for the list and for each product"""
+
+    def __init__(self, version: int, products: list):
+        self.version = version
+        responses = [
+            ProductResponse(
+                id=product.id,
+                name=product.name,
+                filepath=product.filepath,
+                image_url=f"/static/{product.filepath}",
+                created_at=product.created_at,
+            )
+            for product in products
+        ]
+        body = _product_list.dump_json(responses)
+        self.listing = (etag_for(body), body)
+        self.products = {}
+        for response in responses:
+            body = response.model_dump_json().encode()
+            self.products[response.id] = (etag_for(body), body)
+
+class CatalogCache:
+    def __init__(self, session_factory=SessionLocal, check_seconds: float = DEFAULT_VERSION_CHECK_SECONDS):
+        self.session_factory = session_factory
+        self.check_seconds = check_seconds
+        self.snapshot = None
+        self.checked_at = 0.0
+        # Bumped by invalidate(), so a refresh that started before a local write doesn't keep its result
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "CatalogCache":
+        return cls(check_seconds=float(os.getenv("CATALOG_VERSION_CHECK_SECONDS", str(DEFAULT_VERSION_CHECK_SECONDS))))
+
+    def invalidate(self):
+        self.generation += 1
+        self.snapshot = None
+
+    def fresh(self):
+        """The snapshot if it was checked against the database recently, else None"""
+        snapshot = self.snapshot
+        if snapshot is not None and time.monotonic() - self.checked_at < self.check_seconds:
+            return snapshot
+        return None
+
+    def refresh(self, force: bool = False) -> CatalogSnapshot:
+        """Check the version (blocking) and rebuild the snapshot if it moved"""
+        with self.lock:
+            # Another request may have refreshed while this one waited for the lock
+            if not force and self.fresh():
+                return self.snapshot
+            generation = self.generation
+            db = self.session_factory()
+            try:
+                # Version first, then the products, as separate statements (pysqlite
+                # doesn't open a read transaction for SELECTs). A change committed in
+                # between is in the rows but not the version, so the snapshot can only
+                # look older than it is, and the next check rebuilds it
+                version = read_version(db)
+                snapshot = self.snapshot
+                if snapshot is None or snapshot.version != version:
+                    start = time.monotonic()
+                    snapshot = CatalogSnapshot(version, db.query(Product).order_by(Product.id).all())
+                    metrics.increment("catalog_rebuilds")
+                    metrics.observe("catalog_rebuild_seconds", time.monotonic() - start)
+                    print(f"Catalog snapshot rebuilt at version {version}: {len(snapshot.products)} products")
+            finally:
+                db.close()
+            if generation == self.generation:
+                self.snapshot = snapshot
+                self.checked_at = time.monotonic()
+            return snapshot
+
+catalog_cache = CatalogCache.from_env()
@@ -1,11 +1,38 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy import create_engine, event, inspect, text, Column, Integer, Float, String, Text, DateTime, ForeignKey, Index, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker, relationship, column_property
 from datetime import datetime
 import os
 
 # Database setup
 DATABASE_URL = "sqlite:///./tryon.db"
+
+DEFAULT_BUSY_TIMEOUT_MS = 30000
+# Negative cache_size is in KiB
+DEFAULT_CACHE_SIZE_KIB = 64 * 1024
+DEFAULT_MMAP_SIZE_BYTES = 256 * 1024 * 1024
+
+@event.listens_for(Engine, "connect")
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    """
+    WAL lets readers run alongside the writer, and synchronous=NORMAL only
+    fsyncs at checkpoints (a power loss can drop the last commits, but never
+    corrupts the database). Writers wait for the lock instead of failing with
+    "database is locked". Applied to every SQLite engine, including the
+    maintenance scripts'.
+    """
+    if not type(dbapi_connection).__module__.startswith("sqlite3"):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA busy_timeout = {int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', str(DEFAULT_BUSY_TIMEOUT_MS)))}")
+    cursor.execute(f"PRAGMA journal_mode = {os.getenv('SQLITE_JOURNAL_MODE', 'WAL')}")
+    cursor.execute(f"PRAGMA synchronous = {os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')}")
+    cursor.execute(f"PRAGMA cache_size = -{DEFAULT_CACHE_SIZE_KIB}")
+    cursor.execute(f"PRAGMA mmap_size = {DEFAULT_MMAP_SIZE_BYTES}")
+    cursor.execute("PRAGMA temp_store = MEMORY")
+    cursor.close()
+
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
@@ -20,6 +47,24 @@ class User(Base):
     
     # Relationships
     tryon_sessions = relationship("TryOnSession", back_populates="user")
+    photos = relationship("UserPhoto", back_populates="user")
+
+class UserPhoto(Base):
+    __tablename__ = "user_photos"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    # Near-duplicate uploads share their canonical photo's file
+    filepath = Column(String, nullable=False)
+    # 64-bit perceptual hash as 16 hex digits
+    phash = Column(String, nullable=True)
+    canonical_id = Column(Integer, ForeignKey("user_photos.id"), nullable=True)
+    # input_quality scores as JSON
+    quality_scores = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    # Relationships
+    user = relationship("User", back_populates="photos")
 
 class Product(Base):
     __tablename__ = "products"
@@ -27,6 +72,12 @@ class Product(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=False)
     filepath = Column(String, nullable=False)
+    # 64-bit perceptual hash as 16 hex digits
+    phash = Column(String, nullable=True)
+    # Set when this product's image is a near-duplicate of another product's
+    canonical_id = Column(Integer, nullable=True)
+    # input_quality scores as JSON
+    quality_scores = Column(Text, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Relationships
@@ -41,15 +92,163 @@ class TryOnSession(Base):
     input_user_photo_path = Column(String, nullable=False)
     input_product_photo_path = Column(String, nullable=False)
     output_image_path = Column(String, nullable=True)
+    # pending -> preview -> completed, or failed / expired / cancelled.
+    # active_history loads the old value before it is overwritten, for the stats counters
+    status = column_property(Column(String, nullable=False, default="pending"), active_history=True)
+    # Quality tier of the current output image ("preview" or "full")
+    quality = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Relationships
     user = relationship("User", back_populates="tryon_sessions")
     product = relationship("Product", back_populates="tryon_sessions")
+    
+    __table_args__ = (
+        # Looking up earlier results for the same inputs
+        Index("ix_tryon_sessions_inputs", "input_user_photo_path", "input_product_photo_path"),
+        # A user's history, newest first, paged by (created_at, id)
+        Index("ix_tryon_sessions_user_created", "user_id", "created_at", "id"),
+        Index("ix_tryon_sessions_product_created", "product_id", "created_at"),
+    )
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    # Endpoint the key was used on; the same key may be reused on another endpoint
+    scope = Column(String, nullable=False)
+    key = Column(String, nullable=False)
+    # SHA-256 of the request, so a key can't be replayed against different input
+    request_hash = Column(String, nullable=False)
+    # in_progress -> completed
+    status = Column(String, nullable=False, default="in_progress")
+    response_code = Column(Integer, nullable=True)
+    # JSON body returned to replays
+    response_body = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False)
+    # Renewed while the claiming request runs; an in_progress key past it was abandoned
+    lease_expires_at = Column(DateTime, nullable=True)
+    
+    __table_args__ = (
+        UniqueConstraint("scope", "key", name="uq_idempotency_keys_scope_key"),
+        Index("ix_idempotency_keys_expires_at", "expires_at"),
+    )
+
+class OutfitStep(Base):
+    __tablename__ = "outfit_steps"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    # SHA-256 of (base photo, quality tier, garment image paths up to this step);
+    # the step's image is stored under outfits/<prefix_key>/
+    prefix_key = Column(String, nullable=False, unique=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    base_photo_path = Column(String, nullable=False)
+    # Garments worn at this step, in order, as comma-separated product ids
+    product_ids = Column(String, nullable=False)
+    depth = Column(Integer, nullable=False)
+    quality = Column(String, nullable=False)
+    output_image_path = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class StatCounter(Base):
+    """Materialized row counts, maintained by stats.py in the same transaction as the writes"""
+    __tablename__ = "stat_counters"
+    
+    # "users", "products", "tryon_sessions" or "tryon_sessions.<status>"
+    name = Column(String, primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+    # created_at of the newest counted row
+    last_at = Column(DateTime, nullable=True)
+
+class CacheVersion(Base):
+    """Version counters for in-process caches; a worker rebuilds its copy when the version moves"""
+    __tablename__ = "cache_versions"
+    
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+class ReprocessJob(Base):
+    """A bulk re-run of try-on sessions left without a usable result (reprocess.py)"""
+    __tablename__ = "reprocess_jobs"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    # pending -> running -> completed, or paused / cancelled / failed; paused and failed jobs can resume
+    status = Column(String, nullable=False, default="pending")
+    # Selection: session statuses (comma-separated) and created_at range
+    statuses = Column(String, nullable=False)
+    created_after = Column(DateTime, nullable=True)
+    created_before = Column(DateTime, nullable=True)
+    quality = Column(String, nullable=False, default="full")
+    concurrency = Column(Integer, nullable=False)
+    rate_per_minute = Column(Float, nullable=False)
+    # Checkpoint: every session with a lower or equal id has been handled
+    checkpoint_id = Column(Integer, nullable=False, default=0)
+    scanned = Column(Integer, nullable=False, default=0)
+    regenerated = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    skipped = Column(Integer, nullable=False, default=0)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    # Touched by the running worker; a running job whose heartbeat stopped may be taken over
+    heartbeat_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+class SessionStatsHourly(Base):
+    """Sessions that reached a final status, per hour"""
+    __tablename__ = "session_stats_hourly"
+    
+    # Start of the hour (UTC)
+    bucket = Column(DateTime, primary_key=True)
+    status = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+# Columns added after the initial schema: (table, column, column DDL, backfill SQL)
+# create_all() only creates missing tables, so existing databases get these via ALTER TABLE
+COLUMN_MIGRATIONS = [
+    (
+        "tryon_sessions", "status", "VARCHAR NOT NULL DEFAULT 'pending'",
+        "UPDATE tryon_sessions SET status = CASE WHEN output_image_path IS NULL THEN 'failed' ELSE 'completed' END",
+    ),
+    (
+        "tryon_sessions", "quality", "VARCHAR",
+        "UPDATE tryon_sessions SET quality = 'full' WHERE output_image_path IS NOT NULL",
+    ),
+    ("products", "phash", "VARCHAR", None),
+    ("products", "canonical_id", "INTEGER", None),
+    ("products", "quality_scores", "TEXT", None),
+    ("user_photos", "quality_scores", "TEXT", None),
+    # Keys claimed before leases existed belong to workers that have since restarted
+    ("idempotency_keys", "lease_expires_at", "DATETIME", "UPDATE idempotency_keys SET lease_expires_at = created_at"),
+]
+
+def run_migrations(bind=None):
+    """Add columns and indexes missing from databases created by an older schema"""
+    bind = bind or engine
+    inspector = inspect(bind)
+    with bind.begin() as conn:
+        for table, column, ddl, backfill in COLUMN_MIGRATIONS:
+            existing = {c["name"] for c in inspector.get_columns(table)}
+            if column in existing:
+                continue
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+            if backfill:
+                conn.execute(text(backfill))
+            print(f"Migrated {table}: added column {column}")
+        
+        # Indexes declared in __table_args__ are only created with their table
+        for table in Base.metadata.sorted_tables:
+            existing = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(bind=conn)
+                    print(f"Migrated {table.name}: added index {index.name}")
 
 # Create tables
-def create_tables():
-    Base.metadata.create_all(bind=engine)
+def create_tables(bind=None):
+    bind = bind or engine
+    Base.metadata.create_all(bind=bind)
+    run_migrations(bind)
 
 # Dependency to get database session
 def get_db():
@@ -0,0 +1,114 @@
+"""
+Per-request deadlines and cooperative cancellation for try-on generation.
+
+A request's deadline comes from its X-Request-Timeout header (seconds), or
+TRYON_REQUEST_TIMEOUT_SECONDS by default, capped at TRYON_MAX_REQUEST_TIMEOUT_SECONDS.
+The same Deadline object is shared by the request handler and the worker thread
+doing the generation: the handler cancels it when the client disconnects or
+time runs out, and the worker checks it between stages and hands the remaining
+time to the upstream call as its timeout.
+"""
+
+import asyncio
+import os
+import threading
+import time
+
+from fastapi.concurrency import run_in_threadpool
+
+DEADLINE_HEADER = "X-Request-Timeout"
+DEFAULT_TIMEOUT_SECONDS = 120
+DEFAULT_MAX_TIMEOUT_SECONDS = 300
+# How often a waiting handler checks whether its client is still connected
+DISCONNECT_POLL_SECONDS = 0.5
+
+class RequestCancelled(Exception):
+    """The work is no longer wanted: the client went away"""
+
+class DeadlineExceeded(RequestCancelled):
+    """The request's deadline passed before the work finished"""
+
+def get_default_timeout() -> float:
+    return float(os.getenv("TRYON_REQUEST_TIMEOUT_SECONDS", str(DEFAULT_TIMEOUT_SECONDS)))
+
+def get_max_timeout() -> float:
+    return float(os.getenv("TRYON_MAX_REQUEST_TIMEOUT_SECONDS", str(DEFAULT_MAX_TIMEOUT_SECONDS)))
+
+class Deadline:
+    def __init__(self, timeout_seconds: float):
+        self.timeout_seconds = timeout_seconds
+        self.expires_at = time.monotonic() + timeout_seconds
+        self._cancelled = threading.Event()
+        self.reason = None
+
+    @classmethod
+    def from_request(cls, requested_seconds: float = None) -> "Deadline":
+        """Deadline for a request that asked for requested_seconds (None for the default)"""
+        timeout = requested_seconds if requested_seconds else get_default_timeout()
+        return cls(min(timeout, get_max_timeout()))
+
+    def restart(self):
+        """Count the full timeout again from now, e.g. once queued work is dispatched"""
+        self.expires_at = time.monotonic() + self.timeout_seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self, reason: str):
+        if not self._cancelled.is_set():
+            self.reason = reason
+            self._cancelled.set()
+
+    def check(self):
+        """Raise if the work should stop; called by workers between stages"""
+        if self.expired():
+            self.cancel("deadline exceeded")
+            raise DeadlineExceeded(f"Deadline of {self.timeout_seconds:g}s exceeded")
+        if self.cancelled:
+            raise RequestCancelled(self.reason)
+
+def _discard(future):
+    # Retrieve the abandoned worker's outcome so it isn't reported as never retrieved
+    if not future.cancelled():
+        future.exception()
+
+async def wait_cancellable(request, deadline: Deadline, future, on_abandon=None):
+    """
+    Wait for future, giving up as soon as the client disconnects (request may be
+    None for background work) or the deadline passes.
+
+    On giving up, on_abandon(future) is called (if given) and RequestCancelled is raised.
+    """
+    while not future.done():
+        await asyncio.wait({future}, timeout=min(DISCONNECT_POLL_SECONDS, deadline.remaining()))
+        if future.done():
+            break
+        if not deadline.cancelled and request is not None and await request.is_disconnected():
+            deadline.cancel("client disconnected")
+        try:
+            deadline.check()
+        except RequestCancelled:
+            if on_abandon:
+                on_abandon(future)
+            raise
+    return future.result()
+
+async def run_cancellable(request, deadline: Deadline, func, *args, on_finish=None, **kwargs):
+    """
+    Run func in a worker thread and wait for it with wait_cancellable().
+
+    Threads can't be interrupted, so on cancellation the deadline is marked and
+    the worker stops at its next check(); its result is discarded. on_finish()
+    is called once the thread is actually done, abandoned or not.
+    """
+    task = asyncio.ensure_future(run_in_threadpool(func, *args, **kwargs))
+    if on_finish:
+        task.add_done_callback(lambda _: on_finish())
+    return await wait_cancellable(request, deadline, task, on_abandon=lambda t: t.add_done_callback(_discard))
@@ -0,0 +1,262 @@
+"""
+Precomputed product feature index for "similar products" suggestions.
+
+Each canonical product gets a 128-dimensional float32 vector, computed once at
+upload time from the garment region of its image (see image_utils.foreground_bbox):
+- 64 dims: 4x4x4 RGB color histogram, square-rooted (Hellinger)
+- 64 dims: 8x8 grayscale layout, zero-mean
+
+The vectors are L2-normalized, so cosine similarity is a dot product. They live
+in one contiguous .npy matrix that is memory-mapped at startup; a top-k query is
+a single matrix-vector product plus argpartition. New products are appended in
+place, and the matrix file doubles in capacity when it fills up.
+
+Near-duplicate products (Product.canonical_id) are not indexed separately; they
+are answered through their canonical product.
+"""
+
+import json
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+import numpy as np
+from PIL import Image
+
+from database import Product
+from image_utils import open_image, content_crop_box, estimate_decoded_bytes
+from memory_budget import decode_budget
+from storage import STORAGE_ROOT
+
+INDEX_DIR = STORAGE_ROOT / "index"
+FEATURE_DIM = 128
+COLOR_BINS = 4
+LAYOUT_SIZE = 8
+# Share of the vector norm given to color vs. layout
+COLOR_WEIGHT = 0.75
+LAYOUT_WEIGHT = 0.25
+INITIAL_CAPACITY = 1024
+# Bump when the feature definition changes; mismatching index files are rebuilt
+FEATURE_VERSION = 1
+
+def compute_product_features(image_path: str) -> np.ndarray:
+    """Feature vector of the garment in a product image"""
+    with decode_budget.reserve(estimate_decoded_bytes(image_path, (256, 256))):
+        img = open_image(image_path, target_size=(256, 256))
+        crop_box = content_crop_box(img, image_path, padding=0.0)
+        if crop_box:
+            img = img.crop(crop_box)
+        # Everything below works on thumbnails
+        img = img.convert('RGB').resize((64, 64), Image.Resampling.BOX)
+
+    pixels = np.asarray(img, dtype=np.uint8).reshape(-1, 3)
+    bins = (pixels // (256 // COLOR_BINS)).astype(np.int32)
+    codes = (bins[:, 0] * COLOR_BINS + bins[:, 1]) * COLOR_BINS + bins[:, 2]
+    histogram = np.sqrt(np.bincount(codes, minlength=COLOR_BINS ** 3) / len(codes))
+
+    layout = np.asarray(img.convert('L').resize((LAYOUT_SIZE, LAYOUT_SIZE), Image.Resampling.BOX), dtype=np.float32).flatten()
+    layout -= layout.mean()
+
+    def unit(v):
+        norm = np.linalg.norm(v)
+        return v / norm if norm > 0 else v
+
+    features = np.concatenate([COLOR_WEIGHT * unit(histogram), LAYOUT_WEIGHT * unit(layout)]).astype(np.float32)
+    return unit(features)
+
+class FeatureIndex:
+    def __init__(self, index_dir: Path = INDEX_DIR):
+        self.index_dir = index_dir
+        self.matrix_path = index_dir / "product_features.npy"
+        self.ids_path = index_dir / "product_ids.npy"
+        self.meta_path = index_dir / "product_features.json"
+        self.lock_path = index_dir / "product_features.lock"
+        # Guards the mapped arrays; writers additionally serialize on write_lock,
+        # which is always taken before the file lock and before self.lock
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.matrix = None
+        self.ids = None
+        self.count = 0
+        self.rows = {}
+        self.generation = None
+
+    # -- file handling --------------------------------------------------
+
+    @contextmanager
+    def _file_lock(self):
+        """Exclusive lock shared by every worker process writing the index files"""
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_path, "a+b") as handle:
+            if fcntl is not None:
+                fcntl.flock(handle, fcntl.LOCK_EX)
+            else:
+                # msvcrt.LK_LOCK gives up after ~10 seconds, so keep retrying
+                handle.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(handle.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        continue
+            try:
+                yield
+            finally:
+                if fcntl is None:
+                    handle.seek(0)
+                    msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def _write_meta(self, count: int):
+        """Publish a new count; every write bumps the generation readers compare against"""
+        generation = (self.generation or 0) + 1
+        temp_path = self.meta_path.with_suffix(".json.tmp")
+        with open(temp_path, "w") as f:
+            json.dump({"count": count, "dim": FEATURE_DIM, "version": FEATURE_VERSION,
+                       "generation": generation}, f)
+        os.replace(temp_path, self.meta_path)
+        self.generation = generation
+
+    def _read_meta(self):
+        try:
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get("dim") != FEATURE_DIM or meta.get("version") != FEATURE_VERSION:
+            return None
+        return meta
+
+    def _map(self):
+        """(Re)map the index files; called with self.lock held"""
+        meta = self._read_meta()
+        if meta is None or not self.matrix_path.exists():
+            self.matrix, self.ids, self.count, self.rows = None, None, 0, {}
+            return False
+        self.matrix = np.load(self.matrix_path, mmap_mode="r+")
+        self.ids = np.load(self.ids_path, mmap_mode="r+")
+        self.count = meta["count"]
+        self.rows = {int(product_id): row for row, product_id in enumerate(self.ids[:self.count])}
+        self.generation = meta.get("generation", 0)
+        return True
+
+    def _refresh_if_changed(self):
+        """Pick up appends and rebuilds made by other worker processes"""
+        meta = self._read_meta()
+        if meta is None:
+            return
+        if meta.get("generation", 0) != self.generation or meta["count"] != self.count:
+            self._map()
+
+    def _allocate(self, capacity: int):
+        """Create empty index files with the given capacity and map them"""
+        matrix = np.lib.format.open_memmap(self.matrix_path.with_suffix(".tmp.npy"), mode="w+",
+                                           dtype=np.float32, shape=(capacity, FEATURE_DIM))
+        ids = np.lib.format.open_memmap(self.ids_path.with_suffix(".tmp.npy"), mode="w+",
+                                        dtype=np.int64, shape=(capacity,))
+        return matrix, ids
+
+    def _grow(self, capacity: int):
+        """Copy the index into files of a larger capacity; called with both locks held"""
+        matrix, ids = self._allocate(capacity)
+        if self.matrix is not None:
+            matrix[:self.count] = self.matrix[:self.count]
+            ids[:self.count] = self.ids[:self.count]
+        matrix.flush()
+        ids.flush()
+        del matrix, ids
+        os.replace(self.matrix_path.with_suffix(".tmp.npy"), self.matrix_path)
+        os.replace(self.ids_path.with_suffix(".tmp.npy"), self.ids_path)
+        self._write_meta(self.count)
+        self._map()
+
+    # -- public API -----------------------------------------------------
+
+    def load(self, db):
+        """Memory-map the index, rebuilding it from the products table if missing or stale"""
+        with self.lock:
+            if self._map():
+                print(f"Feature index mapped {self.count} products")
+                return
+        self.rebuild(db)
+
+    def rebuild(self, db):
+        """Recompute features for every canonical product"""
+        # Hold the file lock throughout, so an add() from any process either lands
+        # before the products query or waits and is applied on top of the new files
+        with self.write_lock, self._file_lock():
+            products = db.query(Product.id, Product.filepath).filter(Product.canonical_id.is_(None)).order_by(Product.id).all()
+            vectors = []
+            product_ids = []
+            for product_id, filepath in products:
+                try:
+                    vectors.append(compute_product_features(str(STORAGE_ROOT / filepath)))
+                    product_ids.append(product_id)
+                except Exception as e:
+                    print(f"Skipping features for product {product_id}: {e}")
+
+            capacity = max(INITIAL_CAPACITY, 2 * len(vectors))
+            matrix, ids = self._allocate(capacity)
+            if vectors:
+                matrix[:len(vectors)] = np.stack(vectors)
+                ids[:len(vectors)] = product_ids
+            matrix.flush()
+            ids.flush()
+            del matrix, ids
+            with self.lock:
+                # Continue the generation sequence of whatever is on disk
+                meta = self._read_meta()
+                if meta is not None:
+                    self.generation = max(self.generation or 0, meta.get("generation", 0))
+                self.matrix, self.ids, self.count = None, None, 0
+                os.replace(self.matrix_path.with_suffix(".tmp.npy"), self.matrix_path)
+                os.replace(self.ids_path.with_suffix(".tmp.npy"), self.ids_path)
+                self._write_meta(len(vectors))
+                self._map()
+        print(f"Feature index rebuilt with {len(vectors)} products")
+
+    def add(self, product_id: int, features: np.ndarray):
+        """Append one product's features in place"""
+        with self.write_lock, self._file_lock(), self.lock:
+            self._refresh_if_changed()
+            if self.matrix is None:
+                self._grow(INITIAL_CAPACITY)
+            if product_id in self.rows:
+                row = self.rows[product_id]
+            else:
+                if self.count == len(self.ids):
+                    self._grow(2 * len(self.ids))
+                row = self.count
+            self.matrix[row] = features
+            self.ids[row] = product_id
+            self.matrix.flush()
+            self.ids.flush()
+            # Readers only look at the first `count` rows, so publish the count last
+            self.count = max(self.count, row + 1)
+            self.rows[product_id] = row
+            self._write_meta(self.count)
+
+    def similar(self, product_id: int, k: int = 5) -> list:
+        """Top-k (product_id, score) most similar to product_id, best first; None if it isn't indexed"""
+        with self.lock:
+            self._refresh_if_changed()
+            row = self.rows.get(product_id)
+            if row is None:
+                return None
+
+            scores = self.matrix[:self.count] @ self.matrix[row]
+            scores[row] = -np.inf
+            k = min(k, self.count - 1)
+            if k <= 0:
+                return []
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(int(self.ids[i]), float(scores[i])) for i in top]
+
+feature_index = FeatureIndex()
@@ -6,103 +6,166 @@ This script provides utilities to format, reset, and migrate the database.
 
 import os
 import sqlite3
-import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 import argparse
 
-def backup_database(db_path: str) -> str:
-    """Create a backup of the current database"""
+from dotenv import load_dotenv
+
+# Rows touched per write transaction, so the API is never blocked for long
+CHUNK_SIZE = 500
+
+# Database pages copied per step of an online backup
+BACKUP_PAGES_PER_STEP = 256
+
+# Threads used to stat files during verification
+VERIFY_WORKERS = 16
+
+STORAGE_PREFIX = "storage/"
+
+def connect(db_path: str) -> sqlite3.Connection:
+    """Open a connection that waits for the API's writers instead of failing"""
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute("PRAGMA busy_timeout = 30000")
+    return conn
+
+def report_progress(label: str, done: int, total: int):
+    """Print an in-place progress line"""
+    percent = (done / total * 100) if total else 100.0
+    end = "\n" if done >= total else ""
+    print(f"\r  {label}: {done}/{total} ({percent:.0f}%)", end=end, flush=True)
+
+def iter_id_chunks(cursor: sqlite3.Cursor, table: str, where: str):
+    """Yield (first_id, last_id) ranges covering CHUNK_SIZE matching rows each"""
+    last_id = None
+    while True:
+        if last_id is None:
+            cursor.execute(f"SELECT id FROM {table} WHERE {where} ORDER BY id LIMIT ?", (CHUNK_SIZE,))
+        else:
+            cursor.execute(f"SELECT id FROM {table} WHERE {where} AND id > ? ORDER BY id LIMIT ?", (last_id, CHUNK_SIZE))
+        ids = [row[0] for row in cursor.fetchall()]
+        if not ids:
+            return
+        yield ids[0], ids[-1], len(ids)
+        last_id = ids[-1]
+
+def backup_database(db_path: str, dry_run: bool = False) -> str:
+    """Create a consistent backup of the database using SQLite's online backup API"""
     if not os.path.exists(db_path):
         print(f"Database {db_path} does not exist, no backup needed")
         return ""
     
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     backup_path = f"{db_path}.backup_{timestamp}"
-    shutil.copy2(db_path, backup_path)
+    if dry_run:
+        print(f"[dry run] Would back up database to: {backup_path}")
+        return ""
+    
+    source = connect(db_path)
+    destination = sqlite3.connect(backup_path)
+    try:
+        # Copies page by page and restarts automatically if the API writes meanwhile,
+        # so the backup is always a consistent snapshot even while the server is running
+        source.backup(
+            destination,
+            pages=BACKUP_PAGES_PER_STEP,
+            progress=lambda status, remaining, total: report_progress("pages", total - remaining, total),
+        )
+    finally:
+        destination.close()
+        source.close()
+    
     print(f"Database backed up to: {backup_path}")
     return backup_path
 
-def reset_database(db_path: str):
+def reset_database(db_path: str, dry_run: bool = False):
     """Completely reset the database by deleting it"""
     if os.path.exists(db_path):
+        if dry_run:
+            print(f"[dry run] Would delete database {db_path}")
+            return
         os.remove(db_path)
+        # A stale WAL left next to a new database file would be replayed into it
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
         print(f"Database {db_path} has been deleted")
     else:
         print(f"Database {db_path} does not exist")
 
-def create_fresh_database():
+def create_fresh_database(dry_run: bool = False):
     """Create a fresh database with proper schema"""
+    if dry_run:
+        print("[dry run] Would create a fresh database")
+        return
     from database import create_tables
     create_tables()
     print("Fresh database created with proper schema")
 
-def fix_filepath_format(db_path: str):
+def fix_filepath_format(db_path: str, dry_run: bool = False):
     """Fix filepaths in the database to use relative paths from storage root"""
     if not os.path.exists(db_path):
         print(f"Database {db_path} does not exist")
         return
     
-    conn = sqlite3.connect(db_path)
+    conn = connect(db_path)
     cursor = conn.cursor()
-    
-    # Fix product filepaths
-    cursor.execute("SELECT id, filepath FROM products")
-    products = cursor.fetchall()
-    
-    updated_products = 0
-    for product_id, filepath in products:
-        if filepath.startswith('storage/'):
-            # Remove 'storage/' prefix
-            new_filepath = filepath[8:]  # Remove 'storage/' (8 characters)
-            cursor.execute("UPDATE products SET filepath = ? WHERE id = ?", (new_filepath, product_id))
-            updated_products += 1
-            print(f"Updated product {product_id}: {filepath} -> {new_filepath}")
-    
-    # Fix try-on session filepaths
-    cursor.execute("SELECT id, input_user_photo_path, input_product_photo_path, output_image_path FROM tryon_sessions")
-    sessions = cursor.fetchall()
-    
-    updated_sessions = 0
-    for session_id, user_path, product_path, output_path in sessions:
-        updates = []
-        new_user_path = user_path
-        new_product_path = product_path
-        new_output_path = output_path
+    prefix_len = len(STORAGE_PREFIX)
+    
+    def has_prefix(column: str) -> str:
+        # substr() instead of LIKE: LIKE is case-insensitive in SQLite
+        return f"substr({column}, 1, {prefix_len}) = '{STORAGE_PREFIX}'"
+    
+    def strip_prefix(column: str) -> str:
+        return f"CASE WHEN {has_prefix(column)} THEN substr({column}, {prefix_len + 1}) ELSE {column} END"
+    
+    session_columns = ["input_user_photo_path", "input_product_photo_path", "output_image_path"]
+    targets = [
+        ("products", has_prefix("filepath"), f"filepath = {strip_prefix('filepath')}"),
+        (
+            "tryon_sessions",
+            " OR ".join(has_prefix(column) for column in session_columns),
+            ", ".join(f"{column} = {strip_prefix(column)}" for column in session_columns),
+        ),
+    ]
+    
+    updated = {}
+    for table, where, assignments in targets:
+        cursor.execute(f"SELECT COUNT(*) FROM {table} WHERE {where}")
+        total = cursor.fetchone()[0]
+        updated[table] = total
+        if dry_run or not total:
+            continue
         
-        if user_path and user_path.startswith('storage/'):
-            new_user_path = user_path[8:]
-            updates.append(f"user_path: {user_path} -> {new_user_path}")
+        # Resolve the id range first, then update it in its own short transaction
+        done = 0
+        for first_id, last_id, count in iter_id_chunks(cursor, table, f"({where})"):
+            cursor.execute(f"UPDATE {table} SET {assignments} WHERE id BETWEEN ? AND ? AND ({where})", (first_id, last_id))
+            conn.commit()
+            done += count
+            report_progress(table, done, total)
         
-        if product_path and product_path.startswith('storage/'):
-            new_product_path = product_path[8:]
-            updates.append(f"product_path: {product_path} -> {new_product_path}")
-        
-        if output_path and output_path.startswith('storage/'):
-            new_output_path = output_path[8:]
-            updates.append(f"output_path: {output_path} -> {new_output_path}")
-        
-        if updates:
-            cursor.execute("""
-                UPDATE tryon_sessions 
-                SET input_user_photo_path = ?, input_product_photo_path = ?, output_image_path = ? 
-                WHERE id = ?
-            """, (new_user_path, new_product_path, new_output_path, session_id))
-            updated_sessions += 1
-            print(f"Updated session {session_id}: {', '.join(updates)}")
-    
-    conn.commit()
+        if table == "products":
+            # Running API servers rebuild their catalog snapshots when the version moves
+            from catalog import BUMP_VERSION_SQL
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'cache_versions'")
+            if cursor.fetchone():
+                cursor.execute(BUMP_VERSION_SQL)
+                conn.commit()
+    
     conn.close()
     
-    print(f"Fixed {updated_products} product filepaths and {updated_sessions} session filepaths")
+    action = "Would fix" if dry_run else "Fixed"
+    print(f"{action} {updated['products']} product filepaths and {updated['tryon_sessions']} session filepaths")
 
-def clean_orphaned_sessions(db_path: str):
+def clean_orphaned_sessions(db_path: str, dry_run: bool = False):
     """Clean up try-on sessions that reference non-existent users or products"""
     if not os.path.exists(db_path):
         print(f"Database {db_path} does not exist")
         return
     
-    conn = sqlite3.connect(db_path)
+    conn = connect(db_path)
     cursor = conn.cursor()
     
     # Find orphaned sessions
@@ -121,70 +184,127 @@ def clean_orphaned_sessions(db_path: str):
         for session_id, user_id, product_id in orphaned_sessions:
             print(f"  Session {session_id}: user_id={user_id}, product_id={product_id}")
         
-        cursor.execute("""
-            DELETE FROM tryon_sessions 
-            WHERE id IN (
-                SELECT ts.id 
-                FROM tryon_sessions ts
-                LEFT JOIN users u ON ts.user_id = u.id
-                LEFT JOIN products p ON ts.product_id = p.id
-                WHERE u.id IS NULL OR p.id IS NULL
-            )
-        """)
+        if dry_run:
+            print(f"[dry run] Would delete {len(orphaned_sessions)} orphaned sessions and their result files")
+            conn.close()
+            return
+        
+        from storage import delete_result_files
+        
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stat_counters'")
+        has_counters = cursor.fetchone() is not None
+        
+        # Delete in chunks, removing each chunk's result files once its rows are gone
+        orphaned_ids = [session_id for session_id, _, _ in orphaned_sessions]
+        freed = 0
+        for start in range(0, len(orphaned_ids), CHUNK_SIZE):
+            chunk = orphaned_ids[start:start + CHUNK_SIZE]
+            placeholders = ", ".join("?" for _ in chunk)
+            if has_counters:
+                # Keep the materialized counters in step, in the same transaction
+                cursor.execute(f"SELECT status, COUNT(*) FROM tryon_sessions WHERE id IN ({placeholders}) GROUP BY status", chunk)
+                for status, count in cursor.fetchall():
+                    for name in ("tryon_sessions", f"tryon_sessions.{status}"):
+                        cursor.execute("UPDATE stat_counters SET value = value - ? WHERE name = ?", (count, name))
+            cursor.execute(f"DELETE FROM tryon_sessions WHERE id IN ({placeholders})", chunk)
+            conn.commit()
+            freed += sum(delete_result_files(session_id) for session_id in chunk)
+            report_progress("sessions", start + len(chunk), len(orphaned_ids))
         
-        conn.commit()
         print(f"Deleted {len(orphaned_sessions)} orphaned sessions")
+        print(f"Removed result files of orphaned sessions ({freed} bytes)")
     else:
         print("No orphaned sessions found")
     
     conn.close()
 
 def show_database_stats(db_path: str):
-    """Show statistics about the database contents"""
+    """Show statistics about the database contents, read from the materialized counters"""
     if not os.path.exists(db_path):
         print(f"Database {db_path} does not exist")
         return
     
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    # Count records in each table
-    cursor.execute("SELECT COUNT(*) FROM users")
-    user_count = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM products")
-    product_count = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM tryon_sessions")
-    session_count = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM tryon_sessions WHERE output_image_path IS NOT NULL")
-    completed_sessions = cursor.fetchone()[0]
-    
-    print("\n=== Database Statistics ===")
-    print(f"Users: {user_count}")
-    print(f"Products: {product_count}")
-    print(f"Try-on Sessions: {session_count}")
-    print(f"Completed Sessions: {completed_sessions}")
-    print(f"Failed Sessions: {session_count - completed_sessions}")
-    
-    # Show recent activity
-    cursor.execute("SELECT created_at FROM users ORDER BY created_at DESC LIMIT 1")
-    last_user = cursor.fetchone()
-    if last_user:
-        print(f"Last user created: {last_user[0]}")
-    
-    cursor.execute("SELECT created_at FROM products ORDER BY created_at DESC LIMIT 1")
-    last_product = cursor.fetchone()
-    if last_product:
-        print(f"Last product created: {last_product[0]}")
-    
-    cursor.execute("SELECT created_at FROM tryon_sessions ORDER BY created_at DESC LIMIT 1")
-    last_session = cursor.fetchone()
-    if last_session:
-        print(f"Last try-on session: {last_session[0]}")
+    from sqlalchemy import create_engine, text
+    from sqlalchemy.exc import OperationalError
+    # Importing database also registers its busy_timeout/WAL pragmas, so this waits for the API's writers
+    from database import DEFAULT_BUSY_TIMEOUT_MS
+    
+    engine = create_engine(f"sqlite:///{db_path}", connect_args={"timeout": DEFAULT_BUSY_TIMEOUT_MS / 1000})
+    try:
+        with engine.connect() as conn:
+            # The counters are kept up to date by the API, so this never scans the big tables
+            try:
+                rows = conn.execute(text("SELECT name, value, last_at FROM stat_counters")).fetchall()
+                counters = {name: (value, last_at) for name, value, last_at in rows}
+            except OperationalError:
+                counters = {}
+            if "stats_version" not in counters:
+                print("Statistics have not been built yet, run: python format_database.py rebuild-stats")
+                return
+            
+            def count(name: str) -> int:
+                return counters.get(name, (0, None))[0]
+            
+            print("\n=== Database Statistics ===")
+            print(f"Users: {count('users')}")
+            print(f"Products: {count('products')}")
+            print(f"Try-on Sessions: {count('tryon_sessions')}")
+            prefix = "tryon_sessions."
+            for name in sorted(name for name in counters if name.startswith(prefix) and count(name)):
+                print(f"  {name[len(prefix):].capitalize()}: {count(name)}")
+            
+            recent = conn.execute(text(
+                "SELECT status, SUM(count) FROM session_stats_hourly WHERE bucket >= datetime('now', '-24 hours') GROUP BY status"
+            )).fetchall()
+            for status, total in recent:
+                print(f"{status.capitalize()} in the last 24 hours: {total}")
+            
+            # Show recent activity
+            for name, label in [("users", "Last user created"), ("products", "Last product created"), ("tryon_sessions", "Last try-on session")]:
+                last_at = counters.get(name, (0, None))[1]
+                if last_at:
+                    print(f"{label}: {last_at}")
+    finally:
+        engine.dispose()
+
+def rebuild_stats(db_path: str, dry_run: bool = False):
+    """Recompute the materialized statistics from the tables"""
+    if not os.path.exists(db_path):
+        print(f"Database {db_path} does not exist")
+        return
+    if dry_run:
+        print("[dry run] Would recompute stat_counters and session_stats_hourly")
+        return
     
-    conn.close()
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from database import create_tables
+    import stats
+    
+    engine = create_engine(f"sqlite:///{db_path}", connect_args={"timeout": 30})
+    create_tables(engine)
+    db = sessionmaker(bind=engine)()
+    try:
+        counters = stats.rebuild(db)
+        print(f"Rebuilt statistics: {counters}")
+    finally:
+        db.close()
+        engine.dispose()
+
+def find_missing_files(rows: list, storage_root: Path, label: str) -> list:
+    """Return the rows whose last column does not exist under storage_root, checked in parallel"""
+    missing = []
+    if not rows:
+        return missing
+    
+    with ThreadPoolExecutor(max_workers=VERIFY_WORKERS) as executor:
+        paths = (storage_root / row[-1] for row in rows)
+        for done, (row, exists) in enumerate(zip(rows, executor.map(os.path.exists, paths)), start=1):
+            if not exists:
+                missing.append(row)
+            if done % CHUNK_SIZE == 0 or done == len(rows):
+                report_progress(label, done, len(rows))
+    return missing
 
 def verify_file_paths(db_path: str):
     """Verify that all file paths in the database point to existing files"""
@@ -192,7 +312,7 @@ def verify_file_paths(db_path: str):
         print(f"Database {db_path} does not exist")
         return
     
-    conn = sqlite3.connect(db_path)
+    conn = connect(db_path)
     cursor = conn.cursor()
     storage_root = Path("./storage")
     
@@ -202,12 +322,12 @@ def verify_file_paths(db_path: str):
     cursor.execute("SELECT id, name, filepath FROM products")
     products = cursor.fetchall()
     
-    missing_products = []
-    for product_id, name, filepath in products:
-        full_path = storage_root / filepath
-        if not full_path.exists():
-            missing_products.append((product_id, name, filepath))
+    # Check session files
+    cursor.execute("SELECT id, output_image_path FROM tryon_sessions WHERE output_image_path IS NOT NULL")
+    sessions = cursor.fetchall()
+    conn.close()
     
+    missing_products = find_missing_files(products, storage_root, "products")
     if missing_products:
         print(f"Missing product files ({len(missing_products)}):")
         for product_id, name, filepath in missing_products:
@@ -215,29 +335,250 @@ def verify_file_paths(db_path: str):
     else:
         print(f"All {len(products)} product files exist")
     
-    # Check session files
-    cursor.execute("SELECT id, input_user_photo_path, output_image_path FROM tryon_sessions WHERE output_image_path IS NOT NULL")
-    sessions = cursor.fetchall()
-    
-    missing_results = []
-    for session_id, user_path, output_path in sessions:
-        if output_path:
-            full_path = storage_root / output_path
-            if not full_path.exists():
-                missing_results.append((session_id, output_path))
-    
+    missing_results = find_missing_files(sessions, storage_root, "results")
     if missing_results:
         print(f"Missing result files ({len(missing_results)}):")
         for session_id, output_path in missing_results:
             print(f"  Session {session_id}: {output_path}")
     else:
         print(f"All {len(sessions)} result files exist")
+
+def collect_garbage(db_path: str, dry_run: bool = False):
+    """Apply the configured storage retention policies once"""
+    if not os.path.exists(db_path):
+        print(f"Database {db_path} does not exist")
+        return
     
-    conn.close()
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from database import create_tables
+    from retention import RetentionPolicy, StorageCollector
+    
+    engine = create_engine(f"sqlite:///{db_path}")
+    create_tables(engine)
+    policy = RetentionPolicy.from_env()
+    print(f"Retention policy: {policy}")
+    
+    collector = StorageCollector(policy, session_factory=sessionmaker(bind=engine))
+    summary = collector.run_once(dry_run=dry_run)
+    
+    print(f"\n=== Garbage Collection{' (dry run)' if dry_run else ''} ===")
+    print(f"Expired results: {summary['expired_results']}")
+    print(f"Results over per-user limit: {summary['per_user_results']}")
+    print(f"Results evicted for byte budget: {summary['budget_results']}")
+    print(f"Outfit steps evicted for byte budget: {summary['budget_outfit_steps']}")
+    print(f"Orphaned result directories: {summary['orphaned_results']}")
+    print(f"Old user photos: {summary['user_photos']}")
+    print(f"Expired idempotency keys: {summary['idempotency_keys']}")
+    print(f"Bytes freed: {summary['bytes_freed']}")
+    engine.dispose()
+
+def index_photos(db_path: str, dry_run: bool = False):
+    """Compute perceptual hashes for products and user photos stored before hashing existed"""
+    if not os.path.exists(db_path):
+        print(f"Database {db_path} does not exist")
+        return
+    
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from database import create_tables
+    from phash_index import backfill_hashes
+    
+    engine = create_engine(f"sqlite:///{db_path}")
+    create_tables(engine)
+    db = sessionmaker(bind=engine)()
+    try:
+        summary = backfill_hashes(db, dry_run=dry_run)
+    finally:
+        db.close()
+        engine.dispose()
+    
+    action = "Would index" if dry_run else "Indexed"
+    print(f"{action} {summary['products']} products and {summary['user_photos']} user photos")
+
+def index_features(db_path: str, dry_run: bool = False):
+    """Rebuild the similar-products feature index from every canonical product image"""
+    if not os.path.exists(db_path):
+        print(f"Database {db_path} does not exist")
+        return
+    
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from database import create_tables, Product
+    from feature_index import feature_index
+    
+    engine = create_engine(f"sqlite:///{db_path}")
+    create_tables(engine)
+    db = sessionmaker(bind=engine)()
+    try:
+        if dry_run:
+            count = db.query(Product).filter(Product.canonical_id.is_(None)).count()
+            print(f"Would index features for {count} products into {feature_index.index_dir}")
+        else:
+            feature_index.rebuild(db)
+    finally:
+        db.close()
+        engine.dispose()
+
+def mark_failed_results(db_path: str, dry_run: bool = False):
+    """Mark completed sessions whose stored output is the error placeholder as failed"""
+    if not os.path.exists(db_path):
+        print(f"Database {db_path} does not exist")
+        return
+    
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from database import create_tables, TryOnSession
+    from gemini_client import is_error_image
+    import stats
+    
+    engine = create_engine(f"sqlite:///{db_path}")
+    create_tables(engine)
+    db = sessionmaker(bind=engine)()
+    storage_root = Path("./storage")
+    marked = 0
+    last_id = 0
+    try:
+        while True:
+            sessions = db.query(TryOnSession).filter(
+                TryOnSession.id > last_id, TryOnSession.status == "completed",
+                TryOnSession.output_image_path.isnot(None)
+            ).order_by(TryOnSession.id).limit(CHUNK_SIZE).all()
+            if not sessions:
+                break
+            last_id = sessions[-1].id
+            failed_ids = [session.id for session in sessions if is_error_image(storage_root / session.output_image_path)]
+            if failed_ids and not dry_run:
+                # Only rows still completed, in case the API finished them meanwhile
+                updated = db.query(TryOnSession).filter(
+                    TryOnSession.id.in_(failed_ids), TryOnSession.status == "completed"
+                ).update({"status": "failed"}, synchronize_session=False)
+                stats.record_status_change(db, {"completed": updated}, "failed")
+                db.commit()
+            else:
+                db.rollback()
+            marked += len(failed_ids)
+    finally:
+        db.close()
+        engine.dispose()
+    
+    action = "Would mark" if dry_run else "Marked"
+    print(f"{action} {marked} sessions with an error image as failed")
+
+def parse_timestamp(value: str) -> datetime:
+    """argparse type for --since/--until: an ISO date or date and time (UTC)"""
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not an ISO date or timestamp: {value}")
+
+# Same bounds as models.ReprocessRequest
+MAX_REPROCESS_CONCURRENCY = 16
+MAX_REPROCESS_RATE_PER_MINUTE = 600
+
+def parse_concurrency(value: str) -> int:
+    """argparse type for --concurrency: 1 to MAX_REPROCESS_CONCURRENCY sessions"""
+    try:
+        concurrency = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not an integer: {value}")
+    if not 1 <= concurrency <= MAX_REPROCESS_CONCURRENCY:
+        raise argparse.ArgumentTypeError(f"must be between 1 and {MAX_REPROCESS_CONCURRENCY}")
+    return concurrency
+
+def parse_rate(value: str) -> float:
+    """argparse type for --rate: more than 0, up to MAX_REPROCESS_RATE_PER_MINUTE per minute"""
+    try:
+        rate = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a number: {value}")
+    if not 0 < rate <= MAX_REPROCESS_RATE_PER_MINUTE:
+        raise argparse.ArgumentTypeError(f"must be more than 0 and at most {MAX_REPROCESS_RATE_PER_MINUTE}")
+    return rate
+
+def reprocess_sessions(db_path: str, args, dry_run: bool = False):
+    """Re-run sessions without a usable result, or resume an earlier reprocessing job"""
+    if not os.path.exists(db_path):
+        print(f"Database {db_path} does not exist")
+        return
+    
+    import asyncio
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from fastapi.concurrency import run_in_threadpool
+    from database import create_tables, ReprocessJob
+    from deadline import Deadline
+    from quality import QUALITY_TIERS
+    import reprocess
+    
+    engine = create_engine(f"sqlite:///{db_path}")
+    create_tables(engine)
+    session_factory = sessionmaker(bind=engine)
+    db = session_factory()
+    try:
+        statuses = args.status or list(reprocess.DEFAULT_STATUSES)
+        if args.resume:
+            job = db.get(ReprocessJob, args.resume)
+            if not job:
+                print(f"Reprocess job {args.resume} not found")
+                return
+            statuses = reprocess.job_statuses(job)
+            print(f"Job {job.id} is {job.status} at checkpoint {job.checkpoint_id}: "
+                  f"{job.regenerated} regenerated, {job.failed} failed, {job.skipped} skipped so far")
+        
+        if dry_run:
+            since = job.created_after if args.resume else args.since
+            until = job.created_before if args.resume else args.until
+            counts = reprocess.preview(db, statuses, since, until)
+            print(f"\n=== Reprocess (dry run): statuses {', '.join(statuses)} ===")
+            print(f"Sessions scanned: {counts['scanned']}")
+            print(f"Would regenerate, generation failed: {counts['failed_generation']}")
+            print(f"Would regenerate, output missing: {counts['missing_output']}")
+            print(f"Skipped, possibly still generating: {counts['in_flight']}")
+            print(f"Skipped, input photos missing: {counts['inputs_missing']}")
+            return
+        
+        if not args.resume:
+            try:
+                job = reprocess.create_job(db, statuses, args.since, args.until, args.quality,
+                                           args.concurrency, args.rate)
+            except ValueError as e:
+                print(f"Error: {e}")
+                return
+            print(f"Created reprocess job {job.id}")
+        if not reprocess.claim_job(db, job.id):
+            db.refresh(job)
+            print(f"Reprocess job {job.id} is {job.status} and can't be run now")
+            return
+        job_id = job.id
+    finally:
+        db.close()
+    
+    # No scheduler outside the API: the job's concurrency and rate are the only limits
+    from gemini_client import GeminiClient
+    client = GeminiClient()
+    
+    async def generate(candidate, tier):
+        return await run_in_threadpool(
+            client.generate_tryon_image, candidate.user_photo_path, candidate.product_photo_path,
+            candidate.product_name, target_size=QUALITY_TIERS[tier], deadline=Deadline.from_request()
+        )
+    
+    runner = reprocess.ReprocessRunner(job_id, generate, session_factory=session_factory)
+    try:
+        status = asyncio.run(runner.run())
+    except KeyboardInterrupt:
+        status = "paused"
+    if status in reprocess.RESUMABLE_JOB_STATUSES:
+        print(f"Resume with: python format_database.py reprocess --resume {job_id}")
+    engine.dispose()
 
 def main():
+    # RETENTION_* and the other settings in .env apply to the maintenance commands too
+    load_dotenv()
     parser = argparse.ArgumentParser(description="Database formatting and management script")
     parser.add_argument("--db", default="tryon.db", help="Database file path (default: tryon.db)")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would change without modifying anything")
     
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
     
@@ -253,12 +594,38 @@ def main():
     # Stats command
     subparsers.add_parser("stats", help="Show database statistics")
     
+    # Statistics rebuild command
+    subparsers.add_parser("rebuild-stats", help="Recompute the materialized statistics from scratch")
+    
     # Verify command
     subparsers.add_parser("verify", help="Verify file paths exist")
     
     # Backup command
     subparsers.add_parser("backup", help="Create database backup")
     
+    # Garbage collection command
+    subparsers.add_parser("gc", help="Apply storage retention policies once")
+    
+    # Perceptual hash backfill command
+    subparsers.add_parser("index-photos", help="Hash products and user photos uploaded before hashing existed")
+    
+    # Feature index rebuild command
+    subparsers.add_parser("index-features", help="Rebuild the similar-products feature index")
+    
+    # Legacy error result repair command
+    subparsers.add_parser("mark-failed", help="Mark completed sessions stored with an error image as failed")
+    
+    # Reprocess command
+    reprocess_parser = subparsers.add_parser("reprocess", help="Re-run sessions left without a usable result")
+    reprocess_parser.add_argument("--status", action="append", choices=["pending", "preview", "completed", "failed", "cancelled"],
+                                  help="Session status to select; repeat for several (default: failed)")
+    reprocess_parser.add_argument("--since", type=parse_timestamp, help="Only sessions created at or after this time (UTC)")
+    reprocess_parser.add_argument("--until", type=parse_timestamp, help="Only sessions created before this time (UTC)")
+    reprocess_parser.add_argument("--quality", choices=["preview", "full"], default="full", help="Quality tier of the new results")
+    reprocess_parser.add_argument("--concurrency", type=parse_concurrency, default=2, help="Sessions generated at once (default: 2)")
+    reprocess_parser.add_argument("--rate", type=parse_rate, default=30, help="Sessions started per minute at most (default: 30)")
+    reprocess_parser.add_argument("--resume", type=int, metavar="JOB_ID", help="Continue an earlier job from its checkpoint")
+    
     args = parser.parse_args()
     
     if not args.command:
@@ -266,33 +633,57 @@ def main():
         return
     
     db_path = args.db
+    dry_run = args.dry_run
     
     if args.command == "reset":
-        confirm = input(f"Are you sure you want to reset the database '{db_path}'? (y/N): ")
+        confirm = "y" if dry_run else input(f"Are you sure you want to reset the database '{db_path}'? (y/N): ")
         if confirm.lower() == 'y':
-            backup_database(db_path)
-            reset_database(db_path)
-            create_fresh_database()
+            backup_database(db_path, dry_run=dry_run)
+            reset_database(db_path, dry_run=dry_run)
+            create_fresh_database(dry_run=dry_run)
         else:
             print("Reset cancelled")
     
     elif args.command == "fix":
-        backup_database(db_path)
-        fix_filepath_format(db_path)
-        print("Database filepaths have been fixed")
+        backup_database(db_path, dry_run=dry_run)
+        fix_filepath_format(db_path, dry_run=dry_run)
+        if not dry_run:
+            print("Database filepaths have been fixed")
     
     elif args.command == "clean":
-        backup_database(db_path)
-        clean_orphaned_sessions(db_path)
+        backup_database(db_path, dry_run=dry_run)
+        clean_orphaned_sessions(db_path, dry_run=dry_run)
     
     elif args.command == "stats":
         show_database_stats(db_path)
     
+    elif args.command == "rebuild-stats":
+        rebuild_stats(db_path, dry_run=dry_run)
+    
     elif args.command == "verify":
         verify_file_paths(db_path)
     
     elif args.command == "backup":
-        backup_database(db_path)
+        backup_database(db_path, dry_run=dry_run)
+    
+    elif args.command == "gc":
+        backup_database(db_path, dry_run=dry_run)
+        collect_garbage(db_path, dry_run=dry_run)
+    
+    elif args.command == "index-photos":
+        backup_database(db_path, dry_run=dry_run)
+        index_photos(db_path, dry_run=dry_run)
+    
+    elif args.command == "index-features":
+        index_features(db_path, dry_run=dry_run)
+    
+    elif args.command == "mark-failed":
+        backup_database(db_path, dry_run=dry_run)
+        mark_failed_results(db_path, dry_run=dry_run)
+    
+    elif args.command == "reprocess":
+        backup_database(db_path, dry_run=dry_run)
+        reprocess_sessions(db_path, args, dry_run=dry_run)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
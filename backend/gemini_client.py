@@ -1,31 +1,119 @@
+import logging
 import os
-import google.generativeai as genai
+from dataclasses import dataclass
+from typing import Optional
 from dotenv import load_dotenv
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageChops, ImageDraw, ImageFont
 import io
-import base64
 
-# Enable AVIF support
-try:
-    import pillow_avif  # This enables AVIF support for PIL
-    print("AVIF support enabled")
-except ImportError:
-    print("AVIF support not available - install pillow-avif-plugin")
+import metrics
+from deadline import RequestCancelled
+from image_utils import open_image, content_crop_box, estimate_decoded_bytes, ImageTooLargeError, REDUCING_GAP
+from memory_budget import decode_budget
+from upstream import create_backend
+
+logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
 
+# Decoded input plus one full-size working copy (RGB conversion or crop) per input
+INPUT_WORKING_COPIES = 2
+
+# Margin kept around detected content, as a fraction of the content size
+PERSON_CROP_PADDING = 0.08
+PRODUCT_CROP_PADDING = 0.05
+
+# Formats Gemini accepts for inputs, by Pillow format name
+UPSTREAM_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+JPEG_SUBSAMPLING = ("4:4:4", "4:2:2", "4:2:0")
+
+# Placeholder carried by TryOnGenerationError when generation fails: red text on white
+ERROR_IMAGE_SIZE = (512, 512)
+
+@dataclass(frozen=True)
+class UpstreamEncoding:
+    """
+    How preprocessed inputs are encoded for the model. quality applies to JPEG
+    and WebP; subsampling (None = Pillow's default) to JPEG; optimize is an
+    extra Huffman pass for JPEG, the slowest compression method for WebP and
+    zlib optimization for PNG. Pick settings with benchmarks/tune_upstream_encoding.py.
+    """
+    format: str = "JPEG"
+    quality: int = 95
+    subsampling: Optional[str] = None
+    optimize: bool = True
+
+    def __post_init__(self):
+        if self.format not in UPSTREAM_MIME_TYPES:
+            raise ValueError(f"UPSTREAM_IMAGE_FORMAT must be one of {', '.join(UPSTREAM_MIME_TYPES)}")
+        if self.subsampling is not None and self.subsampling not in JPEG_SUBSAMPLING:
+            raise ValueError(f"UPSTREAM_IMAGE_SUBSAMPLING must be one of {', '.join(JPEG_SUBSAMPLING)}")
+
+    @classmethod
+    def from_env(cls) -> "UpstreamEncoding":
+        return cls(
+            format=os.getenv("UPSTREAM_IMAGE_FORMAT", "JPEG").upper(),
+            quality=int(os.getenv("UPSTREAM_IMAGE_QUALITY", "95")),
+            subsampling=os.getenv("UPSTREAM_IMAGE_SUBSAMPLING") or None,
+            optimize=os.getenv("UPSTREAM_IMAGE_OPTIMIZE", "1") != "0",
+        )
+
+    @property
+    def mime_type(self) -> str:
+        return UPSTREAM_MIME_TYPES[self.format]
+
+    def describe(self) -> str:
+        parts = [self.format]
+        if self.format != "PNG":
+            parts.append(f"q{self.quality}")
+        if self.format == "JPEG" and self.subsampling:
+            parts.append(self.subsampling)
+        if self.optimize:
+            parts.append("optimize")
+        return " ".join(parts)
+
+class TryOnGenerationError(Exception):
+    """The model produced no try-on; error_image is a placeholder PNG saying why"""
+
+    def __init__(self, message: str, error_image: bytes):
+        super().__init__(message)
+        self.error_image = error_image
+
+def is_error_image(source) -> bool:
+    """
+    True if source (a path or image bytes) is a placeholder from GeminiClient._create_error_image.
+    
+    Failures are recorded as failed sessions when they happen; this only exists for
+    format_database.py mark-failed, which repairs results stored before that.
+    
+    Such images are white and red only: the red channel is saturated everywhere and
+    the text's anti-aliasing keeps green equal to blue. Model output never is.
+    """
+    try:
+        with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as image:
+            # Only the header has been read so far, so other sizes are rejected cheaply
+            if image.size != ERROR_IMAGE_SIZE or image.mode != "RGB":
+                return False
+            red, green, blue = image.split()
+    except (OSError, ValueError):
+        return False
+    return (red.getextrema() == (255, 255) and ImageChops.difference(green, blue).getbbox() is None
+            and green.getextrema()[0] < 255)
+
+def auto_crop_enabled() -> bool:
+    """Content cropping of model inputs, on unless TRYON_AUTO_CROP=0"""
+    return os.getenv("TRYON_AUTO_CROP", "1") != "0"
+
 class GeminiClient:
-    def __init__(self):
-        api_key = os.getenv("GEMINI_API_KEY")
-        if not api_key:
-            raise ValueError("GEMINI_API_KEY environment variable is required")
-        
-        genai.configure(api_key=api_key)
-        # Use Gemini 2.5 Flash Image Preview (Nano Banana) for virtual try-on generation
-        self.model = genai.GenerativeModel('gemini-2.5-flash-image-preview')
+    def __init__(self, backend=None, encoding: UpstreamEncoding = None):
+        # The upstream call itself (Gemini or the local stub, optionally hedged) lives in upstream.py
+        self.backend = backend or create_backend()
+        self.encoding = encoding or UpstreamEncoding.from_env()
     
-    def generate_tryon_image(self, user_photo_path: str, product_photo_path: str, product_name: str) -> bytes:
+    def generate_tryon_image(self, user_photo_path: str, product_photo_path: str, product_name: str,
+                             target_size: tuple = (1024, 1024), deadline=None, layered: bool = False,
+                             reservation=None) -> bytes:
         """
         Generate virtual try-on image using Gemini 2.5 Flash Image Preview (Nano Banana)
         
@@ -33,35 +121,70 @@ class GeminiClient:
             user_photo_path: Path to user's full-body photo
             product_photo_path: Path to product photo
             product_name: Name of the product for context
+            target_size: Maximum size of the inputs sent to the model (smaller is faster)
+            deadline: Optional deadline.Deadline; checked between stages and used as the upstream timeout
+            layered: Add the garment on top of what the person already wears (outfit chaining)
+                     instead of replacing their outfit
+            reservation: Optional memory_budget.Reservation the caller already acquired for
+                         preprocessing (see estimate_input_bytes); released once it's done
             
         Returns:
             bytes: Generated try-on image data
+            
+        Raises:
+            RequestCancelled: the deadline passed or the request was cancelled
+            TryOnGenerationError: no try-on was produced; carries a placeholder image
         """
         try:
-            # Load images and convert to supported format, optimized for virtual try-on
-            user_image = self._load_and_convert_image(user_photo_path)
-            product_image = self._load_and_convert_image(product_photo_path)
-            
-            # Resize images for optimal processing while maintaining aspect ratio
-            user_image = self._optimize_image_for_tryon(user_image, target_size=(1024, 1024), is_person=True)
-            product_image = self._optimize_image_for_tryon(product_image, target_size=(1024, 1024), is_person=False)
-            
-            # Convert PIL images to high-quality byte data for Gemini
-            user_image_bytes = self._pil_to_bytes(user_image, format='JPEG', quality=95)
-            product_image_bytes = self._pil_to_bytes(product_image, format='JPEG', quality=95)
+            # Decoding and preprocessing hold the budget; only the encoded JPEGs
+            # outlive this block, so the long upstream call holds no pixels
+            if reservation is None:
+                held = decode_budget.reserve(self.estimate_input_bytes((user_photo_path, product_photo_path), target_size),
+                                             deadline=deadline)
+            else:
+                held = decode_budget.holding(reservation)
+            with held:
+                # Load images and convert to supported format, optimized for virtual try-on
+                user_image = self._load_and_convert_image(user_photo_path, target_size=target_size)
+                product_image = self._load_and_convert_image(product_photo_path, target_size=target_size)
+                if deadline:
+                    deadline.check()
+                
+                # Crop to content and resize for optimal processing while maintaining aspect ratio
+                user_image = self._optimize_image_for_tryon(user_image, target_size=target_size, is_person=True,
+                                                            source_path=user_photo_path)
+                product_image = self._optimize_image_for_tryon(product_image, target_size=target_size, is_person=False,
+                                                               source_path=product_photo_path)
+                
+                # Encode for Gemini with the configured upstream encoding
+                user_image_bytes = self._encode_for_upstream(user_image)
+                product_image_bytes = self._encode_for_upstream(product_image)
+                self._report_crop_savings(user_image, user_image_bytes)
+                self._report_crop_savings(product_image, product_image_bytes)
+                user_size, product_size = user_image.size, product_image.size
+                del user_image, product_image
             
             print(f"Generating virtual try-on for user photo: {user_photo_path}")
             print(f"Product photo: {product_photo_path}")
             print(f"Product name: {product_name}")
-            print(f"User image optimized: {user_image.size}")
-            print(f"Product image optimized: {product_image.size}")
-            print(f"Images converted to high-quality JPEG format for Gemini")
+            print(f"User image optimized: {user_size}")
+            print(f"Product image optimized: {product_size}")
+            print(f"Images encoded for Gemini as {self.encoding.describe()}: "
+                  f"{len(user_image_bytes)} + {len(product_image_bytes)} bytes")
+            
+            # Outfit steps keep the garments added by earlier steps
+            if layered:
+                outfit_instruction = f"Keep every garment the person already wears that the {product_name} does not replace."
+                outfit_prohibition = f"Do NOT remove or change garments that the {product_name} does not cover."
+            else:
+                outfit_instruction = "Completely remove the model's previous outfit."
+                outfit_prohibition = "Remove all parts of the previous outfit and its shadows."
             
             # Create an improved detailed prompt for realistic virtual try-on using Nano Banana
             tryon_prompt = f"""You are an advanced virtual try-on AI. Create a PRECISE virtual try-on image where the person from the first image is wearing the EXACT {product_name} from the second image.
 
 FOCUS AREAS:
-# Completely remove the model's previous outfit.
+# {outfit_instruction}
 # Replace with the uploaded {product_name} so it looks naturally worn.
 # Preserve model's **face, pose, hair, and body proportions**.
 # Match lighting and shadows to the original image.
@@ -91,7 +214,7 @@ CRITICAL REQUIREMENTS:
 STRICT PROHIBITIONS:
 ## Do NOT alter the face, skin tone, or hair.
 ## Do NOT change background or add new objects.
-## Remove all parts of the previous outfit and its shadows.
+## {outfit_prohibition}
 ## Do NOT modify body proportions or pose.
 ## Do NOT change lighting conditions from the original photo.
 
@@ -107,71 +230,55 @@ The final result should look like the person actually purchased and is wearing t
             # Generate the try-on image using Gemini 2.5 Flash Image Preview (Nano Banana)
             print("Generating virtual try-on with Gemini 2.5 Flash Image Preview...")
             
-            # Create image objects that Gemini can understand
-            user_img_for_gemini = Image.open(io.BytesIO(user_image_bytes))
-            product_img_for_gemini = Image.open(io.BytesIO(product_image_bytes))
-            
-            response = self.model.generate_content([tryon_prompt, user_img_for_gemini, product_img_for_gemini])
+            # Send the encoded images as-is; PIL images would be decoded and re-encoded by the SDK
+            user_img_for_gemini = {"mime_type": self.encoding.mime_type, "data": user_image_bytes}
+            product_img_for_gemini = {"mime_type": self.encoding.mime_type, "data": product_image_bytes}
             
-            # Extract the generated image from the response
-            # Parse response parts to find image data
-            for part in response.candidates[0].content.parts:
-                if part.inline_data is not None:
-                    # Gemini 2.5 Flash Image Preview returns Base64-encoded image data
-                    mime_type = part.inline_data.mime_type
-                    image_data = part.inline_data.data
-                    
-                    print(f"Received image data - MIME type: {mime_type}")
-                    print(f"Data type: {type(image_data)}, length: {len(image_data) if image_data else 0}")
-                    
-                    if not image_data:
-                        print("Skipping empty image data part")
-                        continue
-                    
-                    # The data is Base64-encoded, decode it to get raw byte stream
-                    if isinstance(image_data, str):
-                        print("Decoding Base64 image data to byte stream...")
-                        image_bytes = base64.b64decode(image_data)
-                    else:
-                        # Already in bytes format
-                        image_bytes = image_data
-                    
-                    print(f"Decoded byte stream: {len(image_bytes)} bytes")
-                    
-                    # Use Pillow to interpret the raw byte stream
-                    try:
-                        # Open the byte stream as an image using Pillow
-                        with Image.open(io.BytesIO(image_bytes)) as img:
-                            print(f"Image opened successfully: {img.size}, mode: {img.mode}, format: {img.format}")
-                            
-                            # Save the image to a byte buffer in PNG format
-                            # Using .png extension automatically saves in PNG format
-                            output_buffer = io.BytesIO()
-                            
-                            # Convert to RGB if needed (for PNG compatibility)
-                            if img.mode not in ['RGB', 'RGBA']:
-                                img = img.convert('RGB')
-                            
-                            # Save as PNG (most compatible format)
-                            img.save(output_buffer, format='PNG')
-                            
-                            print(f"Image saved to buffer as PNG: {output_buffer.tell()} bytes")
-                            return output_buffer.getvalue()
-                            
-                    except Exception as img_error:
-                        print(f"Error processing image with Pillow: {img_error}")
-                        # Return raw bytes if Pillow processing fails
-                        return image_bytes
+            image_bytes = self.backend.generate(tryon_prompt, [user_img_for_gemini, product_img_for_gemini], deadline=deadline)
+            if image_bytes:
+                print(f"Decoded byte stream: {len(image_bytes)} bytes")
                 
-                elif part.text is not None:
-                    print(f"Text response part: {part.text}")
+                # Use Pillow to interpret the raw byte stream
+                try:
+                    # Open the byte stream as an image using Pillow; the output is the
+                    # largest decode of the pipeline, so it holds the budget too
+                    # Its size is only known here, so this reservation waits in the worker thread
+                    output_bytes = self._estimate_output_bytes(image_bytes)
+                    with decode_budget.reserve(output_bytes, deadline=deadline), Image.open(io.BytesIO(image_bytes)) as img:
+                        print(f"Image opened successfully: {img.size}, mode: {img.mode}, format: {img.format}")
+                        
+                        # Save the image to a byte buffer in PNG format
+                        # Using .png extension automatically saves in PNG format
+                        output_buffer = io.BytesIO()
+                        
+                        # Convert to RGB if needed (for PNG compatibility)
+                        if img.mode not in ['RGB', 'RGBA']:
+                            img = img.convert('RGB')
+                        
+                        # Save as PNG (most compatible format)
+                        img.save(output_buffer, format='PNG')
+                        
+                        print(f"Image saved to buffer as PNG: {output_buffer.tell()} bytes")
+                        return output_buffer.getvalue()
+                        
+                except RequestCancelled:
+                    raise
+                except Exception as img_error:
+                    print(f"Error processing image with Pillow: {img_error}")
+                    # Return raw bytes if Pillow processing fails
+                    return image_bytes
             
             # If no image was generated, create an informative error image
             print("No image was generated by Nano Banana, creating error placeholder")
-            error_image = self._create_error_image(f"Virtual try-on generation failed for {product_name}")
-            return error_image
+            message = f"Virtual try-on generation failed for {product_name}"
+            raise TryOnGenerationError(message, self._create_error_image(message))
             
+        except (RequestCancelled, TryOnGenerationError):
+            raise
         except Exception as e:
+            # An upstream timeout caused by our own deadline is a cancellation, not a failed try-on
+            if deadline:
+                deadline.check()
             print(f"Error in virtual try-on generation: {str(e)}")
             print(f"Error type: {type(e).__name__}")
             
@@ -190,37 +297,53 @@ The final result should look like the person actually purchased and is wearing t
                     print(f"Debug error: {debug_e}")
             
             # Create an error image with details
-            error_image = self._create_error_image(f"Try-on failed: {str(e)}")
-            return error_image
+            message = f"Try-on failed: {str(e)}"
+            raise TryOnGenerationError(message, self._create_error_image(message)) from e
 
-    def _load_and_convert_image(self, image_path: str) -> Image.Image:
+    @classmethod
+    def estimate_input_bytes(cls, image_paths, target_size: tuple) -> int:
+        """Decoded memory generate_tryon_image needs to preprocess its inputs"""
+        return sum(cls._estimate_input_bytes(path, target_size) for path in image_paths)
+
+    @staticmethod
+    def _estimate_input_bytes(image_path: str, target_size: tuple) -> int:
+        """Decoded memory needed to preprocess one input; unreadable files fall back to a placeholder"""
+        try:
+            return INPUT_WORKING_COPIES * estimate_decoded_bytes(image_path, target_size)
+        except Exception:
+            return 0
+
+    @staticmethod
+    def _estimate_output_bytes(image_bytes: bytes) -> int:
+        """Decoded memory needed to re-encode the model output; undecodable output reserves nothing"""
+        try:
+            return INPUT_WORKING_COPIES * estimate_decoded_bytes(io.BytesIO(image_bytes))
+        except Exception:
+            return 0
+
+    def _load_and_convert_image(self, image_path: str, target_size: tuple = None) -> Image.Image:
         """
         Load an image and convert it to a format supported by Gemini API
         Gemini supports: JPEG, PNG, WebP, but not AVIF
+        
+        When target_size is given, JPEGs are decoded at reduced scale close to it.
+        Raises ImageTooLargeError for images over the MAX_IMAGE_PIXELS cap.
         """
         try:
-            # Load the image
-            with Image.open(image_path) as img:
-                # Check if image is in AVIF or other unsupported format
-                original_format = img.format
-                print(f"Loading image: {image_path} (format: {original_format})")
-                
-                # Convert AVIF and other unsupported formats to RGB PNG
-                if original_format in ['AVIF', 'HEIC', 'HEIF'] or img.mode not in ['RGB', 'RGBA']:
-                    print(f"Converting {original_format} to PNG...")
-                    # Convert to RGB if not already
-                    if img.mode != 'RGB':
-                        img = img.convert('RGB')
-                    
-                    # Create a copy as PNG
-                    png_buffer = io.BytesIO()
-                    img.save(png_buffer, format='PNG')
-                    png_buffer.seek(0)
-                    return Image.open(png_buffer)
-                
-                # For supported formats, return a copy
-                return img.copy()
+            img = open_image(image_path, target_size=target_size)
+            original_format = img.format
+            print(f"Loading image: {image_path} (format: {original_format}, decoded size: {img.size})")
+            
+            # Convert AVIF and other unsupported formats to RGB; the image is
+            # re-encoded before upload, so no intermediate PNG round trip is needed
+            if original_format in ['AVIF', 'HEIC', 'HEIF'] or img.mode not in ['RGB', 'RGBA']:
+                print(f"Converting {original_format} ({img.mode}) to RGB...")
+                img = img.convert('RGB')
+            
+            return img
                 
+        except ImageTooLargeError:
+            raise
         except Exception as e:
             print(f"Error loading/converting image {image_path}: {e}")
             # Create a placeholder image if loading fails
@@ -229,8 +352,15 @@ The final result should look like the person actually purchased and is wearing t
             draw.text((200, 250), "Image Load Error", fill='red')
             return placeholder
 
-    def _optimize_image_for_tryon(self, image: Image.Image, target_size: tuple = (1024, 1024), is_person: bool = True) -> Image.Image:
-        """Optimize image for virtual try-on processing"""
+    def _optimize_image_for_tryon(self, image: Image.Image, target_size: tuple = (1024, 1024), is_person: bool = True,
+                                  source_path: str = None) -> Image.Image:
+        """
+        Optimize image for virtual try-on processing
+        
+        The image is cropped to its content (plus padding) and the crop is scaled by the
+        same factor the whole image would have been, so the model sees the subject at
+        unchanged detail while the empty margins are no longer sent upstream.
+        """
         # Calculate scaling to fit target size while maintaining aspect ratio
         width, height = image.size
         target_width, target_height = target_size
@@ -241,24 +371,61 @@ The final result should look like the person actually purchased and is wearing t
         scale = min(scale_w, scale_h)
         
         # Only resize if image is larger than target or significantly smaller
-        if scale < 1.0 or scale > 2.0:
-            new_width = int(width * scale)
-            new_height = int(height * scale)
-            
-            # Use high-quality resampling
-            image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            print(f"Image resized from {width}x{height} to {new_width}x{new_height}")
+        if not (scale < 1.0 or scale > 2.0):
+            scale = 1.0
+        uncropped_size = (int(width * scale), int(height * scale))
         
-        # Enhance image quality for better AI processing
         if is_person:
-            # For person images, ensure good contrast and sharpness
+            # Person photos keep generous margins so hair, hands and feet are never clipped
             print("Optimizing person image for try-on...")
+            padding = PERSON_CROP_PADDING
         else:
-            # For product images, enhance details and colors
+            # Product shots often sit in large empty studio backgrounds
             print("Optimizing product image for try-on...")
+            padding = PRODUCT_CROP_PADDING
+        
+        crop_box = content_crop_box(image, source_path, padding=padding) if auto_crop_enabled() else None
+        if crop_box:
+            image = image.crop(crop_box)
+            logger.debug(f"Image cropped to content {crop_box} of {width}x{height}")
+            width, height = image.size
+        
+        if scale != 1.0 or crop_box:
+            new_width = max(1, int(width * scale))
+            new_height = max(1, int(height * scale))
+            
+            if (new_width, new_height) != image.size:
+                # Use high-quality resampling; when shrinking a lot, reduce by an
+                # integer factor first and only LANCZOS the last stretch
+                reducing_gap = REDUCING_GAP if scale < 1.0 / REDUCING_GAP else None
+                image = image.resize((new_width, new_height), Image.Resampling.LANCZOS, reducing_gap=reducing_gap)
+                print(f"Image resized from {width}x{height} to {new_width}x{new_height}")
+        
+        # Remember what would have been sent without the crop, for savings reporting
+        image.info["uncropped_size"] = uncropped_size
         return image
 
-    def _pil_to_bytes(self, image: Image.Image, format: str = 'JPEG', quality: int = 90) -> bytes:
+    def _report_crop_savings(self, image: Image.Image, payload: bytes):
+        """Estimate and record the upstream bytes saved by cropping an encoded input"""
+        uncropped_width, uncropped_height = image.info.get("uncropped_size", image.size)
+        uncropped_pixels = uncropped_width * uncropped_height
+        sent_pixels = image.width * image.height
+        if sent_pixels >= uncropped_pixels:
+            return
+        
+        # JPEG size scales roughly with pixel count at a fixed quality
+        saved_bytes = int(len(payload) * (uncropped_pixels / sent_pixels - 1))
+        metrics.increment("crop_bytes_saved", saved_bytes)
+        metrics.increment("crop_pixels_saved", uncropped_pixels - sent_pixels)
+        logger.debug(f"Cropping saved ~{saved_bytes} bytes ({uncropped_pixels - sent_pixels} pixels) upstream")
+
+    def _encode_for_upstream(self, image: Image.Image) -> bytes:
+        encoding = self.encoding
+        return self._pil_to_bytes(image, format=encoding.format, quality=encoding.quality,
+                                  subsampling=encoding.subsampling, optimize=encoding.optimize)
+
+    def _pil_to_bytes(self, image: Image.Image, format: str = 'JPEG', quality: int = 90,
+                      subsampling: str = None, optimize: bool = True) -> bytes:
         """Convert PIL Image to bytes in specified format with quality control"""
         buffer = io.BytesIO()
         
@@ -276,15 +443,22 @@ The final result should look like the person actually purchased and is wearing t
         
         # Save to buffer with specified quality
         if format.upper() == 'JPEG':
-            image.save(buffer, format=format, quality=quality, optimize=True)
+            options = {"subsampling": subsampling} if subsampling else {}
+            image.save(buffer, format=format, quality=quality, optimize=optimize, **options)
+        elif format.upper() == 'WEBP':
+            # method 6 is WebP's slowest, smallest compression; 4 is Pillow's default
+            image.save(buffer, format=format, quality=quality, method=6 if optimize else 4)
+        elif format.upper() == 'PNG':
+            image.save(buffer, format=format, optimize=optimize)
         else:
             image.save(buffer, format=format)
         
         return buffer.getvalue()
 
-    def _create_error_image(self, message: str) -> bytes:
+    @staticmethod
+    def _create_error_image(message: str) -> bytes:
         """Create an error image when generation fails"""
-        error_img = Image.new('RGB', (512, 512), color='white')
+        error_img = Image.new('RGB', ERROR_IMAGE_SIZE, color='white')
         draw = ImageDraw.Draw(error_img)
         
         try:
@@ -309,7 +483,7 @@ The final result should look like the person actually purchased and is wearing t
         y_offset = 200
         for line in lines:
             bbox = draw.textbbox((0, 0), line, font=font)
-            x = (512 - (bbox[2] - bbox[0])) // 2
+            x = (ERROR_IMAGE_SIZE[0] - (bbox[2] - bbox[0])) // 2
             draw.text((x, y_offset), line, fill='red', font=font)
             y_offset += 30
         
@@ -319,14 +493,8 @@ The final result should look like the person actually purchased and is wearing t
         return img_byte_arr.getvalue()
     
     def test_connection(self) -> bool:
-        """Test if Gemini API is working"""
-        try:
-            # Test with a simple text generation request (compatible with all models)
-            response = self.model.generate_content("Say 'API test successful'")
-            return bool(response and response.text)
-        except Exception as e:
-            print(f"Gemini API test failed: {str(e)}")
-            return False
+        """Test if the upstream backend is working"""
+        return self.backend.test_connection()
 
     @staticmethod
     def get_optimization_tips() -> dict:
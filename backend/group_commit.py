@@ -0,0 +1,127 @@
+"""
+Single writer thread that batches small writes into group commits.
+
+With SQLite only one transaction can write at a time, and each commit costs a
+WAL append (plus an fsync at checkpoints). Handlers that each commit their own
+one-row transaction therefore queue on the write lock. High-frequency writes
+(try-on session creation and status updates) instead go through this writer:
+jobs are queued, and the writer thread runs everything that queued up while
+it was committing the previous batch (up to GROUP_COMMIT_MAX_BATCH jobs,
+optionally waiting GROUP_COMMIT_MAX_DELAY_MS for more) in one transaction
+with one commit.
+
+A job is a function taking the writer's Session; it must only touch the
+database and return plain values, since ORM objects don't leave the writer
+thread. If a batch fails, it is rolled back and its jobs are retried one
+transaction each, so a failing job only fails its own caller.
+"""
+
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import metrics
+from database import SessionLocal
+
+DEFAULT_MAX_BATCH = 64
+# Jobs queue up while the previous batch commits, which is enough batching;
+# waiting for more only adds latency at low concurrency
+DEFAULT_MAX_DELAY_MS = 0
+
+class GroupCommitWriter:
+    def __init__(self, session_factory=SessionLocal, max_batch: int = DEFAULT_MAX_BATCH, max_delay_ms: float = DEFAULT_MAX_DELAY_MS):
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self.jobs = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "GroupCommitWriter":
+        return cls(
+            max_batch=int(os.getenv("GROUP_COMMIT_MAX_BATCH", str(DEFAULT_MAX_BATCH))),
+            max_delay_ms=float(os.getenv("GROUP_COMMIT_MAX_DELAY_MS", str(DEFAULT_MAX_DELAY_MS))),
+        )
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="group-commit-writer", daemon=True)
+                self.thread.start()
+
+    def stop(self, timeout: float = 5):
+        """Finish the queued jobs and stop the thread"""
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread:
+            self.jobs.put(None)
+            thread.join(timeout)
+
+    def submit(self, job, *args, **kwargs) -> Future:
+        """Queue job(db, *args, **kwargs); the future resolves once its batch is committed"""
+        self.start()
+        future = Future()
+        self.jobs.put((job, args, kwargs, future))
+        return future
+
+    async def run(self, job, *args, **kwargs):
+        """submit() and wait without blocking the event loop"""
+        return await asyncio.wrap_future(self.submit(job, *args, **kwargs))
+
+    def _collect(self, first) -> list:
+        """first plus whatever else arrives within the batching window"""
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                item = self.jobs.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is None:
+                # Put the stop marker back for the main loop
+                self.jobs.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        db = self.session_factory()
+        try:
+            while True:
+                first = self.jobs.get()
+                if first is None:
+                    return
+                batch = self._collect(first)
+                start = time.monotonic()
+                self._commit_batch(db, batch)
+                metrics.observe("group_commit_batch_size", len(batch))
+                metrics.observe("group_commit_seconds", time.monotonic() - start)
+        finally:
+            db.close()
+
+    def _commit_batch(self, db, batch: list):
+        results = []
+        try:
+            for job, args, kwargs, _ in batch:
+                results.append(job(db, *args, **kwargs))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            db.expunge_all()
+            if len(batch) == 1:
+                batch[0][3].set_exception(e)
+                return
+            metrics.increment("group_commit_retried_batches")
+            for item in batch:
+                self._commit_batch(db, [item])
+            return
+        # Every job sees the database, not objects cached from earlier batches
+        db.expunge_all()
+        for (_, _, _, future), result in zip(batch, results):
+            future.set_result(result)
+
+db_writer = GroupCommitWriter.from_env()
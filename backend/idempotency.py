@@ -0,0 +1,235 @@
+"""
+Idempotency-Key support for endpoints that create records or start generations.
+
+A client sends the same `Idempotency-Key` header on every retry of one logical
+request. The first request claims the key in the idempotency_keys table and
+runs; its JSON response is stored with the key. Retries with the same key and
+the same request replay the stored response, or wait for the first request if
+it is still running, so the work is never done twice. Keys expire after
+IDEMPOTENCY_TTL_SECONDS.
+
+If the first request fails with an exception, or returns a response whose
+status is failed or cancelled, the key is released so a retry can run again. A running request holds its key on a lease of
+IDEMPOTENCY_LEASE_SECONDS that it keeps renewing; if its worker dies, the
+lease runs out and the next retry takes the key over and runs.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+
+import metrics
+from database import IdempotencyKey
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL_SECONDS = 86400
+# How long a retry waits for the original request before giving up with 409
+DEFAULT_WAIT_SECONDS = 120
+# Claims not renewed for this long are taken over by retries; renewed every third of it
+DEFAULT_LEASE_SECONDS = 30
+MAX_KEY_LENGTH = 255
+# Retries in another worker process only see completion through the database
+POLL_INTERVAL_SECONDS = 0.25
+# Expired keys are deleted at most this often per process
+PURGE_INTERVAL_SECONDS = 60
+
+REPLAY_HEADER = "Idempotent-Replayed"
+# Responses with these statuses are not stored: a retry should run again
+UNFINISHED_STATUSES = ("failed", "cancelled")
+
+# Wakes up retries in this process as soon as the original request finishes
+_in_flight = {}
+_last_purge = 0.0
+
+def get_ttl_seconds() -> int:
+    return int(os.getenv("IDEMPOTENCY_TTL_SECONDS", str(DEFAULT_TTL_SECONDS)))
+
+def get_wait_seconds() -> float:
+    return float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", str(DEFAULT_WAIT_SECONDS)))
+
+def get_lease_seconds() -> float:
+    return float(os.getenv("IDEMPOTENCY_LEASE_SECONDS", str(DEFAULT_LEASE_SECONDS)))
+
+def request_fingerprint(*parts) -> str:
+    """SHA-256 over the request's parameters (str or bytes)"""
+    digest = hashlib.sha256()
+    for part in parts:
+        data = part if isinstance(part, bytes) else str(part).encode()
+        # Length-prefixed so ("ab", "c") and ("a", "bc") differ
+        digest.update(len(data).to_bytes(8, "big"))
+        digest.update(data)
+    return digest.hexdigest()
+
+def purge_expired(db) -> int:
+    """Delete expired keys and return how many were removed"""
+    deleted = db.query(IdempotencyKey).filter(IdempotencyKey.expires_at <= datetime.utcnow()).delete(synchronize_session=False)
+    db.commit()
+    return deleted
+
+def _maybe_purge(db):
+    global _last_purge
+    now = time.monotonic()
+    if now - _last_purge >= PURGE_INTERVAL_SECONDS:
+        _last_purge = now
+        purge_expired(db)
+
+def _find(db, scope: str, key: str):
+    # Always read the committed row, not a copy cached in the session
+    db.expire_all()
+    return db.query(IdempotencyKey).filter(IdempotencyKey.scope == scope, IdempotencyKey.key == key).first()
+
+def _claim(db, scope: str, key: str, request_hash: str):
+    """Insert the key; returns the new row, or the existing one if another request holds it"""
+    now = datetime.utcnow()
+    record = IdempotencyKey(
+        scope=scope,
+        key=key,
+        request_hash=request_hash,
+        expires_at=now + timedelta(seconds=get_ttl_seconds()),
+        lease_expires_at=now + timedelta(seconds=get_lease_seconds()),
+    )
+    db.add(record)
+    try:
+        db.commit()
+        return record, None
+    except IntegrityError:
+        db.rollback()
+    return None, _find(db, scope, key)
+
+def _take_over(db, record):
+    """Claim an in_progress key whose lease ran out; False if another retry got there first"""
+    now = datetime.utcnow()
+    taken = db.query(IdempotencyKey).filter(
+        IdempotencyKey.id == record.id,
+        IdempotencyKey.status == "in_progress",
+        IdempotencyKey.lease_expires_at == record.lease_expires_at,
+    ).update({"lease_expires_at": now + timedelta(seconds=get_lease_seconds())}, synchronize_session=False)
+    db.commit()
+    return taken == 1
+
+def _renew_lease(session_factory, record_id: int):
+    # A separate session, so the handler's own transaction is left alone
+    db = session_factory()
+    try:
+        db.query(IdempotencyKey).filter(
+            IdempotencyKey.id == record_id, IdempotencyKey.status == "in_progress"
+        ).update({"lease_expires_at": datetime.utcnow() + timedelta(seconds=get_lease_seconds())},
+                 synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+async def _hold_lease(session_factory, record_id: int):
+    """Keep renewing the claim's lease until cancelled"""
+    while True:
+        await asyncio.sleep(get_lease_seconds() / 3)
+        try:
+            await run_in_threadpool(_renew_lease, session_factory, record_id)
+        except Exception as e:
+            logger.warning(f"Failed to renew idempotency lease {record_id}: {e}")
+
+def _release(db, record_id: int):
+    db.rollback()
+    db.query(IdempotencyKey).filter(IdempotencyKey.id == record_id).delete(synchronize_session=False)
+    db.commit()
+
+def _replay(record) -> JSONResponse:
+    metrics.increment("idempotent_replays")
+    return JSONResponse(
+        status_code=record.response_code,
+        content=json.loads(record.response_body),
+        headers={REPLAY_HEADER: "true"},
+    )
+
+async def run_idempotent(db, scope: str, key: str, request_hash: str, handler):
+    """
+    Run handler() at most once per (scope, key).
+
+    Without a key, handler() simply runs. Returns the handler's result, or a
+    JSONResponse replaying the result of an earlier request with the same key.
+    """
+    if not key:
+        return await handler()
+    if len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key must be at most {MAX_KEY_LENGTH} characters")
+
+    _maybe_purge(db)
+    deadline = time.monotonic() + get_wait_seconds()
+    attached = False
+    while True:
+        record, existing = _claim(db, scope, key, request_hash)
+        if record:
+            break
+
+        if existing is None:
+            # Released between our insert and lookup; try to claim it again
+            continue
+        if existing.expires_at <= datetime.utcnow():
+            db.delete(existing)
+            db.commit()
+            continue
+        if existing.request_hash != request_hash:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+        if existing.status == "completed":
+            return _replay(existing)
+        if existing.lease_expires_at is not None and existing.lease_expires_at <= datetime.utcnow():
+            # The request holding the key stopped renewing it: its worker is gone
+            if _take_over(db, existing):
+                metrics.increment("idempotent_takeovers")
+                record = _find(db, scope, key)
+                if record:
+                    break
+            continue
+
+        # The original request is still running: attach to it
+        if not attached:
+            attached = True
+            metrics.increment("idempotent_waits")
+        if time.monotonic() >= deadline:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+        event = _in_flight.get((scope, key))
+        try:
+            await asyncio.wait_for(asyncio.shield(event.wait()) if event else asyncio.sleep(POLL_INTERVAL_SECONDS),
+                                   timeout=POLL_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+    record_id = record.id
+    done = asyncio.Event()
+    _in_flight[(scope, key)] = done
+    lease = asyncio.create_task(_hold_lease(sessionmaker(bind=db.get_bind()), record_id))
+    try:
+        try:
+            result = await handler()
+        except BaseException:
+            # Nothing is stored for failures (including cancellation), so a retry runs again
+            _release(db, record_id)
+            raise
+
+        body = jsonable_encoder(result)
+        if isinstance(body, dict) and body.get("status") in UNFINISHED_STATUSES:
+            # A failed generation is reported in the response, not raised; don't replay it
+            _release(db, record_id)
+            return result
+
+        record.status = "completed"
+        record.response_code = 200
+        record.response_body = json.dumps(body)
+        db.commit()
+        return result
+    finally:
+        lease.cancel()
+        _in_flight.pop((scope, key), None)
+        done.set()
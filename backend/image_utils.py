@@ -0,0 +1,273 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from memory_budget import decode_budget
+
+# Default cap on decoded pixels (about 50 megapixels, twice a 24MP phone photo)
+DEFAULT_MAX_IMAGE_PIXELS = 50_000_000
+
+# Staged downscaling: reduce by an integer factor first, then LANCZOS the rest
+# of the way. 3.0 is indistinguishable from a full LANCZOS resize in practice.
+REDUCING_GAP = 3.0
+
+EXIF_ORIENTATION_TAG = 0x0112
+
+# Foreground detection runs on a thumbnail no larger than this
+DETECTION_SIZE = 256
+# L1 RGB distance from the estimated background color that counts as foreground
+COLOR_DISTANCE_THRESHOLD = 48
+# Gray-level gradient magnitude that counts as foreground texture
+EDGE_THRESHOLD = 24
+# A row/column belongs to the content box only if this fraction of it is foreground,
+# which keeps JPEG noise and dust specks from stretching the box
+MIN_LINE_FRACTION = 0.02
+# Crops that keep more than this fraction of the area aren't worth it
+MAX_CROP_AREA_FRACTION = 0.9
+# Detected boxes cached per (path, mtime, size)
+CROP_CACHE_SIZE = 1024
+# dHash grid: HASH_SIZE x HASH_SIZE gradient bits = 64-bit hash
+HASH_SIZE = 8
+# Color signature grid: COLOR_GRID x COLOR_GRID mean RGB cells
+COLOR_GRID = 4
+
+_avif_lock = threading.Lock()
+_avif_checked = False
+
+def enable_avif():
+    """Register the AVIF plugin on first use instead of at import time"""
+    global _avif_checked
+    if _avif_checked:
+        return
+    with _avif_lock:
+        if _avif_checked:
+            return
+        try:
+            import pillow_avif  # noqa: F401 - registers AVIF with PIL
+            print("AVIF support enabled")
+        except ImportError:
+            print("AVIF support not available - install pillow-avif-plugin")
+        _avif_checked = True
+
+class ImageTooLargeError(ValueError):
+    """Raised when an image header declares more pixels than MAX_IMAGE_PIXELS allows"""
+
+def get_max_image_pixels() -> int:
+    """Pixel cap from MAX_IMAGE_PIXELS (0 disables the check)"""
+    return int(os.getenv("MAX_IMAGE_PIXELS", str(DEFAULT_MAX_IMAGE_PIXELS)))
+
+def check_pixel_budget(img: Image.Image):
+    """Reject decompression bombs using the header size, before any pixel data is decoded"""
+    max_pixels = get_max_image_pixels()
+    width, height = img.size
+    if max_pixels and width * height > max_pixels:
+        raise ImageTooLargeError(
+            f"Image is {width}x{height} ({width * height} pixels), limit is {max_pixels} pixels"
+        )
+
+def fit_size(size: tuple, target_size: tuple) -> tuple:
+    """Size that fits within target_size while keeping the aspect ratio (never upscales)"""
+    width, height = size
+    scale = min(target_size[0] / width, target_size[1] / height, 1.0)
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+def _draft_scale(size: tuple, requested: tuple) -> int:
+    """The DCT scale (1, 2, 4 or 8) JPEG draft mode picks for a requested size"""
+    scale = min(size[0] // requested[0], size[1] // requested[1])
+    for factor in (8, 4, 2, 1):
+        if scale >= factor:
+            return factor
+    return 1
+
+def estimate_decoded_bytes(source, target_size: tuple = None) -> int:
+    """
+    Memory open_image(source, target_size) will use for pixels, from the header alone.
+
+    Pillow keeps multi-band images at 4 bytes per pixel. JPEGs account for
+    draft-mode reduction.
+    """
+    enable_avif()
+    position = source.tell() if hasattr(source, "tell") else None
+    try:
+        with Image.open(source) as img:
+            width, height = img.size
+            if target_size and img.format == 'JPEG':
+                scale = _draft_scale(img.size, fit_size(img.size, target_size))
+                width, height = -(-width // scale), -(-height // scale)
+            bytes_per_pixel = 4 if len(img.getbands()) > 1 else 1
+    finally:
+        if position is not None:
+            source.seek(position)
+    return width * height * bytes_per_pixel
+
+def open_image(source, target_size: tuple = None) -> Image.Image:
+    """
+    Open and decode an image, checking the pixel cap first.
+
+    When target_size is given and the source is a JPEG, the decoder is asked for
+    a DCT-scaled version (1/2, 1/4 or 1/8) that is still at least as large as the
+    final fitted size, so most of the full-resolution decode work is skipped.
+    The result is EXIF-transposed, so the pixels are in display orientation.
+    """
+    enable_avif()
+    img = Image.open(source)
+    check_pixel_budget(img)
+
+    if target_size and img.format == 'JPEG':
+        requested = fit_size(img.size, target_size)
+        if requested != img.size:
+            img.draft('RGB', requested)
+
+    img.load()
+    # exif_transpose() always copies, so only call it when there is something to undo
+    if img.getexif().get(EXIF_ORIENTATION_TAG, 1) != 1:
+        img = ImageOps.exif_transpose(img)
+    return img
+
+def downscale(img: Image.Image, target_size: tuple) -> Image.Image:
+    """Downscale img to fit target_size using staged (reducing_gap) LANCZOS resampling"""
+    new_size = fit_size(img.size, target_size)
+    if new_size == img.size:
+        return img
+    return img.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
+
+def foreground_bbox(img: Image.Image):
+    """
+    Bounding box of the image content as fractions (left, top, right, bottom), or None.
+
+    Foreground is any pixel that is far from the background color (estimated as the
+    median of the border pixels) or sits on a strong edge. Images with transparency
+    use their alpha channel instead.
+    """
+    scale = min(1.0, DETECTION_SIZE / max(img.size))
+    small_size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        alpha = np.asarray(img.getchannel('A').resize(small_size, Image.Resampling.BOX))
+        mask = alpha > 16
+    else:
+        pixels = np.asarray(img.convert('RGB').resize(small_size, Image.Resampling.BOX), dtype=np.int16)
+        border = np.concatenate([pixels[0], pixels[-1], pixels[:, 0], pixels[:, -1]])
+        background = np.median(border, axis=0)
+        color_distance = np.abs(pixels - background).sum(axis=2)
+
+        gray = pixels.mean(axis=2)
+        edges = np.zeros_like(gray)
+        edges[:, 1:] += np.abs(np.diff(gray, axis=1))
+        edges[1:, :] += np.abs(np.diff(gray, axis=0))
+
+        mask = (color_distance > COLOR_DISTANCE_THRESHOLD) | (edges > EDGE_THRESHOLD)
+
+    rows = np.flatnonzero(mask.mean(axis=1) > MIN_LINE_FRACTION)
+    cols = np.flatnonzero(mask.mean(axis=0) > MIN_LINE_FRACTION)
+    if rows.size == 0 or cols.size == 0:
+        return None
+
+    height, width = mask.shape
+    return (float(cols[0] / width), float(rows[0] / height), float((cols[-1] + 1) / width), float((rows[-1] + 1) / height))
+
+def pad_bbox(bbox: tuple, padding: float) -> tuple:
+    """Grow a fractional bbox by padding (a fraction of its own size) on every side"""
+    left, top, right, bottom = bbox
+    pad_x = (right - left) * padding
+    pad_y = (bottom - top) * padding
+    return (max(0.0, left - pad_x), max(0.0, top - pad_y), min(1.0, right + pad_x), min(1.0, bottom + pad_y))
+
+class CropCache:
+    """Thread-safe LRU of detected content boxes, keyed by file identity"""
+
+    def __init__(self, max_entries: int = CROP_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key_for(path: str):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+    def get_or_detect(self, path: str, img: Image.Image):
+        """Fractional content box for the image at path, detecting it on a cache miss"""
+        key = self.key_for(path) if path else None
+        if key is not None:
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    return self.entries[key]
+
+        bbox = foreground_bbox(img)
+
+        if key is not None:
+            with self.lock:
+                self.entries[key] = bbox
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return bbox
+
+crop_cache = CropCache()
+
+def content_crop_box(img: Image.Image, path: str = None, padding: float = 0.05):
+    """
+    Pixel crop box (left, top, right, bottom) around the image content plus padding,
+    or None when cropping would not remove a meaningful share of the image.
+    Boxes are fractional internally, so a cached box works at any decode scale.
+    """
+    bbox = crop_cache.get_or_detect(path, img)
+    if bbox is None:
+        return None
+
+    left, top, right, bottom = pad_bbox(bbox, padding)
+    if (right - left) * (bottom - top) > MAX_CROP_AREA_FRACTION:
+        return None
+
+    width, height = img.size
+    return (int(left * width), int(top * height), max(int(left * width) + 1, round(right * width)),
+            max(int(top * height) + 1, round(bottom * height)))
+
+def perceptual_hash(source) -> int:
+    """
+    64-bit difference hash (dHash) of an image path, file object or bytes-like stream.
+
+    Each bit says whether a pixel of a 9x8 grayscale thumbnail is brighter than its
+    right neighbour, so re-saves, re-compression and resizing barely change it.
+    """
+    target_size = (HASH_SIZE * 8, HASH_SIZE * 8)
+    with decode_budget.reserve(estimate_decoded_bytes(source, target_size)):
+        img = open_image(source, target_size=target_size)
+        gray = np.asarray(
+            img.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BOX, reducing_gap=REDUCING_GAP),
+            dtype=np.int16,
+        )
+        del img
+    bits = (gray[:, 1:] > gray[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>u8')[0])
+
+def color_signature(source) -> np.ndarray:
+    """
+    Mean color of each cell of a COLOR_GRID x COLOR_GRID grid, as float32 RGB.
+
+    dHash only sees grayscale gradients, so the same garment in another color hashes
+    the same; this tells them apart.
+    """
+    target_size = (HASH_SIZE * 8, HASH_SIZE * 8)
+    with decode_budget.reserve(estimate_decoded_bytes(source, target_size)):
+        img = open_image(source, target_size=target_size)
+        cells = np.asarray(
+            img.convert('RGB').resize((COLOR_GRID, COLOR_GRID), Image.Resampling.BOX, reducing_gap=REDUCING_GAP),
+            dtype=np.float32,
+        )
+        del img
+    return cells
+
+def color_distance(a: np.ndarray, b: np.ndarray) -> float:
+    """Mean absolute difference of two color signatures, 0-255"""
+    return float(np.abs(a - b).mean())
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
@@ -0,0 +1,228 @@
+"""
+Pre-flight quality checks for try-on inputs.
+
+Every user photo and product image is scored once, at upload, from a small
+thumbnail (a JPEG draft decode, so a few milliseconds):
+- width, height: the stored image's resolution
+- sharpness: variance of the Laplacian inside the foreground box (low = blurry)
+- brightness: mean gray level of the whole frame
+- dark_fraction, bright_fraction: share of crushed shadows / blown highlights
+  inside the foreground box, so a white or black studio backdrop isn't
+  mistaken for bad exposure
+- coverage: share of the frame taken by the foreground box (0 = nothing found)
+
+The scores are stored as JSON on the user_photos / products row. Before a
+generation, /tryon and /outfits evaluate them against InputQualityGate's
+thresholds, so unusable inputs are turned away with actionable reasons
+instead of costing an upstream call. Rows from before scoring existed are
+scored the first time they are used.
+
+INPUT_QUALITY_GATE selects the mode: enforce (reject failing inputs), warn
+(only attach warnings) or off.
+"""
+
+import json
+import logging
+import os
+
+import numpy as np
+from PIL import Image
+
+from image_utils import estimate_decoded_bytes, fit_size, foreground_bbox, open_image
+from memory_budget import decode_budget
+
+logger = logging.getLogger(__name__)
+
+# Scores are computed on a thumbnail no larger than this, so sharpness values
+# are comparable across resolutions
+ANALYSIS_SIZE = (512, 512)
+# Bump when the scoring changes, so stored scores are recomputed
+SCORES_VERSION = 2
+
+# Gray levels counted as crushed shadows / blown highlights
+DARK_LEVEL = 16
+BRIGHT_LEVEL = 240
+
+DEFAULT_MIN_SIDE = 256
+DEFAULT_MIN_SHARPNESS = 15.0
+# Inputs below this multiple of a rejection threshold pass with a warning
+WARN_MARGIN = 2.0
+# Person photos darker than this mean gray level are rejected; below twice it, warned
+MIN_BRIGHTNESS = 25.0
+# Share of clipped pixels inside the foreground box that warns about exposure
+MAX_CLIPPED_FRACTION = 0.5
+# Foreground coverage below which a product image is rejected / warned
+MIN_PRODUCT_COVERAGE = 0.02
+WARN_PRODUCT_COVERAGE = 0.1
+# Person photos where the foreground is smaller than this are warned
+WARN_PERSON_COVERAGE = 0.15
+
+GATE_MODES = ("enforce", "warn", "off")
+
+def analyze(source) -> dict:
+    """Quality scores of an image path, file object or bytes-like stream"""
+    position = source.tell() if hasattr(source, "tell") else None
+    try:
+        with Image.open(source) as header:
+            width, height = header.size
+    finally:
+        if position is not None:
+            source.seek(position)
+
+    with decode_budget.reserve(estimate_decoded_bytes(source, ANALYSIS_SIZE)):
+        img = open_image(source, target_size=ANALYSIS_SIZE)
+        small = img.resize(fit_size(img.size, ANALYSIS_SIZE), Image.Resampling.BOX)
+        del img
+
+    bbox = foreground_bbox(small)
+    gray = np.asarray(small.convert('L'))
+    rows, cols = gray.shape
+
+    # Blur and clipping are measured where the subject is, so a plain studio
+    # background neither makes a sharp product look blurry nor a lit one overexposed
+    subject = gray
+    if bbox:
+        left, top, right, bottom = (int(bbox[0] * cols), int(bbox[1] * rows),
+                                    round(bbox[2] * cols), round(bbox[3] * rows))
+        if right - left >= 3 and bottom - top >= 3:
+            subject = gray[top:bottom, left:right]
+    region = subject.astype(np.float32)
+    laplacian = (4 * region[1:-1, 1:-1] - region[:-2, 1:-1] - region[2:, 1:-1]
+                 - region[1:-1, :-2] - region[1:-1, 2:])
+
+    histogram = np.bincount(subject.ravel(), minlength=256)
+    total = subject.size
+
+    return {
+        "version": SCORES_VERSION,
+        "width": width,
+        "height": height,
+        "sharpness": round(float(laplacian.var()), 2) if laplacian.size else 0.0,
+        "brightness": round(float(gray.mean()), 2),
+        "dark_fraction": round(float(histogram[:DARK_LEVEL].sum() / total), 4),
+        "bright_fraction": round(float(histogram[BRIGHT_LEVEL:].sum() / total), 4),
+        "coverage": round((bbox[2] - bbox[0]) * (bbox[3] - bbox[1]), 4) if bbox else 0.0,
+    }
+
+def analysis_bytes(source) -> int:
+    """Decoded memory analyze(source) reserves; 0 if the image can't be read"""
+    try:
+        return estimate_decoded_bytes(source, ANALYSIS_SIZE)
+    except Exception:
+        return 0
+
+def try_analyze(source):
+    """analyze(), or None if the image can't be decoded"""
+    try:
+        return analyze(source)
+    except Exception as e:
+        logger.warning(f"Could not score image quality: {e}")
+        return None
+
+def dump_scores(scores) -> str:
+    return json.dumps(scores) if scores is not None else None
+
+def load_scores(value):
+    """Stored scores, or None if missing or from an older scoring version"""
+    if not value:
+        return None
+    try:
+        scores = json.loads(value)
+    except ValueError:
+        return None
+    return scores if scores.get("version") == SCORES_VERSION else None
+
+def stored_scores(db, model, filepath: str):
+    """Current scores stored for an image file on any UserPhoto/Product row, or None"""
+    for (value,) in db.query(model.quality_scores).filter(model.filepath == filepath, model.quality_scores.isnot(None)).limit(5):
+        scores = load_scores(value)
+        if scores is not None:
+            return scores
+    return None
+
+def save_scores(db, model, filepath: str, scores: dict):
+    """Store scores on every row using the file (near-duplicates share files)"""
+    db.query(model).filter(model.filepath == filepath).update(
+        {model.quality_scores: dump_scores(scores)}, synchronize_session=False
+    )
+    db.commit()
+
+class InputQualityGate:
+    def __init__(self, mode: str = "enforce", min_side: int = DEFAULT_MIN_SIDE,
+                 min_sharpness: float = DEFAULT_MIN_SHARPNESS):
+        if mode not in GATE_MODES:
+            raise ValueError(f"INPUT_QUALITY_GATE must be one of {', '.join(GATE_MODES)}")
+        self.mode = mode
+        self.min_side = min_side
+        self.min_sharpness = min_sharpness
+
+    @classmethod
+    def from_env(cls) -> "InputQualityGate":
+        return cls(
+            mode=os.getenv("INPUT_QUALITY_GATE", "enforce").lower(),
+            min_side=int(os.getenv("INPUT_MIN_SIDE", str(DEFAULT_MIN_SIDE))),
+            min_sharpness=float(os.getenv("INPUT_MIN_SHARPNESS", str(DEFAULT_MIN_SHARPNESS))),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    def evaluate(self, scores, kind: str) -> list:
+        """(severity, message) pairs for a "person" or "product" image; severity is reject or warn"""
+        if scores is None:
+            return [("reject", "could not be decoded; please upload it again as a JPEG or PNG")]
+
+        issues = []
+        side = min(scores["width"], scores["height"])
+        if side < self.min_side:
+            issues.append(("reject", f"is too small ({scores['width']}x{scores['height']}); "
+                                     f"upload one at least {round(self.min_side * WARN_MARGIN)}px on the short side"))
+        elif side < self.min_side * WARN_MARGIN:
+            issues.append(("warn", f"is low resolution ({scores['width']}x{scores['height']}); "
+                                   f"results are better from {round(self.min_side * WARN_MARGIN)}px or more"))
+
+        # An image with no foreground is reported as empty below, not as blurry
+        if scores["coverage"] and scores["sharpness"] < self.min_sharpness:
+            issues.append(("reject", "is too blurry; retake it in focus and hold the camera steady"))
+        elif scores["coverage"] and scores["sharpness"] < self.min_sharpness * WARN_MARGIN:
+            issues.append(("warn", "looks slightly blurry; a sharper photo gives better results"))
+
+        if kind == "person":
+            # Products are often shot on white or black, so exposure is only judged for people
+            if scores["brightness"] < MIN_BRIGHTNESS:
+                issues.append(("reject", "is too dark; retake it in better light"))
+            elif not scores["coverage"]:
+                issues.append(("reject", "appears to be blank; upload a full-length photo of yourself"))
+            elif scores["brightness"] < MIN_BRIGHTNESS * WARN_MARGIN or scores["dark_fraction"] > MAX_CLIPPED_FRACTION:
+                issues.append(("warn", "is underexposed; more light gives better results"))
+            elif scores["bright_fraction"] > MAX_CLIPPED_FRACTION:
+                issues.append(("warn", "is overexposed; avoid direct sunlight or flash"))
+            if scores["coverage"] and scores["coverage"] < WARN_PERSON_COVERAGE:
+                issues.append(("warn", "shows the person very small; step closer so the body fills the frame"))
+        else:
+            if scores["coverage"] < MIN_PRODUCT_COVERAGE:
+                issues.append(("reject", "shows no detectable garment; use a photo of the item on a plain background"))
+            elif scores["coverage"] < WARN_PRODUCT_COVERAGE:
+                issues.append(("warn", "is mostly background; crop it closer to the garment"))
+        return issues
+
+    def check(self, inputs: list) -> tuple:
+        """
+        Evaluate (label, kind, scores) inputs; returns (rejections, warnings) as
+        messages. In warn mode every issue is a warning.
+        """
+        rejections, warnings = [], []
+        for label, kind, scores in inputs:
+            for severity, message in self.evaluate(scores, kind):
+                if severity == "reject" and self.mode == "enforce":
+                    rejections.append(f"{label} {message}")
+                else:
+                    warnings.append(f"{label} {message}")
+        return rejections, warnings
+
+    def describe(self, scores, kind: str) -> list:
+        """Issue messages for one image, as shown at upload time"""
+        return [f"Image {message}" for _, message in self.evaluate(scores, kind)]
+
+input_gate = InputQualityGate.from_env()
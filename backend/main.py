@@ -1,21 +1,153 @@
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form
+from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form, BackgroundTasks, Query, Request, Header
+from fastapi.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, Response
+from contextlib import asynccontextmanager
+from sqlalchemy import tuple_
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
+import asyncio
+import hmac
+import logging
 import os
+import time
 from pathlib import Path
+from io import BytesIO
 
-from database import get_db, create_tables, User, Product, TryOnSession
-from models import UserCreate, UserResponse, ProductResponse, TryOnRequest, TryOnResponse, TryOnSessionResponse
-from storage import save_user_photo, save_product_photo, save_result_image, validate_image_file
-from gemini_client import GeminiClient
+from database import get_db, create_tables, SessionLocal, User, UserPhoto, Product, TryOnSession, ReprocessJob
+from models import UserCreate, UserResponse, ProductResponse, SimilarProductResponse, UserPhotoResponse, TryOnRequest, TryOnResponse, TryOnSessionResponse, TryOnHistoryPage, OutfitRequest, OutfitResponse, OutfitStepResponse, ReprocessRequest, ReprocessJobResponse
+from storage import save_user_photo, save_product_photo, save_result_image, save_outfit_image, validate_image_file
+from image_utils import estimate_decoded_bytes
+from gemini_client import GeminiClient, TryOnGenerationError
+from upstream import HedgedBackend
+import metrics
+from retention import RetentionPolicy, StorageCollector
+from quality import LatencyGovernor, QUALITY_TIERS, result_filename
+from phash_index import perceptual_index, compute_hash, hash_to_hex
+from feature_index import feature_index, compute_product_features
+from idempotency import run_idempotent, request_fingerprint
+from scheduler import FairScheduler, TIER_COSTS
+from deadline import Deadline, DeadlineExceeded, RequestCancelled, DEADLINE_HEADER, run_cancellable
+from memory_budget import decode_budget, track_usage, Reservation
+from group_commit import db_writer
+import outfits
+import input_quality
+import reprocess
+from catalog import catalog_cache, etag_matches
+from pagination import encode_cursor, decode_cursor, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+import stats
 
-# Create FastAPI app
-app = FastAPI(title="TryOn.ai API", version="1.0.0")
+# Per-request diagnostics go to module loggers; LOG_LEVEL=DEBUG shows them all
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "WARNING").upper(),
+    format="%(levelname)s %(name)s: %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+# Requests that arrive before startup finishes wait this long for it
+DEFAULT_STARTUP_WAIT_SECONDS = 30
+# Served while the app is still initializing
+READINESS_EXEMPT_PATHS = {"/", "/health", "/ready", "/metrics"}
+
+# Set by the lifespan once startup finishes
+gemini_client = None
+
+# Degrades full-quality try-ons to preview under load
+quality_governor = LatencyGovernor.from_env()
+
+# Shares upstream model capacity between priority classes and users
+tryon_scheduler = FairScheduler.from_env()
+
+# Background storage garbage collection
+storage_collector_task = None
+
+# Reprocessing jobs run by this worker, by job id
+reprocess_tasks = {}
+
+def init_gemini_client():
+    """Build the Gemini client; the API stays up without it, as before"""
+    global gemini_client
+    try:
+        gemini_client = GeminiClient()
+        print("Gemini client initialized successfully")
+    except Exception as e:
+        print(f"Failed to initialize Gemini client: {e}")
+        gemini_client = None
+
+def start_storage_collector():
+    global storage_collector_task
+    policy = RetentionPolicy.from_env()
+    if policy.enabled:
+        storage_collector_task = asyncio.create_task(StorageCollector(policy).run_forever())
+    else:
+        print("Storage retention disabled (no RETENTION_* policy configured)")
+
+async def load_perceptual_index():
+    db = SessionLocal()
+    try:
+        await run_in_threadpool(perceptual_index.load_products, db)
+    finally:
+        db.close()
+
+def build_stats():
+    db = SessionLocal()
+    try:
+        stats.ensure_built(db)
+    finally:
+        db.close()
+
+async def load_feature_index():
+    db = SessionLocal()
+    try:
+        await run_in_threadpool(feature_index.load, db)
+    finally:
+        db.close()
+
+async def initialize(app: FastAPI):
+    """Startup work, run after the server is already accepting connections"""
+    start = time.monotonic()
+    try:
+        # The indexes read the schema, so tables come first; everything else is independent
+        await run_in_threadpool(create_tables)
+        db_writer.start()
+        await asyncio.gather(
+            run_in_threadpool(init_gemini_client),
+            load_perceptual_index(),
+            load_feature_index(),
+            run_in_threadpool(build_stats),
+            run_in_threadpool(catalog_cache.refresh),
+        )
+        start_storage_collector()
+    except Exception as e:
+        app.state.startup_error = str(e)
+        print(f"Startup failed: {e}")
+        return
+    finally:
+        app.state.startup_done.set()
+    
+    app.state.startup_seconds = time.monotonic() - start
+    metrics.observe("startup_seconds", app.state.startup_seconds)
+    print(f"Startup finished in {app.state.startup_seconds:.2f}s")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.startup_done = asyncio.Event()
+    app.state.startup_error = None
+    app.state.startup_seconds = None
+    startup_task = asyncio.create_task(initialize(app))
+    yield
+    startup_task.cancel()
+    # Running reprocessing jobs checkpoint and pause, so they can be resumed
+    for task in list(reprocess_tasks.values()):
+        task.cancel()
+    await asyncio.gather(*reprocess_tasks.values(), return_exceptions=True)
+    # Commit whatever session writes are still queued
+    await run_in_threadpool(db_writer.stop)
+    if storage_collector_task:
+        storage_collector_task.cancel()
 
-# Create database tables
-create_tables()
+# Create FastAPI app
+app = FastAPI(title="TryOn.ai API", version="1.0.0", lifespan=lifespan)
 
 # Mount static files for serving images
 storage_path = Path("./storage")
@@ -26,13 +158,71 @@ else:
     storage_path.mkdir(exist_ok=True)
     app.mount("/static", StaticFiles(directory="storage"), name="static")
 
-# Initialize Gemini client
-try:
-    gemini_client = GeminiClient()
-    print("Gemini client initialized successfully")
-except Exception as e:
-    print(f"Failed to initialize Gemini client: {e}")
-    gemini_client = None
+def startup_wait_seconds() -> float:
+    return float(os.getenv("STARTUP_WAIT_SECONDS", str(DEFAULT_STARTUP_WAIT_SECONDS)))
+
+class ReadinessGate:
+    """
+    Hold requests that need the database or indexes until startup has finished.
+    
+    A plain ASGI middleware rather than @app.middleware("http"), which wraps
+    receive() and hides client disconnects from the endpoints.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if scope["type"] != "http" or path in READINESS_EXEMPT_PATHS or path.startswith("/static/"):
+            await self.app(scope, receive, send)
+            return
+        
+        response = await self.wait_for_startup(scope["app"].state)
+        if response:
+            await response(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+    
+    @staticmethod
+    async def wait_for_startup(state):
+        """None once the app is ready, otherwise the 503 response to send"""
+        startup_done = getattr(state, "startup_done", None)
+        if startup_done is None:
+            return JSONResponse(status_code=503, content={"detail": "Service is not started"})
+        if not startup_done.is_set():
+            try:
+                await asyncio.wait_for(startup_done.wait(), timeout=startup_wait_seconds())
+            except asyncio.TimeoutError:
+                return JSONResponse(status_code=503, content={"detail": "Service is starting"}, headers={"Retry-After": "1"})
+        if state.startup_error:
+            return JSONResponse(status_code=503, content={"detail": "Service failed to start"})
+        return None
+
+class RequestMemoryTracker:
+    """
+    Record the peak decoded-image memory each request reserved, including work
+    it handed to worker threads (see memory_budget.track_usage).
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        with track_usage() as usage:
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                if usage.peak > 0:
+                    metrics.observe("request_decoded_peak_bytes", usage.peak)
+                    logger.debug(f"{scope['method']} {scope['path']} decoded peak: {usage.peak / (1024 * 1024):.1f} MiB")
+
+app.add_middleware(ReadinessGate)
+app.add_middleware(RequestMemoryTracker)
 
 @app.get("/")
 async def root():
@@ -41,11 +231,46 @@ async def root():
 @app.get("/health")
 async def health_check():
     gemini_status = gemini_client.test_connection() if gemini_client else False
+    backend = getattr(gemini_client, "backend", None)
     return {
         "status": "healthy",
-        "gemini_api": "connected" if gemini_status else "disconnected"
+        "gemini_api": "connected" if gemini_status else "disconnected",
+        "quality_governor": quality_governor.snapshot(),
+        "scheduler": tryon_scheduler.snapshot(),
+        "decode_budget": decode_budget.snapshot(),
+        "hedging": backend.snapshot() if isinstance(backend, HedgedBackend) else None
     }
 
+def require_admin(authorization: Optional[str] = Header(None)):
+    """Dependency for admin endpoints: `Authorization: Bearer <ADMIN_TOKEN>`"""
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), admin_token.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token", headers={"WWW-Authenticate": "Bearer"})
+
+@app.get("/admin/stats", dependencies=[Depends(require_admin)])
+async def admin_stats(hours: int = Query(24, ge=1, le=24 * 31), db: Session = Depends(get_db)):
+    """Row counts and hourly session outcomes from the materialized counters"""
+    return stats.snapshot(db, hours)
+
+@app.get("/ready")
+async def readiness_check(request: Request):
+    """200 once startup has finished, 503 while starting or after a failed startup"""
+    state = request.app.state
+    if getattr(state, "startup_error", None):
+        return JSONResponse(status_code=503, content={"status": "failed", "error": state.startup_error})
+    startup_done = getattr(state, "startup_done", None)
+    if startup_done is None or not startup_done.is_set():
+        return JSONResponse(status_code=503, content={"status": "starting"})
+    return {"status": "ready", "startup_seconds": state.startup_seconds}
+
+@app.get("/metrics")
+async def get_metrics():
+    """In-process counters and latency summaries for this worker"""
+    return metrics.snapshot()
+
 # User endpoints
 @app.post("/users", response_model=UserResponse)
 async def create_user(user_data: UserCreate, db: Session = Depends(get_db)):
@@ -69,6 +294,7 @@ async def get_user(user_id: int, db: Session = Depends(get_db)):
 async def upload_product_photo(
     name: str = Form(...),
     file: UploadFile = File(...),
+    idempotency_key: Optional[str] = Header(None),
     db: Session = Depends(get_db)
 ):
     """Upload product photo and create product record"""
@@ -83,61 +309,136 @@ async def upload_product_photo(
     if not validate_image_file(file_content):
         raise HTTPException(status_code=400, detail="Invalid image file")
     
-    # Save product photo
-    product_id, filepath = save_product_photo(file_content, file.filename)
+    # A retried upload with the same key returns the product created the first time
+    fingerprint = request_fingerprint(name, file_content)
+    return await run_idempotent(
+        db, "upload-product-photo", idempotency_key, fingerprint,
+        lambda: reserved_for_upload(file_content, create_product(name, file.filename, file_content, db))
+    )
+
+async def reserved_for_upload(file_content: bytes, work):
+    """
+    Await work holding one decode-memory reservation for the whole upload. Its
+    decodes run in worker threads covered by the reservation, so an upload
+    waiting for memory waits here rather than in a thread. Sized for a full-size
+    decode plus a converted copy, the most any step holds at once.
+    """
+    async with decode_budget.reserve_async(2 * estimate_decoded_bytes(BytesIO(file_content))):
+        return await work
+
+async def create_product(name: str, filename: str, file_content: bytes, db: Session) -> dict:
+    """Store a validated product image and create its product record"""
+    # Near-duplicates of an existing product are linked to it; the upload is still stored as is
+    phash = await run_in_threadpool(compute_hash, BytesIO(file_content))
+    canonical = None
+    if phash is not None:
+        canonical = await run_in_threadpool(perceptual_index.canonical_product, db, phash, BytesIO(file_content))
+    
+    # Save product photo; conversion decodes the image, so keep it off the event loop
+    product_id, filepath = await run_in_threadpool(save_product_photo, file_content, filename)
+    
+    # Scored once here, so /tryon can gate on the stored scores
+    scores = input_quality.load_scores(canonical.quality_scores) if canonical else None
+    if scores is None:
+        scores = await run_in_threadpool(input_quality.try_analyze, Path("./storage") / filepath)
     
     # Create product record
-    db_product = Product(id=product_id, name=name, filepath=filepath)
+    db_product = Product(
+        id=product_id,
+        name=name,
+        filepath=filepath,
+        phash=hash_to_hex(phash) if phash is not None else None,
+        canonical_id=canonical.id if canonical else None,
+        quality_scores=input_quality.dump_scores(scores)
+    )
     db.add(db_product)
     db.commit()
     db.refresh(db_product)
     
+    if phash is not None and not canonical:
+        perceptual_index.add_product(phash, db_product.id)
+    
+    if not canonical:
+        # Features are computed once here so similarity queries never decode images
+        try:
+            features = await run_in_threadpool(compute_product_features, str(Path("./storage") / filepath))
+            await run_in_threadpool(feature_index.add, db_product.id, features)
+        except Exception as e:
+            logger.warning(f"Could not index features for product {db_product.id}: {e}")
+    
     # Return product with image_url
     return {
         "id": db_product.id,
         "name": db_product.name,
         "filepath": db_product.filepath,
         "image_url": f"/static/{db_product.filepath}",
-        "created_at": db_product.created_at
+        "created_at": db_product.created_at,
+        "duplicate_of": db_product.canonical_id,
+        "quality_issues": input_quality.input_gate.describe(scores, "product")
     }
 
+async def catalog_snapshot():
+    """Current catalog snapshot; a database round trip only when its version is due for a check"""
+    return catalog_cache.fresh() or await run_in_threadpool(catalog_cache.refresh)
+
+def catalog_response(entry: tuple, if_none_match: Optional[str]) -> Response:
+    """Pre-serialized (etag, body), or a 304 when the client's copy is current"""
+    etag, body = entry
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, etag):
+        metrics.increment("catalog_not_modified")
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 @app.get("/products", response_model=List[ProductResponse])
-async def get_products(db: Session = Depends(get_db)):
+async def get_products(if_none_match: Optional[str] = Header(None)):
     """Get all products"""
-    products = db.query(Product).all()
-    # Add image_url to each product
-    products_with_urls = []
-    for product in products:
-        product_dict = {
-            "id": product.id,
-            "name": product.name,
-            "filepath": product.filepath,
-            "image_url": f"/static/{product.filepath}",
-            "created_at": product.created_at
-        }
-        products_with_urls.append(product_dict)
-    return products_with_urls
+    snapshot = await catalog_snapshot()
+    return catalog_response(snapshot.listing, if_none_match)
 
 @app.get("/products/{product_id}", response_model=ProductResponse)
-async def get_product(product_id: int, db: Session = Depends(get_db)):
+async def get_product(product_id: int, if_none_match: Optional[str] = Header(None)):
     """Get product by ID"""
+    # A product another worker just added shows up once the version is next checked;
+    # unknown ids don't trigger a refresh, so they can't be used to bypass the snapshot
+    snapshot = await catalog_snapshot()
+    entry = snapshot.products.get(product_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Product not found")
+    return catalog_response(entry, if_none_match)
+
+@app.get("/products/{product_id}/similar", response_model=List[SimilarProductResponse])
+async def get_similar_products(product_id: int, k: int = Query(5, ge=1, le=50), db: Session = Depends(get_db)):
+    """Products that look most like this one, best match first"""
     product = db.query(Product).filter(Product.id == product_id).first()
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    return {
-        "id": product.id,
-        "name": product.name,
-        "filepath": product.filepath,
-        "image_url": f"/static/{product.filepath}",
-        "created_at": product.created_at
-    }
+    # Near-duplicates are indexed through their canonical product
+    matches = feature_index.similar(product.canonical_id or product.id, k)
+    if matches is None:
+        raise HTTPException(status_code=404, detail="Product has no feature vector yet")
+    
+    products = {p.id: p for p in db.query(Product).filter(Product.id.in_([pid for pid, _ in matches]))}
+    return [
+        {
+            "id": match.id,
+            "name": match.name,
+            "filepath": match.filepath,
+            "image_url": f"/static/{match.filepath}",
+            "created_at": match.created_at,
+            "score": score
+        }
+        for match, score in ((products.get(pid), score) for pid, score in matches)
+        if match is not None
+    ]
 
 # User photo upload
-@app.post("/upload-user-photo")
+@app.post("/upload-user-photo", response_model=UserPhotoResponse)
 async def upload_user_photo(
     user_id: int = Form(...),
     file: UploadFile = File(...),
+    idempotency_key: Optional[str] = Header(None),
     db: Session = Depends(get_db)
 ):
     """Upload user photo"""
@@ -157,19 +458,163 @@ async def upload_user_photo(
     if not validate_image_file(file_content):
         raise HTTPException(status_code=400, detail="Invalid image file")
     
-    # Save user photo
-    filepath = save_user_photo(user_id, file_content, file.filename)
+    fingerprint = request_fingerprint(user_id, file_content)
+    return await run_idempotent(
+        db, "upload-user-photo", idempotency_key, fingerprint,
+        lambda: reserved_for_upload(file_content, create_user_photo(user_id, file.filename, file_content, db))
+    )
+
+async def create_user_photo(user_id: int, filename: str, file_content: bytes, db: Session) -> UserPhotoResponse:
+    """Store a validated user photo and record it"""
+    # A near-duplicate of an earlier photo is linked to it; the upload is still stored as is
+    phash = await run_in_threadpool(compute_hash, BytesIO(file_content))
+    canonical = None
+    if phash is not None:
+        canonical = await run_in_threadpool(
+            perceptual_index.canonical_user_photo, db, user_id, phash, BytesIO(file_content)
+        )
+    
+    # Save user photo; conversion decodes the image, so keep it off the event loop
+    filepath = await run_in_threadpool(save_user_photo, user_id, file_content, filename)
+    
+    scores = input_quality.load_scores(canonical.quality_scores) if canonical else None
+    if scores is None:
+        scores = await run_in_threadpool(input_quality.try_analyze, Path("./storage") / filepath)
+    
+    db_photo = UserPhoto(
+        user_id=user_id,
+        filepath=filepath,
+        phash=hash_to_hex(phash) if phash is not None else None,
+        canonical_id=canonical.id if canonical else None,
+        quality_scores=input_quality.dump_scores(scores)
+    )
+    db.add(db_photo)
+    db.commit()
+    db.refresh(db_photo)
+    
+    if phash is not None and not canonical:
+        perceptual_index.add_user_photo(db, user_id, phash, db_photo.id)
+    
+    return UserPhotoResponse(
+        user_id=user_id,
+        photo_id=db_photo.id,
+        filepath=filepath,
+        duplicate_of=db_photo.canonical_id,
+        quality_issues=input_quality.input_gate.describe(scores, "person")
+    )
+
+def find_latest_user_photo(db: Session, user_id: int):
+    """Relative path of the user's most recent photo, or None"""
+    photo = db.query(UserPhoto).filter(UserPhoto.user_id == user_id).order_by(
+        UserPhoto.created_at.desc(), UserPhoto.id.desc()
+    ).first()
+    if photo:
+        return photo.filepath
+    
+    # Photos uploaded before user_photos existed are only on disk
+    user_photos_dir = Path(f"./storage/users/{user_id}/photos")
+    print(f"Looking for user photos in: {user_photos_dir}")
+    
+    if not user_photos_dir.exists():
+        print(f"User photos directory does not exist: {user_photos_dir}")
+        return None
+    
+    user_photo_files = list(user_photos_dir.glob("*.jpg"))
+    print(f"Found user photo files: {user_photo_files}")
+    
+    if not user_photo_files:
+        print("No JPG files found in user photos directory")
+        return None
+    
+    # Use the most recent user photo
+    user_photo_path = str(max(user_photo_files, key=os.path.getctime))
+    
+    # Convert to relative path from storage root for database storage
+    return str(Path(user_photo_path).relative_to(Path("./storage")))
+
+async def image_quality_scores(db: Session, model, filepath: str):
+    """Stored quality scores of an image, scoring (and storing) them if it predates scoring"""
+    scores = input_quality.stored_scores(db, model, filepath)
+    if scores is None:
+        path = Path("./storage") / filepath
+        async with decode_budget.reserve_async(input_quality.analysis_bytes(path)):
+            scores = await run_in_threadpool(input_quality.try_analyze, path)
+        if scores is not None:
+            input_quality.save_scores(db, model, filepath, scores)
+    return scores
+
+async def check_input_quality(db: Session, user_photo_path: Optional[str], products: list) -> List[str]:
+    """
+    Gate a generation on the stored quality scores of its inputs. Raises a 422
+    listing the reasons when an input is unusable; returns warnings otherwise.
+    """
+    if not input_quality.input_gate.enabled:
+        return []
+    
+    start = time.monotonic()
+    inputs = []
+    if user_photo_path:
+        inputs.append(("User photo", "person", await image_quality_scores(db, UserPhoto, user_photo_path)))
+    for product in products:
+        inputs.append((f"Product image of '{product.name}'", "product",
+                       await image_quality_scores(db, Product, product.filepath)))
+    rejections, warnings = input_quality.input_gate.check(inputs)
+    metrics.observe("input_quality_check_seconds", time.monotonic() - start)
+    
+    if rejections:
+        logger.info(f"Rejected try-on inputs: {rejections}")
+        metrics.increment("input_quality_rejected")
+        raise HTTPException(status_code=422, detail={
+            "message": "Input images failed the quality check",
+            "reasons": rejections,
+            "warnings": warnings
+        })
+    if warnings:
+        metrics.increment("input_quality_warned")
+    return warnings
+
+def find_reusable_session(db: Session, user_photo_path: str, product_id: int, quality: str):
+    """An earlier completed session for the same user photo and product whose result is still on disk"""
+    # A full result is always good enough; a preview only satisfies preview requests
+    qualities = ["preview", "full"] if quality == "preview" else ["full"]
+    sessions = db.query(TryOnSession).filter(
+        TryOnSession.input_user_photo_path == user_photo_path,
+        TryOnSession.product_id == product_id,
+        TryOnSession.status == "completed",
+        TryOnSession.quality.in_(qualities),
+        TryOnSession.output_image_path.isnot(None)
+    ).order_by((TryOnSession.quality == "full").desc(), TryOnSession.id.desc()).limit(5)
     
-    return {"user_id": user_id, "filepath": filepath}
+    # Generation failures are recorded as failed sessions, so everything here is a real result
+    for session in sessions:
+        if (Path("./storage") / session.output_image_path).exists():
+            return session
+    return None
 
 # Try-on endpoints
 @app.post("/tryon", response_model=TryOnResponse)
 async def try_on(
     tryon_request: TryOnRequest,
+    request: Request,
+    background_tasks: BackgroundTasks,
+    idempotency_key: Optional[str] = Header(None),
+    request_timeout: Optional[float] = Header(None, alias=DEADLINE_HEADER, gt=0),
     db: Session = Depends(get_db)
 ):
     """Generate try-on image"""
-    print(f"Try-on request received: user_id={tryon_request.user_id}, product_id={tryon_request.product_id}")
+    # The deadline starts counting when the request arrives
+    deadline = Deadline.from_request(request_timeout)
+    # Retries with the same key never start a second generation
+    fingerprint = request_fingerprint(tryon_request.model_dump_json())
+    return await run_idempotent(
+        db, "tryon", idempotency_key, fingerprint,
+        lambda: create_tryon(tryon_request, request, deadline, background_tasks, db)
+    )
+
+async def create_tryon(tryon_request: TryOnRequest, request: Request, deadline: Deadline,
+                       background_tasks: BackgroundTasks, db: Session) -> TryOnResponse:
+    """Create a try-on session and generate its result, giving up if the client leaves or the deadline passes"""
+    print(f"Try-on request received: user_id={tryon_request.user_id}, product_id={tryon_request.product_id}, quality={tryon_request.quality}")
     
     if not gemini_client:
         print("Gemini API not available")
@@ -189,73 +634,242 @@ async def try_on(
     print(f"Found user: {user.id}, product: {product.id} ({product.name})")
     
     # Find the most recent user photo (simplified - in production, you might want to specify which photo)
-    user_photos_dir = Path(f"./storage/users/{user.id}/photos")
-    print(f"Looking for user photos in: {user_photos_dir}")
-    
-    if not user_photos_dir.exists():
-        print(f"User photos directory does not exist: {user_photos_dir}")
-        raise HTTPException(status_code=400, detail="No user photos found")
-    
-    user_photo_files = list(user_photos_dir.glob("*.jpg"))
-    print(f"Found user photo files: {user_photo_files}")
-    
-    if not user_photo_files:
-        print("No JPG files found in user photos directory")
+    user_photo_relative = find_latest_user_photo(db, user.id)
+    if not user_photo_relative:
         raise HTTPException(status_code=400, detail="No user photos found")
     
-    # Use the most recent user photo
-    user_photo_path = str(max(user_photo_files, key=os.path.getctime))
+    # The same photo and product asked for again get the earlier result
+    reusable = find_reusable_session(db, user_photo_relative, product.id, tryon_request.quality)
+    if reusable:
+        logger.debug(f"Reusing result of session {reusable.id} for identical inputs")
+        return TryOnResponse(
+            session_id=reusable.id,
+            output_image_url=f"/static/{reusable.output_image_path}",
+            created_at=reusable.created_at,
+            quality=reusable.quality,
+            status=reusable.status,
+            reused=True
+        )
     
-    # Convert to relative path from storage root for database storage
-    user_photo_relative = str(Path(user_photo_path).relative_to(Path("./storage")))
+    # Unusable inputs are turned away here instead of costing an upstream call
+    warnings = await check_input_quality(db, user_photo_relative, [product])
     
-    # Create try-on session record
-    db_session = TryOnSession(
+    # Create try-on session record; session writes are batched by the group-commit writer
+    session_id, created_at = await db_writer.run(
+        insert_tryon_session,
         user_id=tryon_request.user_id,
         product_id=tryon_request.product_id,
         input_user_photo_path=user_photo_relative,
-        input_product_photo_path=product.filepath
+        input_product_photo_path=product.filepath,
+        status="pending"
     )
-    db.add(db_session)
-    db.commit()
-    db.refresh(db_session)
+    
+    # Convert relative paths to full paths for file access
+    full_user_photo_path = str(Path("./storage") / user_photo_relative)
+    full_product_photo_path = str(Path("./storage") / product.filepath)
+    
+    # Under load, full-tier requests are served at the preview tier to hold the latency target
+    tier = quality_governor.choose_tier(tryon_request.quality)
+    refine = tryon_request.quality == "progressive" and not quality_governor.should_degrade()
+    if tier != tryon_request.quality and not refine:
+        logger.info(f"Serving session {session_id} at {tier} quality (requested {tryon_request.quality})")
     
     try:
         # Generate try-on image using Gemini
-        # Convert relative paths to full paths for file access
-        full_user_photo_path = str(Path("./storage") / user_photo_relative)
-        full_product_photo_path = str(Path("./storage") / product.filepath)
-        
-        result_image_data = gemini_client.generate_tryon_image(
-            full_user_photo_path, 
-            full_product_photo_path, 
-            product.name
+        output_path = await generate_result(
+            session_id, full_user_photo_path, full_product_photo_path, product.name, tier,
+            tryon_request.user_id, tryon_request.priority, deadline, request
         )
         
-        # Save result image
-        output_path = save_result_image(db_session.id, result_image_data)
-        
         # Update session with output path
-        db_session.output_image_path = output_path
-        db.commit()
+        status = "preview" if refine else "completed"
+        await db_writer.run(update_tryon_session, session_id, output_image_path=output_path, quality=tier, status=status)
+        
+        if refine:
+            # Replace the preview with the full result once it is ready
+            background_tasks.add_task(
+                refine_tryon_session, session_id, full_user_photo_path, full_product_photo_path, product.name,
+                tryon_request.user_id
+            )
         
         # Generate URL for the result image - use relative path for URL
         output_url = f"/static/{output_path}"
         
         return TryOnResponse(
-            session_id=db_session.id,
+            session_id=session_id,
             output_image_url=output_url,
-            created_at=db_session.created_at
+            created_at=created_at,
+            quality=tier,
+            status=status,
+            warnings=warnings
         )
         
+    except RequestCancelled as e:
+        logger.info(f"Try-on session {session_id} cancelled: {e}")
+        await db_writer.run(update_tryon_session, session_id, status="cancelled")
+        raise cancellation_error(e)
+    
+    except TryOnGenerationError as e:
+        logger.warning(f"Try-on generation failed for session {session_id}: {e}")
+        # The placeholder tells the user what went wrong; the session stays failed,
+        # so it is never reused and reprocessing picks it up
+        output_path = await run_in_threadpool(save_result_image, session_id, e.error_image, filename=result_filename(tier))
+        await db_writer.run(update_tryon_session, session_id, output_image_path=output_path, quality=tier, status="failed")
+        return TryOnResponse(
+            session_id=session_id,
+            output_image_url=f"/static/{output_path}",
+            created_at=created_at,
+            quality=tier,
+            status="failed",
+            warnings=warnings
+        )
+    
     except Exception as e:
         print(f"Try-on generation failed: {str(e)}")
+        await db_writer.run(update_tryon_session, session_id, status="failed")
         # If generation fails, still return the session but without output
         return TryOnResponse(
-            session_id=db_session.id,
+            session_id=session_id,
             output_image_url="",
-            created_at=db_session.created_at
+            created_at=created_at,
+            status="failed",
+            warnings=warnings
+        )
+
+def insert_tryon_session(db: Session, **values) -> tuple:
+    """Group-commit job: create a session and return its (id, created_at)"""
+    session = TryOnSession(**values)
+    db.add(session)
+    db.flush()
+    return session.id, session.created_at
+
+def update_tryon_session(db: Session, session_id: int, only_if_status: str = None, **values):
+    """Group-commit job: set columns on a session (only while it has only_if_status, if given)"""
+    session = db.get(TryOnSession, session_id)
+    if session is None or (only_if_status and session.status != only_if_status):
+        return None
+    previous = {column: getattr(session, column) for column in values}
+    for column, value in values.items():
+        setattr(session, column, value)
+    return previous
+
+def cancellation_error(e: RequestCancelled) -> HTTPException:
+    """HTTP error for a generation given up on, counted by cause"""
+    if isinstance(e, DeadlineExceeded):
+        metrics.increment("tryon_deadline_exceeded")
+        return HTTPException(status_code=504, detail="Try-on did not finish within the request deadline")
+    metrics.increment("tryon_client_disconnected")
+    # Nobody is listening; 499 is what the access log should show
+    return HTTPException(status_code=499, detail="Client disconnected")
+
+def generate_image(user_photo_path: str, product_photo_path: str, product_name: str, tier: str,
+                   deadline: Deadline, layered: bool = False, reservation: Reservation = None) -> bytes:
+    """Worker-thread model call shared by try-ons and outfit steps"""
+    # The request may have waited for a free thread
+    deadline.check()
+    quality_governor.started(tier)
+    start = time.monotonic()
+    try:
+        result_image_data = gemini_client.generate_tryon_image(
+            user_photo_path,
+            product_photo_path,
+            product_name,
+            target_size=QUALITY_TIERS[tier],
+            deadline=deadline,
+            layered=layered,
+            reservation=reservation,
+        )
+    finally:
+        quality_governor.finished(tier, None if deadline.cancelled else time.monotonic() - start)
+    
+    # Nobody is waiting for a result that arrives after cancellation
+    deadline.check()
+    return result_image_data
+
+def generate_and_save(session_id: int, user_photo_path: str, product_photo_path: str,
+                      product_name: str, tier: str, deadline: Deadline, reservation: Reservation = None) -> str:
+    """Worker-thread part of generate_result"""
+    result_image_data = generate_image(user_photo_path, product_photo_path, product_name, tier, deadline,
+                                       reservation=reservation)
+    return save_result_image(session_id, result_image_data, filename=result_filename(tier))
+
+def generate_outfit_step(prefix_key: str, person_photo_path: str, product_photo_path: str,
+                         product_name: str, tier: str, deadline: Deadline, reservation: Reservation = None) -> str:
+    """Worker-thread part of one outfit step: add a garment to the previous step's image"""
+    result_image_data = generate_image(person_photo_path, product_photo_path, product_name, tier, deadline,
+                                       layered=True, reservation=reservation)
+    return save_outfit_image(prefix_key, result_image_data, filename=result_filename(tier))
+
+async def run_scheduled(worker, *args, inputs: tuple, user_id: int, priority: str, tier: str, deadline: Deadline,
+                        request: Request = None, queue_deadline: Deadline = None):
+    """
+    Run worker(*args, deadline, reservation=...) in a worker thread once the fair-share
+    scheduler grants a slot and the memory budget covers preprocessing the input photos.
+    
+    With queue_deadline, the wait for a slot is bounded by it instead, and deadline
+    only starts counting once the work is dispatched.
+    
+    Raises RequestCancelled as soon as the client disconnects or the deadline passes.
+    """
+    ticket = await tryon_scheduler.acquire(user_id, priority, queue_deadline or deadline, request, cost=TIER_COSTS[tier])
+    try:
+        if queue_deadline:
+            deadline.restart()
+        # Wait for memory here rather than in the worker thread; the worker releases
+        # the reservation once its inputs are encoded
+        reservation = await decode_budget.acquire_async(
+            GeminiClient.estimate_input_bytes(inputs, QUALITY_TIERS[tier]), deadline
+        )
+    except BaseException:
+        tryon_scheduler.release(ticket)
+        raise
+    
+    def finish():
+        reservation.release()
+        tryon_scheduler.release(ticket)
+    
+    # Generation blocks on the upstream call, so keep it off the event loop. The slot
+    # is held until the worker thread is done, even if the request gives up on it
+    return await run_cancellable(
+        request, deadline, worker, *args, deadline, reservation=reservation, on_finish=finish
+    )
+
+async def generate_result(session_id: int, user_photo_path: str, product_photo_path: str,
+                          product_name: str, tier: str, user_id: int, priority: str,
+                          deadline: Deadline, request: Request = None) -> str:
+    """Generate a try-on image at the given quality tier, save it, and return its relative path"""
+    return await run_scheduled(
+        generate_and_save, session_id, user_photo_path, product_photo_path, product_name, tier,
+        inputs=(user_photo_path, product_photo_path),
+        user_id=user_id, priority=priority, tier=tier, deadline=deadline, request=request
+    )
+
+async def refine_tryon_session(session_id: int, user_photo_path: str, product_photo_path: str, product_name: str,
+                               user_id: int):
+    """Background step of progressive try-ons: swap the preview for the full-quality result"""
+    try:
+        # The user already has the preview, so the upgrade is speculative work. Nobody
+        # waits on it, but it still gets a deadline so it can't hang forever
+        output_path = await generate_result(
+            session_id, user_photo_path, product_photo_path, product_name, "full",
+            user_id, "speculative", Deadline.from_request()
         )
+        
+        previous = await db_writer.run(
+            update_tryon_session, session_id, output_image_path=output_path, quality="full", status="completed"
+        )
+        if previous is None:
+            return
+        
+        # The preview is no longer referenced once the full result is committed
+        preview_path = previous["output_image_path"]
+        if preview_path and preview_path != output_path:
+            (Path("./storage") / preview_path).unlink(missing_ok=True)
+        logger.debug(f"Session {session_id} refined to full quality")
+    except Exception as e:
+        logger.warning(f"Refinement of session {session_id} failed: {str(e)}")
+        # Keep the preview; it is the best result this session will get
+        await db_writer.run(update_tryon_session, session_id, only_if_status="preview", status="completed")
 
 @app.get("/tryon/{session_id}", response_model=TryOnSessionResponse)
 async def get_tryon_result(session_id: int, db: Session = Depends(get_db)):
@@ -265,6 +879,217 @@ async def get_tryon_result(session_id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Try-on session not found")
     return session
 
+@app.get("/users/{user_id}/tryons", response_model=TryOnHistoryPage)
+async def get_user_tryons(
+    user_id: int,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None),
+    db: Session = Depends(get_db)
+):
+    """A user's try-ons, newest first, one keyset page at a time"""
+    if not db.query(User.id).filter(User.id == user_id).first():
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    # Product columns come from the same query, so there are no per-row product loads.
+    # ix_tryon_sessions_user_created serves both the filter and the order
+    query = db.query(
+        TryOnSession.id, TryOnSession.product_id, TryOnSession.output_image_path, TryOnSession.status,
+        TryOnSession.quality, TryOnSession.created_at, Product.name, Product.filepath
+    ).outerjoin(Product, Product.id == TryOnSession.product_id).filter(TryOnSession.user_id == user_id)
+    if cursor:
+        query = query.filter(tuple_(TryOnSession.created_at, TryOnSession.id) < decode_cursor(cursor))
+    # One extra row tells whether there is a next page
+    rows = query.order_by(TryOnSession.created_at.desc(), TryOnSession.id.desc()).limit(limit + 1).all()
+    
+    page = rows[:limit]
+    return {
+        "items": [
+            {
+                "session_id": row.id,
+                "product_id": row.product_id,
+                "product_name": row.name,
+                "product_image_url": f"/static/{row.filepath}" if row.filepath else None,
+                "output_image_url": f"/static/{row.output_image_path}" if row.output_image_path else None,
+                "status": row.status,
+                "quality": row.quality,
+                "created_at": row.created_at
+            }
+            for row in page
+        ],
+        "next_cursor": encode_cursor(page[-1].created_at, page[-1].id) if len(rows) > limit else None
+    }
+
+# Outfit endpoints
+@app.post("/outfits", response_model=OutfitResponse)
+async def create_outfit(
+    outfit_request: OutfitRequest,
+    request: Request,
+    idempotency_key: Optional[str] = Header(None),
+    request_timeout: Optional[float] = Header(None, alias=DEADLINE_HEADER, gt=0),
+    db: Session = Depends(get_db)
+):
+    """Try on several garments at once, reusing the longest cached prefix of the outfit"""
+    # One deadline covers the whole chain
+    deadline = Deadline.from_request(request_timeout)
+    fingerprint = request_fingerprint(outfit_request.model_dump_json())
+    return await run_idempotent(
+        db, "outfits", idempotency_key, fingerprint,
+        lambda: build_outfit(outfit_request, request, deadline, db)
+    )
+
+async def build_outfit(outfit_request: OutfitRequest, request: Request, deadline: Deadline, db: Session) -> OutfitResponse:
+    """Generate the outfit steps after its longest cached prefix"""
+    if not gemini_client:
+        raise HTTPException(status_code=500, detail="Gemini API not available")
+    
+    user = db.query(User).filter(User.id == outfit_request.user_id).first()
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    products = {p.id: p for p in db.query(Product).filter(Product.id.in_(outfit_request.product_ids))}
+    for product_id in outfit_request.product_ids:
+        if product_id not in products:
+            raise HTTPException(status_code=404, detail=f"Product {product_id} not found")
+    garments = [products[product_id] for product_id in outfit_request.product_ids]
+    
+    base_photo_relative = find_latest_user_photo(db, user.id)
+    if not base_photo_relative:
+        raise HTTPException(status_code=400, detail="No user photos found")
+    
+    # The whole chain runs at one tier, so cached steps of either tier never mix
+    tier = quality_governor.choose_tier(outfit_request.quality)
+    keys = outfits.prefix_keys(base_photo_relative, tier, [garment.filepath for garment in garments])
+    cached = outfits.find_cached_steps(db, keys)
+    cached_depth = outfits.longest_cached_prefix(keys, cached)
+    logger.debug(f"Outfit for user {user.id}: {cached_depth} of {len(keys)} steps cached ({tier})")
+    metrics.increment("outfit_steps_cached", cached_depth)
+    
+    # Only the inputs of the steps still to generate reach the model; the base
+    # photo only if no step is cached
+    warnings = []
+    if cached_depth < len(keys):
+        warnings = await check_input_quality(db, None if cached_depth else base_photo_relative, garments[cached_depth:])
+    
+    steps = []
+    for key, garment in zip(keys[:cached_depth], garments):
+        step = cached.get(key)
+        if step:
+            outfits.touch(step)
+        steps.append(OutfitStepResponse(
+            product_id=garment.id,
+            output_image_url=f"/static/{step.output_image_path}" if step else None,
+            cached=True
+        ))
+    
+    person_path = cached[keys[cached_depth - 1]].output_image_path if cached_depth else base_photo_relative
+    for depth in range(cached_depth + 1, len(keys) + 1):
+        garment = garments[depth - 1]
+        try:
+            person_photo_path = str(Path("./storage") / person_path)
+            garment_photo_path = str(Path("./storage") / garment.filepath)
+            output_path = await run_scheduled(
+                generate_outfit_step, keys[depth - 1], person_photo_path, garment_photo_path, garment.name, tier,
+                inputs=(person_photo_path, garment_photo_path),
+                user_id=user.id, priority=outfit_request.priority, tier=tier, deadline=deadline, request=request
+            )
+        except RequestCancelled as e:
+            # Finished steps stay cached, so a retry resumes from here
+            logger.info(f"Outfit for user {user.id} cancelled at step {depth}: {e}")
+            raise cancellation_error(e)
+        except Exception as e:
+            logger.warning(f"Outfit step {depth} failed: {e}")
+            raise HTTPException(status_code=502, detail=f"Outfit generation failed at garment {depth}")
+        
+        step = outfits.record_step(db, keys[depth - 1], user.id, base_photo_relative,
+                                   outfit_request.product_ids[:depth], tier, output_path)
+        metrics.increment("outfit_steps_generated")
+        steps.append(OutfitStepResponse(product_id=garment.id, output_image_url=f"/static/{step.output_image_path}"))
+        person_path = step.output_image_path
+    
+    return OutfitResponse(
+        output_image_url=f"/static/{person_path}",
+        quality=tier,
+        steps=steps,
+        cached_steps=cached_depth,
+        generated_steps=len(keys) - cached_depth,
+        warnings=warnings
+    )
+
+async def reprocess_generate(candidate: reprocess.Candidate, tier: str) -> bytes:
+    """Model call for reprocessing jobs: batch priority, on behalf of the session's user"""
+    # Batch work waits behind interactive requests, so waiting doesn't eat into the generation time
+    return await run_scheduled(
+        generate_image, candidate.user_photo_path, candidate.product_photo_path, candidate.product_name, tier,
+        inputs=(candidate.user_photo_path, candidate.product_photo_path),
+        user_id=candidate.user_id, priority="batch", tier=tier, deadline=Deadline.from_request(),
+        queue_deadline=Deadline(reprocess.get_queue_timeout())
+    )
+
+def start_reprocess_job(job_id: int):
+    """Run a claimed job in the background of this worker"""
+    task = asyncio.create_task(reprocess.ReprocessRunner(job_id, reprocess_generate).run())
+    reprocess_tasks[job_id] = task
+    task.add_done_callback(lambda _: reprocess_tasks.pop(job_id, None))
+
+def get_reprocess_job(db: Session, job_id: int) -> ReprocessJob:
+    job = db.get(ReprocessJob, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Reprocess job not found")
+    return job
+
+@app.post("/admin/reprocess", response_model=ReprocessJobResponse, dependencies=[Depends(require_admin)])
+async def create_reprocess_job(reprocess_request: ReprocessRequest, db: Session = Depends(get_db)):
+    """Re-run sessions left without a usable result, e.g. after an upstream outage"""
+    if not gemini_client:
+        raise HTTPException(status_code=500, detail="Gemini API not available")
+    try:
+        job = reprocess.create_job(db, **reprocess_request.model_dump())
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    reprocess.claim_job(db, job.id)
+    start_reprocess_job(job.id)
+    db.refresh(job)
+    return ReprocessJobResponse(**reprocess.job_summary(job))
+
+@app.get("/admin/reprocess", response_model=List[ReprocessJobResponse], dependencies=[Depends(require_admin)])
+async def list_reprocess_jobs(limit: int = Query(20, ge=1, le=100), db: Session = Depends(get_db)):
+    """Most recent reprocessing jobs first"""
+    jobs = db.query(ReprocessJob).order_by(ReprocessJob.id.desc()).limit(limit).all()
+    return [ReprocessJobResponse(**reprocess.job_summary(job)) for job in jobs]
+
+@app.get("/admin/reprocess/{job_id}", response_model=ReprocessJobResponse, dependencies=[Depends(require_admin)])
+async def get_reprocess_job_status(job_id: int, db: Session = Depends(get_db)):
+    return ReprocessJobResponse(**reprocess.job_summary(get_reprocess_job(db, job_id)))
+
+@app.post("/admin/reprocess/{job_id}/resume", response_model=ReprocessJobResponse, dependencies=[Depends(require_admin)])
+async def resume_reprocess_job(job_id: int, db: Session = Depends(get_db)):
+    """Continue a paused or failed job from its checkpoint, or take over one whose worker died"""
+    job = get_reprocess_job(db, job_id)
+    if not gemini_client:
+        raise HTTPException(status_code=500, detail="Gemini API not available")
+    if not reprocess.claim_job(db, job_id):
+        raise HTTPException(status_code=409, detail=f"Reprocess job is {job.status} and can't be resumed")
+    start_reprocess_job(job_id)
+    db.refresh(job)
+    return ReprocessJobResponse(**reprocess.job_summary(job))
+
+@app.post("/admin/reprocess/{job_id}/pause", response_model=ReprocessJobResponse, dependencies=[Depends(require_admin)])
+async def pause_reprocess_job(job_id: int, db: Session = Depends(get_db)):
+    """Stop starting sessions; those in flight finish and the job can be resumed"""
+    return stop_reprocess_job(db, job_id, "paused")
+
+@app.post("/admin/reprocess/{job_id}/cancel", response_model=ReprocessJobResponse, dependencies=[Depends(require_admin)])
+async def cancel_reprocess_job(job_id: int, db: Session = Depends(get_db)):
+    """Stop the job for good"""
+    return stop_reprocess_job(db, job_id, "cancelled")
+
+def stop_reprocess_job(db: Session, job_id: int, status: str) -> ReprocessJobResponse:
+    job = get_reprocess_job(db, job_id)
+    if not reprocess.stop_job(db, job_id, status):
+        raise HTTPException(status_code=409, detail=f"Reprocess job is already {job.status}")
+    db.refresh(job)
+    return ReprocessJobResponse(**reprocess.job_summary(job))
+
 @app.get("/static/{file_path:path}")
 async def serve_static_file(file_path: str):
     """Serve static files"""
@@ -0,0 +1,240 @@
+"""
+Process-wide budget for decoded image memory.
+
+Every image decode reserves its estimated decoded size (see
+image_utils.estimate_decoded_bytes) before any pixels are materialized, and
+gives it back when the pixels are dropped. Reservations wait, in arrival order,
+while the budget is exhausted, so concurrent requests queue instead of running
+the process out of memory.
+
+Request handlers reserve on the event loop (reserve_async, acquire_async)
+before handing the decode to a worker thread, so a request waiting for memory
+doesn't tie up a thread. The thread inherits the reservation: reservations made
+while the current context already holds one are covered by it and don't count
+twice. reserve blocks the calling thread and is for code that isn't covered by
+an outer reservation, such as scripts or a decode whose size is only known
+inside the thread.
+
+A reservation larger than the whole budget is clamped to it: oversized images
+still work, one at a time.
+
+Peak reserved bytes are tracked per request through a context variable (see
+track_usage) and process-wide in snapshot().
+
+Configured with DECODE_MEMORY_BUDGET_BYTES (0 disables the budget). The
+shared decode_budget reads it on first use rather than at import, so a value
+in .env is seen once gemini_client has loaded it.
+"""
+
+import asyncio
+import contextvars
+import os
+import threading
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+DEFAULT_BUDGET_BYTES = 1024 * 1024 * 1024
+# How often a waiting reservation re-checks its deadline
+WAIT_POLL_SECONDS = 0.25
+
+class MemoryUsage:
+    """Decoded bytes reserved by one request, current and peak"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+
+    def add(self, nbytes: int):
+        with self.lock:
+            self.current += nbytes
+            self.peak = max(self.peak, self.current)
+
+# Usage of the request being served, if any
+_usage = contextvars.ContextVar("decode_memory_usage", default=None)
+# Set while the current context holds a reservation that covers nested ones
+_holding = contextvars.ContextVar("decode_memory_holding", default=False)
+
+@contextmanager
+def track_usage():
+    """Track decoded memory reserved by everything run in this context, including worker threads"""
+    usage = MemoryUsage()
+    token = _usage.set(usage)
+    try:
+        yield usage
+    finally:
+        _usage.reset(token)
+
+def capacity_from_env() -> int:
+    return int(os.getenv("DECODE_MEMORY_BUDGET_BYTES", str(DEFAULT_BUDGET_BYTES)))
+
+class _Waiter:
+    def __init__(self, nbytes: int, wake):
+        self.nbytes = nbytes
+        self.wake = wake
+        self.granted = False
+
+class Reservation:
+    """Bytes held of a DecodeBudget; release() gives them back, once"""
+
+    def __init__(self, budget: "DecodeBudget", nbytes: int):
+        self.budget = budget
+        self.nbytes = nbytes
+        self.lock = threading.Lock()
+        self.released = False
+
+    def release(self):
+        with self.lock:
+            if self.released:
+                return
+            self.released = True
+        self.budget.release(self.nbytes)
+
+class DecodeBudget:
+    def __init__(self, capacity: int = None):
+        # None: read DECODE_MEMORY_BUDGET_BYTES on first use
+        self._capacity = capacity
+        self.in_use = 0
+        self.peak = 0
+        self.waiters = deque()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "DecodeBudget":
+        return cls(capacity_from_env())
+
+    @property
+    def capacity(self) -> int:
+        # Not under self.lock, which callers may already hold; resolving twice is harmless
+        if self._capacity is None:
+            self._capacity = capacity_from_env()
+        return self._capacity
+
+    def _clamp(self, nbytes: int) -> int:
+        return min(max(0, int(nbytes)), self.capacity)
+
+    def _fits(self, nbytes: int) -> bool:
+        return self.in_use + nbytes <= self.capacity
+
+    def _take(self, nbytes: int):
+        self.in_use += nbytes
+        self.peak = max(self.peak, self.in_use)
+
+    def _enqueue_or_take(self, nbytes: int, wake):
+        """Take nbytes now (returns None) or queue a waiter; called with the lock held"""
+        if not self.waiters and self._fits(nbytes):
+            self._take(nbytes)
+            return None
+        waiter = _Waiter(nbytes, wake)
+        self.waiters.append(waiter)
+        return waiter
+
+    def _abandon(self, waiter: _Waiter):
+        """Withdraw a waiter, giving its bytes back if it was granted meanwhile"""
+        with self.lock:
+            if not waiter.granted:
+                self.waiters.remove(waiter)
+                self._wake_waiters()
+                return
+        self.release(waiter.nbytes)
+
+    def _wake_waiters(self):
+        # First come, first served: a large request at the head blocks smaller ones
+        # behind it, so it can't be starved
+        while self.waiters and self._fits(self.waiters[0].nbytes):
+            waiter = self.waiters.popleft()
+            self._take(waiter.nbytes)
+            waiter.granted = True
+            waiter.wake()
+
+    def acquire(self, nbytes: int, deadline=None) -> int:
+        """Blocking acquire for worker threads; deadline.check() is called while waiting"""
+        nbytes = self._clamp(nbytes)
+        event = threading.Event()
+        with self.lock:
+            waiter = self._enqueue_or_take(nbytes, event.set)
+        if waiter:
+            try:
+                while not event.wait(WAIT_POLL_SECONDS):
+                    if deadline:
+                        deadline.check()
+            except BaseException:
+                self._abandon(waiter)
+                raise
+        return nbytes
+
+    async def acquire_async(self, nbytes: int, deadline=None) -> Reservation:
+        """Wait on the event loop for nbytes; deadline.check() is called while waiting"""
+        nbytes = self._clamp(nbytes) if self.capacity > 0 else 0
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def wake():
+            # Called with the lock held, from whichever thread released the bytes
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        with self.lock:
+            waiter = self._enqueue_or_take(nbytes, wake)
+        if waiter:
+            try:
+                while True:
+                    try:
+                        await asyncio.wait_for(asyncio.shield(granted), WAIT_POLL_SECONDS)
+                        break
+                    except asyncio.TimeoutError:
+                        if deadline:
+                            deadline.check()
+            except BaseException:
+                self._abandon(waiter)
+                raise
+        return Reservation(self, nbytes)
+
+    def release(self, nbytes: int):
+        with self.lock:
+            self.in_use -= nbytes
+            self._wake_waiters()
+
+    @contextmanager
+    def holding(self, reservation: Reservation):
+        """Cover decodes in the block (and threads it starts) by reservation; released at the end"""
+        usage = _usage.get()
+        if usage:
+            usage.add(reservation.nbytes)
+        token = _holding.set(True)
+        try:
+            yield reservation
+        finally:
+            _holding.reset(token)
+            if usage:
+                usage.add(-reservation.nbytes)
+            reservation.release()
+
+    @contextmanager
+    def reserve(self, nbytes: int, deadline=None):
+        """Hold nbytes of the budget for the duration of the block, blocking the calling thread"""
+        if self.capacity <= 0 or _holding.get():
+            yield
+            return
+        with self.holding(Reservation(self, self.acquire(nbytes, deadline))):
+            yield
+
+    @asynccontextmanager
+    async def reserve_async(self, nbytes: int, deadline=None):
+        """Hold nbytes of the budget for the duration of the block, waiting on the event loop"""
+        if self.capacity <= 0 or _holding.get():
+            yield
+            return
+        with self.holding(await self.acquire_async(nbytes, deadline)):
+            yield
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "capacity_bytes": self.capacity,
+                "in_use_bytes": self.in_use,
+                "peak_bytes": self.peak,
+                "waiting": len(self.waiters),
+            }
+
+# Sized lazily, after .env has been loaded
+decode_budget = DecodeBudget()
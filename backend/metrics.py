@@ -0,0 +1,52 @@
+"""
+In-process metrics for TryOn-POC.
+
+Counters and observations are kept per worker process and served as JSON
+from GET /metrics. Observations keep count, sum, max and a bounded window
+of recent values for percentiles.
+"""
+
+import threading
+from collections import defaultdict, deque
+
+# Recent values kept per observation for percentile estimates
+OBSERVATION_WINDOW = 1000
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_observations = {}
+
+def increment(name: str, value: float = 1):
+    """Add value to a counter"""
+    with _lock:
+        _counters[name] += value
+
+def observe(name: str, value: float):
+    """Record one observation (latency, size, ...)"""
+    with _lock:
+        obs = _observations.get(name)
+        if obs is None:
+            obs = _observations[name] = {"count": 0, "sum": 0.0, "max": 0.0, "recent": deque(maxlen=OBSERVATION_WINDOW)}
+        obs["count"] += 1
+        obs["sum"] += value
+        obs["max"] = max(obs["max"], value)
+        obs["recent"].append(value)
+
+def _percentile(sorted_values: list, fraction: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def snapshot() -> dict:
+    """All counters and observation summaries"""
+    with _lock:
+        observations = {}
+        for name, obs in _observations.items():
+            recent = sorted(obs["recent"])
+            observations[name] = {
+                "count": obs["count"],
+                "mean": obs["sum"] / obs["count"],
+                "max": obs["max"],
+                "p50": _percentile(recent, 0.50),
+                "p95": _percentile(recent, 0.95),
+                "p99": _percentile(recent, 0.99),
+            }
+        return {"counters": dict(_counters), "observations": observations}
@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, Field
+from typing import List, Optional, Literal
 from datetime import datetime
 
 # Request models
@@ -23,22 +23,90 @@ class ProductResponse(BaseModel):
     filepath: str
     image_url: str
     created_at: datetime
+    # Product whose image this upload duplicates, if any
+    duplicate_of: Optional[int] = None
+    # Problems the input quality check found in the image
+    quality_issues: List[str] = []
     
     class Config:
         from_attributes = True
 
+class SimilarProductResponse(ProductResponse):
+    # Cosine similarity of the product feature vectors, 1.0 = identical
+    score: float
+
+class UserPhotoResponse(BaseModel):
+    user_id: int
+    photo_id: int
+    filepath: str
+    # Earlier photo this upload duplicates, if any
+    duplicate_of: Optional[int] = None
+    # Problems the input quality check found in the photo
+    quality_issues: List[str] = []
+
 class TryOnRequest(BaseModel):
     user_id: int
     product_id: int
+    # preview: fast 512px generation; full: 1024px; progressive: preview now, full later
+    quality: Literal["preview", "full", "progressive"] = "full"
+    # Scheduling class: interactive (someone is waiting), batch, or speculative
+    priority: Literal["interactive", "batch", "speculative"] = "interactive"
 
 class TryOnResponse(BaseModel):
     session_id: int
     output_image_url: str
     created_at: datetime
+    # Tier of the returned image and session status ("preview" while a full result is pending)
+    quality: Optional[str] = None
+    status: Optional[str] = None
+    # True when an earlier result for the same photo and product was returned
+    reused: bool = False
+    # Input quality problems that didn't block generation
+    warnings: List[str] = []
     
     class Config:
         from_attributes = True
 
+class TryOnHistoryItem(BaseModel):
+    session_id: int
+    product_id: int
+    # None if the product has since been deleted
+    product_name: Optional[str] = None
+    product_image_url: Optional[str] = None
+    output_image_url: Optional[str] = None
+    status: str
+    quality: Optional[str] = None
+    created_at: datetime
+
+class TryOnHistoryPage(BaseModel):
+    items: List[TryOnHistoryItem]
+    # Pass as `cursor` to get the next page; None on the last page
+    next_cursor: Optional[str] = None
+
+class OutfitRequest(BaseModel):
+    user_id: int
+    # Garments in the order they are put on, e.g. top, bottoms, jacket
+    product_ids: List[int] = Field(..., min_length=1, max_length=5)
+    quality: Literal["preview", "full"] = "full"
+    priority: Literal["interactive", "batch", "speculative"] = "interactive"
+
+class OutfitStepResponse(BaseModel):
+    product_id: int
+    # Image of the outfit up to and including this garment; None if an earlier cached
+    # intermediate was evicted
+    output_image_url: Optional[str] = None
+    cached: bool = False
+
+class OutfitResponse(BaseModel):
+    output_image_url: str
+    quality: str
+    steps: List[OutfitStepResponse]
+    # Steps served from the prefix cache vs. generated for this request
+    cached_steps: int
+    generated_steps: int
+    # Input quality problems that didn't block generation
+    warnings: List[str] = []
+
 class TryOnSessionResponse(BaseModel):
     id: int
     user_id: int
@@ -46,8 +114,39 @@ class TryOnSessionResponse(BaseModel):
     input_user_photo_path: str
     input_product_photo_path: str
     output_image_path: Optional[str]
+    status: str
+    quality: Optional[str]
     created_at: datetime
     
     class Config:
         from_attributes = True
 
+
+class ReprocessRequest(BaseModel):
+    # Session statuses to select; completed and preview sessions are only re-run if their output is missing
+    statuses: List[Literal["pending", "preview", "completed", "failed", "cancelled"]] = Field(["failed"], min_length=1)
+    created_after: Optional[datetime] = None
+    created_before: Optional[datetime] = None
+    quality: Literal["preview", "full"] = "full"
+    concurrency: int = Field(2, ge=1, le=16)
+    rate_per_minute: float = Field(30, gt=0, le=600)
+
+class ReprocessJobResponse(BaseModel):
+    id: int
+    status: str
+    statuses: List[str]
+    created_after: Optional[datetime]
+    created_before: Optional[datetime]
+    quality: str
+    concurrency: int
+    rate_per_minute: float
+    # Every session with an id up to this one has been handled
+    checkpoint_id: int
+    scanned: int
+    regenerated: int
+    failed: int
+    skipped: int
+    error: Optional[str]
+    created_at: datetime
+    heartbeat_at: Optional[datetime]
+    finished_at: Optional[datetime]
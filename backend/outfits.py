@@ -0,0 +1,72 @@
+"""
+Multi-garment outfits built by chaining try-on generations.
+
+An outfit is a base user photo plus an ordered list of garments (top, then
+bottoms, then jacket). Step i feeds the output of step i-1 back in as the
+person image and adds garment i. Every step's output is cached in outfit_steps
+under a prefix key for (base photo, quality tier, garments so far), so outfits
+sharing a prefix with an earlier one (same photo, same top) only generate the
+steps after their longest cached prefix.
+
+Photos and garments are keyed by their image files. Cached steps count towards the
+retention byte budget and are evicted least recently used first.
+"""
+
+import os
+import time
+
+from sqlalchemy.exc import IntegrityError
+
+from database import OutfitStep
+from idempotency import request_fingerprint
+from storage import STORAGE_ROOT
+
+def prefix_keys(base_photo_path: str, tier: str, garment_paths: list) -> list:
+    """Cache key of every prefix of the outfit, shortest first"""
+    return [
+        request_fingerprint(base_photo_path, tier, *garment_paths[:depth])
+        for depth in range(1, len(garment_paths) + 1)
+    ]
+
+def find_cached_steps(db, keys: list) -> dict:
+    """Cached steps for these prefix keys whose images are still on disk, by key"""
+    steps = db.query(OutfitStep).filter(OutfitStep.prefix_key.in_(keys)).all()
+    return {step.prefix_key: step for step in steps if (STORAGE_ROOT / step.output_image_path).exists()}
+
+def longest_cached_prefix(keys: list, cached: dict) -> int:
+    """Number of garments covered by the longest cached prefix"""
+    for depth in range(len(keys), 0, -1):
+        if keys[depth - 1] in cached:
+            return depth
+    return 0
+
+def touch(step: OutfitStep):
+    """Mark a cached step as used for LRU eviction"""
+    path = STORAGE_ROOT / step.output_image_path
+    try:
+        # Only the access time: the crop cache keys files by mtime
+        os.utime(path, ns=(time.time_ns(), path.stat().st_mtime_ns))
+    except OSError:
+        pass
+
+def record_step(db, prefix_key: str, user_id: int, base_photo_path: str, product_ids: list,
+                tier: str, output_path: str) -> OutfitStep:
+    """Cache a generated step; if a concurrent request cached the same prefix first, return its row"""
+    step = OutfitStep(
+        prefix_key=prefix_key,
+        user_id=user_id,
+        base_photo_path=base_photo_path,
+        product_ids=",".join(str(product_id) for product_id in product_ids),
+        depth=len(product_ids),
+        quality=tier,
+        output_image_path=output_path,
+    )
+    db.add(step)
+    try:
+        db.commit()
+        db.refresh(step)
+        return step
+    except IntegrityError:
+        # Same key, same file: the other request's image simply replaced ours
+        db.rollback()
+    return db.query(OutfitStep).filter(OutfitStep.prefix_key == prefix_key).first()
@@ -0,0 +1,30 @@
+"""
+Keyset (seek) pagination cursors.
+
+A page ends with the sort key of its last row; the next page starts strictly
+after it, so every page is a single index range scan no matter how deep the
+client has paged, and rows inserted meanwhile never shift page boundaries.
+Cursors are opaque URL-safe strings to clients.
+"""
+
+import base64
+import json
+from datetime import datetime
+
+from fastapi import HTTPException
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    raw = json.dumps([created_at.isoformat(), row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple:
+    """(created_at, id) from a cursor; 400 if it wasn't produced by encode_cursor"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, row_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
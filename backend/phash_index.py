@@ -0,0 +1,226 @@
+"""
+Perceptual-hash index for near-duplicate user and product photos.
+
+Hashes are 64-bit dHashes (see image_utils.perceptual_hash) stored as 16-digit
+hex strings on UserPhoto and Product rows. In memory they are kept in BK-trees,
+one per user for user photos and one for the product catalog, so a lookup only
+visits hashes that can be within the Hamming distance threshold.
+
+Hashes are grayscale, so a hash match is only a candidate: it counts as a
+duplicate once the two images' color signatures (image_utils.color_signature)
+are within the color distance too. A duplicate is only linked to its canonical
+photo (canonical_id); the upload is still stored as its own file.
+
+Each worker process holds its own index: the product tree is loaded at startup,
+and a user's tree is loaded from the database the first time that user uploads.
+"""
+
+import logging
+import os
+import threading
+from datetime import datetime
+from pathlib import Path
+
+from database import Product, UserPhoto
+from image_utils import color_distance, color_signature, hamming_distance, perceptual_hash
+from storage import STORAGE_ROOT, USERS_DIR
+
+logger = logging.getLogger(__name__)
+
+# Hashes at most this many bits apart are candidates for the same photo
+DEFAULT_MATCH_DISTANCE = 6
+# ...and are the same photo if their color signatures differ by at most this much (0-255)
+DEFAULT_COLOR_DISTANCE = 12
+
+def get_match_distance() -> int:
+    return int(os.getenv("PHASH_MATCH_DISTANCE", str(DEFAULT_MATCH_DISTANCE)))
+
+def get_color_distance() -> float:
+    return float(os.getenv("PHASH_COLOR_DISTANCE", str(DEFAULT_COLOR_DISTANCE)))
+
+def same_colors(source, candidate_path: Path, signature: list) -> bool:
+    """
+    Whether the candidate file's colors match source's. signature is a one-item
+    cache for source's signature, so it is computed at most once per lookup.
+    """
+    try:
+        if not signature:
+            if hasattr(source, "seek"):
+                source.seek(0)
+            signature.append(color_signature(source))
+        return color_distance(signature[0], color_signature(candidate_path)) <= get_color_distance()
+    except Exception as e:
+        logger.warning(f"Could not compare colors with {candidate_path}: {e}")
+        return False
+
+def hash_to_hex(value: int) -> str:
+    return f"{value:016x}"
+
+def hex_to_hash(value: str) -> int:
+    return int(value, 16)
+
+class BKTree:
+    """Burkhard-Keller tree over Hamming distance"""
+
+    def __init__(self):
+        # Nodes are [hash, item, {distance: child}]
+        self.root = None
+        self.size = 0
+
+    def add(self, value: int, item):
+        node = [value, item, {}]
+        self.size += 1
+        if self.root is None:
+            self.root = node
+            return
+
+        current = self.root
+        while True:
+            distance = hamming_distance(value, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, value: int, max_distance: int) -> list:
+        """All (distance, item) pairs within max_distance, nearest first"""
+        if self.root is None:
+            return []
+
+        matches = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= max_distance:
+                matches.append((distance, node[1]))
+            # Triangle inequality: only children in [d - max, d + max] can match
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        matches.sort(key=lambda match: match[0])
+        return matches
+
+class PerceptualIndex:
+    """BK-trees of canonical photo ids, per user and for the catalog"""
+
+    def __init__(self):
+        self.user_trees = {}
+        self.product_tree = BKTree()
+        self.lock = threading.Lock()
+
+    def load_products(self, db):
+        """Build the product tree from canonical products with a stored hash"""
+        tree = BKTree()
+        rows = db.query(Product.id, Product.phash).filter(
+            Product.phash.isnot(None), Product.canonical_id.is_(None)
+        )
+        for product_id, phash in rows:
+            tree.add(hex_to_hash(phash), product_id)
+        with self.lock:
+            self.product_tree = tree
+        print(f"Perceptual index loaded {tree.size} products")
+
+    def _user_tree(self, db, user_id: int) -> BKTree:
+        with self.lock:
+            tree = self.user_trees.get(user_id)
+        if tree is not None:
+            return tree
+
+        tree = BKTree()
+        rows = db.query(UserPhoto.id, UserPhoto.phash).filter(
+            UserPhoto.user_id == user_id, UserPhoto.phash.isnot(None), UserPhoto.canonical_id.is_(None)
+        )
+        for photo_id, phash in rows:
+            tree.add(hex_to_hash(phash), photo_id)
+        with self.lock:
+            return self.user_trees.setdefault(user_id, tree)
+
+    def find_user_photo(self, db, user_id: int, value: int) -> list:
+        """Canonical UserPhoto ids of this user within the match distance, nearest first"""
+        tree = self._user_tree(db, user_id)
+        with self.lock:
+            return [photo_id for _, photo_id in tree.search(value, get_match_distance())]
+
+    def find_product(self, value: int) -> list:
+        """Canonical product ids within the match distance, nearest first"""
+        with self.lock:
+            return [product_id for _, product_id in self.product_tree.search(value, get_match_distance())]
+
+    def add_user_photo(self, db, user_id: int, value: int, photo_id: int):
+        tree = self._user_tree(db, user_id)
+        with self.lock:
+            tree.add(value, photo_id)
+
+    def add_product(self, value: int, product_id: int):
+        with self.lock:
+            self.product_tree.add(value, product_id)
+
+    def canonical_user_photo(self, db, user_id: int, value: int, source):
+        """The user's earlier photo that source (with hash value) duplicates, if its file still exists"""
+        signature = []
+        for photo_id in self.find_user_photo(db, user_id, value):
+            photo = db.query(UserPhoto).filter(UserPhoto.id == photo_id).first()
+            if photo and (STORAGE_ROOT / photo.filepath).exists() and same_colors(source, STORAGE_ROOT / photo.filepath, signature):
+                return photo
+        return None
+
+    def canonical_product(self, db, value: int, source):
+        """The existing product whose image source (with hash value) duplicates, if its file still exists"""
+        signature = []
+        for product_id in self.find_product(value):
+            product = db.query(Product).filter(Product.id == product_id).first()
+            if product and (STORAGE_ROOT / product.filepath).exists() and same_colors(source, STORAGE_ROOT / product.filepath, signature):
+                return product
+        return None
+
+    def forget_user(self, user_id: int):
+        """Drop a user's tree so it is reloaded from the database on next use"""
+        with self.lock:
+            self.user_trees.pop(user_id, None)
+
+perceptual_index = PerceptualIndex()
+
+def compute_hash(source):
+    """Perceptual hash of an image, or None if it can't be decoded"""
+    try:
+        return perceptual_hash(source)
+    except Exception as e:
+        logger.warning(f"Could not compute perceptual hash: {e}")
+        return None
+
+def backfill_hashes(db, storage_root: Path = STORAGE_ROOT, dry_run: bool = False) -> dict:
+    """Hash products stored before hashing existed and register legacy user photo files"""
+    summary = {"products": 0, "user_photos": 0}
+
+    products = db.query(Product).filter(Product.phash.is_(None)).all()
+    for done, product in enumerate(products, start=1):
+        value = compute_hash(storage_root / product.filepath)
+        if value is not None and not dry_run:
+            product.phash = hash_to_hex(value)
+        summary["products"] += value is not None
+        if done % 100 == 0 or done == len(products):
+            db.commit()
+            print(f"  products: {done}/{len(products)}")
+
+    known = {path for (path,) in db.query(UserPhoto.filepath)}
+    users_dir = storage_root / USERS_DIR.relative_to(STORAGE_ROOT)
+    photo_files = sorted(users_dir.glob("*/photos/*"), key=lambda f: f.stat().st_mtime) if users_dir.exists() else []
+    for photo in photo_files:
+        relative = str(photo.relative_to(storage_root))
+        user_id = photo.parent.parent.name
+        if relative in known or not user_id.isdigit():
+            continue
+        value = compute_hash(photo)
+        if not dry_run:
+            db.add(UserPhoto(
+                user_id=int(user_id),
+                filepath=relative,
+                phash=hash_to_hex(value) if value is not None else None,
+                # Keep upload order, so the newest file stays the user's current photo
+                created_at=datetime.utcfromtimestamp(photo.stat().st_mtime),
+            ))
+        summary["user_photos"] += 1
+    db.commit()
+    return summary
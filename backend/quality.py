@@ -0,0 +1,97 @@
+"""
+Try-on quality tiers and load-based degradation.
+
+- preview: 512px inputs, fastest upstream turnaround
+- full: 1024px inputs (the original behaviour)
+- progressive: return a preview first, then replace it with the full result
+
+LatencyGovernor downgrades full-tier work to preview while recent full-tier
+latency is above TRYON_LATENCY_TARGET_SECONDS, or while too many full-tier
+generations are in flight (TRYON_MAX_FULL_IN_FLIGHT).
+"""
+
+import os
+import threading
+import time
+from collections import deque
+
+QUALITY_TIERS = {
+    "preview": (512, 512),
+    "full": (1024, 1024),
+}
+
+# Percentile of recent full-tier latency compared against the target
+LATENCY_PERCENTILE = 0.9
+
+def result_filename(tier: str) -> str:
+    """Preview and full results get distinct names so cached URLs never show the wrong tier"""
+    return "output.png" if tier == "full" else f"output_{tier}.png"
+
+class LatencyGovernor:
+    def __init__(self, target_seconds: float = 0, window_seconds: float = 120, max_full_in_flight: int = 0):
+        self.target_seconds = target_seconds
+        self.window_seconds = window_seconds
+        self.max_full_in_flight = max_full_in_flight
+        self.samples = deque()
+        self.in_flight = {tier: 0 for tier in QUALITY_TIERS}
+        self.degraded_count = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "LatencyGovernor":
+        return cls(
+            target_seconds=float(os.getenv("TRYON_LATENCY_TARGET_SECONDS", "0")),
+            window_seconds=float(os.getenv("TRYON_LATENCY_WINDOW_SECONDS", "120")),
+            max_full_in_flight=int(os.getenv("TRYON_MAX_FULL_IN_FLIGHT", "0")),
+        )
+
+    def _recent_full_latency(self, now: float):
+        # Samples age out of the window, so once load drops (or full-tier work stops
+        # being sampled because everything was degraded) the governor recovers
+        while self.samples and now - self.samples[0][0] > self.window_seconds:
+            self.samples.popleft()
+        if not self.samples:
+            return None
+        latencies = sorted(latency for _, latency in self.samples)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * LATENCY_PERCENTILE))]
+
+    def should_degrade(self) -> bool:
+        """Whether full-tier work should currently be served at the preview tier"""
+        with self.lock:
+            if self.max_full_in_flight and self.in_flight["full"] >= self.max_full_in_flight:
+                return True
+            if self.target_seconds <= 0:
+                return False
+            recent = self._recent_full_latency(time.monotonic())
+            return recent is not None and recent > self.target_seconds
+
+    def choose_tier(self, requested: str) -> str:
+        """Tier to generate first for a requested quality ('preview', 'full' or 'progressive')"""
+        if requested in ("preview", "progressive"):
+            return "preview"
+        if self.should_degrade():
+            with self.lock:
+                self.degraded_count += 1
+            return "preview"
+        return "full"
+
+    def started(self, tier: str):
+        with self.lock:
+            self.in_flight[tier] += 1
+
+    def finished(self, tier: str, seconds: float = None):
+        """Record a finished generation; seconds is None for cancelled work, which isn't sampled"""
+        with self.lock:
+            self.in_flight[tier] -= 1
+            if tier == "full" and seconds is not None:
+                self.samples.append((time.monotonic(), seconds))
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            recent = self._recent_full_latency(time.monotonic())
+            return {
+                "target_seconds": self.target_seconds,
+                "recent_full_latency_seconds": recent,
+                "in_flight": dict(self.in_flight),
+                "degraded_requests": self.degraded_count,
+            }
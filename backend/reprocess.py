@@ -0,0 +1,456 @@
+"""
+Bulk reprocessing of try-on sessions left without a usable result, e.g. after
+an upstream outage.
+
+A job (a reprocess_jobs row) selects sessions by status and created_at range.
+Of those, a session is re-run when its generation failed (status "failed",
+whose output is at most the error placeholder) or its output is missing. Pending and preview
+sessions are only taken once they are older than REPROCESS_STALE_AFTER_SECONDS,
+so generations still in flight are left alone. Expired sessions are never
+taken: retention deleted their results on purpose.
+
+Sessions are dispatched in id order, at most `concurrency` at a time and at
+most `rate_per_minute` started per minute. The job's checkpoint is the highest
+id up to which every session has been handled, so a paused, failed or
+interrupted job resumes where it stopped; sessions past the checkpoint that
+were already fixed are no longer selected. The new result is staged next to
+the old one and renamed over it in the transaction that updates the row, and
+only if the row is still in the state it was selected in.
+
+The model call is passed in: the API runs it through the fair-share scheduler
+at batch priority, format_database.py reprocess calls the model directly.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import or_
+
+import metrics
+import stats
+from database import SessionLocal, ReprocessJob, TryOnSession, Product
+from quality import result_filename
+from storage import STORAGE_ROOT, RESULTS_DIR
+
+logger = logging.getLogger(__name__)
+
+# Expired sessions had their results removed by retention and stay that way
+REPROCESSABLE_STATUSES = ("pending", "preview", "completed", "failed", "cancelled")
+DEFAULT_STATUSES = ("failed",)
+# Statuses of sessions whose generation may still be running
+IN_FLIGHT_STATUSES = ("pending", "preview")
+# Job statuses a worker may pick up; "running" only once its heartbeat has stopped
+RESUMABLE_JOB_STATUSES = ("pending", "paused", "failed")
+STOPPABLE_JOB_STATUSES = ("pending", "running", "paused", "failed")
+
+DEFAULT_CONCURRENCY = 2
+DEFAULT_RATE_PER_MINUTE = 30
+DEFAULT_STALE_AFTER_SECONDS = 3600
+# How long a batch-priority session may wait for a scheduler slot; its generation
+# deadline only starts once it is dispatched
+DEFAULT_QUEUE_TIMEOUT_SECONDS = 3600
+# Consecutive failed sessions that stop a job; the upstream is probably still down
+DEFAULT_MAX_CONSECUTIVE_FAILURES = 10
+# Sessions read per selection query
+PAGE_SIZE = 100
+HEARTBEAT_SECONDS = 10
+# A running job whose heartbeat is older than this was abandoned by its worker
+JOB_LEASE_SECONDS = 60
+
+class ReprocessError(Exception):
+    """A session could not be regenerated"""
+
+@dataclass
+class Candidate:
+    session_id: int
+    user_id: int
+    # Status and output at selection time; the swap only happens if they are unchanged
+    status: str
+    output_image_path: Optional[str]
+    user_photo_path: str
+    product_photo_path: str
+    product_name: str
+
+def job_statuses(job: ReprocessJob) -> list:
+    return job.statuses.split(",")
+
+def job_summary(job: ReprocessJob) -> dict:
+    return {
+        "id": job.id,
+        "status": job.status,
+        "statuses": job_statuses(job),
+        "created_after": job.created_after,
+        "created_before": job.created_before,
+        "quality": job.quality,
+        "concurrency": job.concurrency,
+        "rate_per_minute": job.rate_per_minute,
+        "checkpoint_id": job.checkpoint_id,
+        "scanned": job.scanned,
+        "regenerated": job.regenerated,
+        "failed": job.failed,
+        "skipped": job.skipped,
+        "error": job.error,
+        "created_at": job.created_at,
+        "heartbeat_at": job.heartbeat_at,
+        "finished_at": job.finished_at,
+    }
+
+def naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """created_at columns hold naive UTC (datetime.utcnow), so aware bounds are converted to match"""
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+def create_job(db, statuses=DEFAULT_STATUSES, created_after: datetime = None, created_before: datetime = None,
+               quality: str = "full", concurrency: int = DEFAULT_CONCURRENCY,
+               rate_per_minute: float = DEFAULT_RATE_PER_MINUTE) -> ReprocessJob:
+    unknown = set(statuses) - set(REPROCESSABLE_STATUSES)
+    if unknown:
+        raise ValueError(f"Sessions with status {', '.join(sorted(unknown))} can't be reprocessed")
+    created_after, created_before = naive_utc(created_after), naive_utc(created_before)
+    if created_after and created_before and created_after >= created_before:
+        raise ValueError("created_after must be earlier than created_before")
+    job = ReprocessJob(
+        status="pending",
+        statuses=",".join(statuses),
+        created_after=created_after,
+        created_before=created_before,
+        quality=quality,
+        concurrency=concurrency,
+        rate_per_minute=rate_per_minute,
+    )
+    db.add(job)
+    db.commit()
+    return job
+
+def claim_job(db, job_id: int) -> bool:
+    """Mark the job running for the caller; False if it is finished or another worker is running it"""
+    now = datetime.utcnow()
+    claimed = db.query(ReprocessJob).filter(
+        ReprocessJob.id == job_id,
+        or_(
+            ReprocessJob.status.in_(RESUMABLE_JOB_STATUSES),
+            (ReprocessJob.status == "running") & (ReprocessJob.heartbeat_at < now - timedelta(seconds=JOB_LEASE_SECONDS)),
+        ),
+    ).update({"status": "running", "heartbeat_at": now, "error": None, "finished_at": None}, synchronize_session=False)
+    db.commit()
+    return claimed == 1
+
+def stop_job(db, job_id: int, status: str) -> bool:
+    """Ask a job to stop as "paused" or "cancelled"; its worker notices within HEARTBEAT_SECONDS"""
+    stopped = db.query(ReprocessJob).filter(
+        ReprocessJob.id == job_id, ReprocessJob.status.in_(STOPPABLE_JOB_STATUSES)
+    ).update({"status": status}, synchronize_session=False)
+    db.commit()
+    return stopped == 1
+
+def get_queue_timeout() -> float:
+    return float(os.getenv("REPROCESS_QUEUE_TIMEOUT_SECONDS", str(DEFAULT_QUEUE_TIMEOUT_SECONDS)))
+
+def stale_before(now: datetime = None) -> datetime:
+    stale_after = float(os.getenv("REPROCESS_STALE_AFTER_SECONDS", str(DEFAULT_STALE_AFTER_SECONDS)))
+    return (now or datetime.utcnow()) - timedelta(seconds=stale_after)
+
+def select_page(db, statuses: list, created_after: datetime, created_before: datetime, after_id: int,
+                limit: int = PAGE_SIZE) -> list:
+    """(session, product name) for the next sessions in the selection, by id"""
+    query = db.query(TryOnSession, Product.name).outerjoin(Product, Product.id == TryOnSession.product_id).filter(
+        TryOnSession.id > after_id, TryOnSession.status.in_(statuses)
+    )
+    if created_after:
+        query = query.filter(TryOnSession.created_at >= created_after)
+    if created_before:
+        query = query.filter(TryOnSession.created_at < created_before)
+    return query.order_by(TryOnSession.id).limit(limit).all()
+
+def classify(session: TryOnSession, in_flight_before: datetime) -> Optional[str]:
+    """
+    Why the session needs regenerating ("failed_generation", "missing_output"), why it
+    can't be ("in_flight", "inputs_missing"), or None when its result is fine.
+    """
+    if session.status == "failed":
+        reason = "failed_generation"
+    elif session.output_image_path and (STORAGE_ROOT / session.output_image_path).exists():
+        return None
+    else:
+        reason = "missing_output"
+    if session.status in IN_FLIGHT_STATUSES and session.created_at >= in_flight_before:
+        return "in_flight"
+    for path in (session.input_user_photo_path, session.input_product_photo_path):
+        if not (STORAGE_ROOT / path).exists():
+            return "inputs_missing"
+    return reason
+
+def preview(db, statuses=DEFAULT_STATUSES, created_after: datetime = None, created_before: datetime = None) -> dict:
+    """What a job with this selection would do, without generating anything"""
+    counts = {"scanned": 0, "failed_generation": 0, "missing_output": 0, "in_flight": 0, "inputs_missing": 0}
+    created_after, created_before = naive_utc(created_after), naive_utc(created_before)
+    in_flight_before = stale_before()
+    after_id = 0
+    while True:
+        rows = select_page(db, list(statuses), created_after, created_before, after_id)
+        if not rows:
+            return counts
+        for session, _ in rows:
+            counts["scanned"] += 1
+            reason = classify(session, in_flight_before)
+            if reason:
+                counts[reason] += 1
+        after_id = rows[-1][0].id
+        # Nothing is written, so don't keep a read transaction open across pages
+        db.rollback()
+
+class ReprocessRunner:
+    """Works through one claimed job; generate(candidate, tier) is an async function returning image bytes"""
+
+    def __init__(self, job_id: int, generate, session_factory=SessionLocal,
+                 max_consecutive_failures: int = None):
+        self.job_id = job_id
+        self.generate = generate
+        self.session_factory = session_factory
+        self.max_consecutive_failures = max_consecutive_failures or int(
+            os.getenv("REPROCESS_MAX_CONSECUTIVE_FAILURES", str(DEFAULT_MAX_CONSECUTIVE_FAILURES))
+        )
+        self.counts = {"scanned": 0, "regenerated": 0, "failed": 0, "skipped": 0}
+        # Sessions that failed since the last success; retried on resume if they stop the job
+        self.failure_streak = []
+        # Session ids being generated, and the last id looked at
+        self.in_flight = set()
+        self.scanned_through = 0
+        # Set when the job was paused or cancelled from outside, or gave up
+        self.stop_event = asyncio.Event()
+        self.error = None
+        self.save_lock = asyncio.Lock()
+
+    def checkpoint(self) -> int:
+        """Highest id up to which every session has been handled"""
+        checkpoint = min(self.in_flight) - 1 if self.in_flight else self.scanned_through
+        if self.error and self.failure_streak:
+            checkpoint = min(checkpoint, min(self.failure_streak) - 1)
+        return checkpoint
+
+    def _load(self) -> ReprocessJob:
+        db = self.session_factory()
+        try:
+            job = db.get(ReprocessJob, self.job_id)
+            db.expunge(job)
+            return job
+        finally:
+            db.close()
+
+    def _write_progress(self, checkpoint: int, counts: dict, final_status: str = None) -> str:
+        """Persist the checkpoint and counts; returns the job's status, which others may have changed"""
+        db = self.session_factory()
+        try:
+            job = db.get(ReprocessJob, self.job_id)
+            job.checkpoint_id = checkpoint
+            for name, value in counts.items():
+                setattr(job, name, value)
+            if job.status == "running":
+                job.heartbeat_at = datetime.utcnow()
+                if final_status:
+                    job.status = final_status
+                    job.error = self.error
+                    if final_status == "completed":
+                        job.finished_at = datetime.utcnow()
+            status = job.status
+            db.commit()
+            return status
+        finally:
+            db.close()
+
+    async def _save_progress(self, final_status: str = None) -> str:
+        # Serialized, so a slower write never replaces a newer checkpoint
+        async with self.save_lock:
+            counts = {name: self.base_counts[name] + value for name, value in self.counts.items()}
+            status = await run_in_threadpool(self._write_progress, self.checkpoint(), counts, final_status)
+        if status != "running":
+            self.stop_event.set()
+        return status
+
+    async def _heartbeat(self):
+        while not self.stop_event.is_set():
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                await self._save_progress()
+
+    def _select(self, after_id: int) -> list:
+        db = self.session_factory()
+        try:
+            rows = select_page(db, job_statuses(self.job), self.job.created_after, self.job.created_before, after_id)
+            result = []
+            for session, product_name in rows:
+                reason = classify(session, self.in_flight_before)
+                candidate = None
+                if reason in ("failed_generation", "missing_output"):
+                    candidate = Candidate(
+                        session_id=session.id,
+                        user_id=session.user_id,
+                        status=session.status,
+                        output_image_path=session.output_image_path,
+                        user_photo_path=str(STORAGE_ROOT / session.input_user_photo_path),
+                        product_photo_path=str(STORAGE_ROOT / session.input_product_photo_path),
+                        product_name=product_name or "garment",
+                    )
+                result.append((session.id, reason, candidate))
+            return result
+        finally:
+            db.close()
+
+    def _swap_in(self, candidate: Candidate, image_data: bytes) -> bool:
+        """Install the new result if the session is unchanged since it was selected"""
+        tier = self.job.quality
+        directory = RESULTS_DIR / str(candidate.session_id)
+        directory.mkdir(parents=True, exist_ok=True)
+        final_path = directory / result_filename(tier)
+        staged_path = directory / f".{final_path.name}.reprocess"
+        with open(staged_path, "wb") as f:
+            f.write(image_data)
+        output_path = str(final_path.relative_to(STORAGE_ROOT))
+
+        db = self.session_factory()
+        try:
+            updated = db.query(TryOnSession).filter(
+                TryOnSession.id == candidate.session_id,
+                TryOnSession.status == candidate.status,
+                TryOnSession.output_image_path == candidate.output_image_path,
+            ).update({"output_image_path": output_path, "quality": tier, "status": "completed"},
+                     synchronize_session=False)
+            if not updated:
+                db.rollback()
+                return False
+            if candidate.status != "completed":
+                stats.record_status_change(db, {candidate.status: 1}, "completed")
+            # Renamed while the row update is uncommitted: readers see the old or the new image whole
+            os.replace(staged_path, final_path)
+            db.commit()
+        finally:
+            db.close()
+            staged_path.unlink(missing_ok=True)
+
+        previous = candidate.output_image_path
+        if previous and previous != output_path:
+            (STORAGE_ROOT / previous).unlink(missing_ok=True)
+        return True
+
+    async def _process(self, candidate: Candidate, slots: asyncio.Semaphore):
+        start = time.monotonic()
+        try:
+            # Upstream errors raise TryOnGenerationError and count as failures below
+            image_data = await self.generate(candidate, self.job.quality)
+            if not image_data:
+                raise ReprocessError("generation returned no image")
+            if await run_in_threadpool(self._swap_in, candidate, image_data):
+                self.counts["regenerated"] += 1
+                metrics.increment("reprocess_regenerated")
+                logger.debug(f"Reprocess job {self.job_id}: session {candidate.session_id} regenerated")
+            else:
+                self.counts["skipped"] += 1
+                metrics.increment("reprocess_skipped")
+                logger.debug(f"Reprocess job {self.job_id}: session {candidate.session_id} changed meanwhile, left alone")
+            self.failure_streak = []
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.counts["failed"] += 1
+            self.failure_streak.append(candidate.session_id)
+            metrics.increment("reprocess_failed")
+            logger.warning(f"Reprocess job {self.job_id}: session {candidate.session_id} failed: {e}")
+            if len(self.failure_streak) >= self.max_consecutive_failures and not self.error:
+                self.error = f"Stopped after {len(self.failure_streak)} consecutive failures, last: {e}"
+                self.stop_event.set()
+        finally:
+            metrics.observe("reprocess_session_seconds", time.monotonic() - start)
+            slots.release()
+        self.in_flight.discard(candidate.session_id)
+        await self._save_progress()
+
+    async def _wait_or_stop(self, seconds: float) -> bool:
+        """Sleep up to seconds; True if the job was stopped meanwhile"""
+        if seconds <= 0:
+            return self.stop_event.is_set()
+        try:
+            await asyncio.wait_for(self.stop_event.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+        return self.stop_event.is_set()
+
+    async def _dispatch(self, tasks: set):
+        slots = asyncio.Semaphore(self.job.concurrency)
+        # Starts are spaced evenly, so the rate cap holds over any window
+        interval = 60.0 / self.job.rate_per_minute
+        next_start = time.monotonic()
+        while True:
+            page = await run_in_threadpool(self._select, self.scanned_through)
+            if not page:
+                return True
+            for session_id, reason, candidate in page:
+                if candidate is None:
+                    self.counts["scanned"] += 1
+                    if reason in ("in_flight", "inputs_missing"):
+                        self.counts["skipped"] += 1
+                        metrics.increment("reprocess_skipped")
+                    self.scanned_through = session_id
+                    continue
+                await slots.acquire()
+                if self.stop_event.is_set() or await self._wait_or_stop(next_start - time.monotonic()):
+                    slots.release()
+                    return False
+                next_start = max(next_start, time.monotonic()) + interval
+                self.counts["scanned"] += 1
+                self.in_flight.add(session_id)
+                self.scanned_through = session_id
+                task = asyncio.create_task(self._process(candidate, slots))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await self._save_progress()
+            if self.stop_event.is_set():
+                return False
+
+    async def run(self) -> str:
+        """Work through the job, which the caller has claimed; returns its final status"""
+        self.job = await run_in_threadpool(self._load)
+        self.base_counts = {name: getattr(self.job, name) for name in self.counts}
+        self.scanned_through = self.job.checkpoint_id
+        self.in_flight_before = stale_before()
+        print(f"Reprocess job {self.job_id} running from session {self.scanned_through + 1}: "
+              f"statuses {self.job.statuses}, {self.job.concurrency} at a time, {self.job.rate_per_minute:g}/min")
+
+        tasks = set()
+        heartbeat = asyncio.create_task(self._heartbeat())
+        try:
+            finished = await self._dispatch(tasks)
+            # In-flight sessions are finished even when the job is stopping
+            if tasks:
+                await asyncio.gather(*tasks)
+            if finished:
+                final_status = "completed"
+            else:
+                final_status = "failed" if self.error else "paused"
+        except asyncio.CancelledError:
+            # Shutdown: the interrupted sessions are past the checkpoint and get redone on resume
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self._save_progress("paused")
+            print(f"Reprocess job {self.job_id} interrupted at checkpoint {self.checkpoint()}")
+            raise
+        except Exception as e:
+            self.error = str(e)
+            final_status = "failed"
+        finally:
+            self.stop_event.set()
+            heartbeat.cancel()
+
+        status = await self._save_progress(final_status)
+        print(f"Reprocess job {self.job_id} {status}: {self.counts['regenerated']} regenerated, "
+              f"{self.counts['failed']} failed, {self.counts['skipped']} skipped of {self.counts['scanned']} scanned"
+              + (f" ({self.error})" if self.error else ""))
+        return status
@@ -0,0 +1,287 @@
+"""
+Storage retention and background garbage collection for TryOn-POC.
+
+Policies are read from environment variables (0 disables a policy):
+- RETENTION_RESULT_MAX_AGE_DAYS: delete results older than this many days
+- RETENTION_MAX_RESULTS_PER_USER: keep only the newest N results per user
+- RETENTION_MAX_STORAGE_BYTES: global byte budget for results and cached outfit
+  steps together, evicted LRU
+- RETENTION_USER_PHOTO_MAX_AGE_DAYS: delete old user photos (newest is kept, as
+  are photos behind a stored or pending result or a cached outfit step)
+- RETENTION_INTERVAL_SECONDS: how often the background collector runs
+
+Every run also deletes expired idempotency keys.
+"""
+
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from sqlalchemy import func
+
+from database import SessionLocal, TryOnSession, UserPhoto, IdempotencyKey, OutfitStep
+from idempotency import purge_expired
+from phash_index import perceptual_index
+import stats
+from storage import STORAGE_ROOT, USERS_DIR, RESULTS_DIR, OUTFITS_DIR, delete_result_files, delete_outfit_files
+
+# Rows are committed in chunks so the collector never holds the write lock for long
+COMMIT_CHUNK_SIZE = 200
+
+@dataclass
+class RetentionPolicy:
+    result_max_age_days: float = 0
+    max_results_per_user: int = 0
+    max_storage_bytes: int = 0
+    user_photo_max_age_days: float = 0
+    interval_seconds: int = 3600
+
+    @classmethod
+    def from_env(cls) -> "RetentionPolicy":
+        """Build a policy from RETENTION_* environment variables"""
+        return cls(
+            result_max_age_days=float(os.getenv("RETENTION_RESULT_MAX_AGE_DAYS", "0")),
+            max_results_per_user=int(os.getenv("RETENTION_MAX_RESULTS_PER_USER", "0")),
+            max_storage_bytes=int(os.getenv("RETENTION_MAX_STORAGE_BYTES", "0")),
+            user_photo_max_age_days=float(os.getenv("RETENTION_USER_PHOTO_MAX_AGE_DAYS", "0")),
+            interval_seconds=int(os.getenv("RETENTION_INTERVAL_SECONDS", "3600")),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return any([
+            self.result_max_age_days > 0,
+            self.max_results_per_user > 0,
+            self.max_storage_bytes > 0,
+            self.user_photo_max_age_days > 0,
+        ])
+
+class StorageCollector:
+    """Enforces a RetentionPolicy over the storage directory and the sessions table"""
+
+    def __init__(self, policy: RetentionPolicy, session_factory=SessionLocal, storage_root: Path = STORAGE_ROOT):
+        self.policy = policy
+        self.session_factory = session_factory
+        self.storage_root = storage_root
+        self.results_dir = storage_root / RESULTS_DIR.relative_to(STORAGE_ROOT)
+        self.users_dir = storage_root / USERS_DIR.relative_to(STORAGE_ROOT)
+        self.outfits_dir = storage_root / OUTFITS_DIR.relative_to(STORAGE_ROOT)
+
+    def run_once(self, dry_run: bool = False) -> dict:
+        """Run every enabled policy once and return a summary of what was removed"""
+        summary = {
+            "expired_results": 0,
+            "per_user_results": 0,
+            "orphaned_results": 0,
+            "budget_results": 0,
+            "budget_outfit_steps": 0,
+            "user_photos": 0,
+            "idempotency_keys": 0,
+            "bytes_freed": 0,
+        }
+        db = self.session_factory()
+        try:
+            if self.policy.result_max_age_days > 0:
+                self._expire_old_results(db, summary, dry_run)
+            if self.policy.max_results_per_user > 0:
+                self._enforce_per_user_limit(db, summary, dry_run)
+            self._remove_orphaned_results(db, summary, dry_run)
+            if self.policy.max_storage_bytes > 0:
+                self._enforce_byte_budget(db, summary, dry_run)
+            if self.policy.user_photo_max_age_days > 0:
+                self._remove_old_user_photos(db, summary, dry_run)
+            self._purge_idempotency_keys(db, summary, dry_run)
+        finally:
+            db.close()
+
+        return summary
+
+    async def run_forever(self):
+        """Run the collector periodically in a worker thread until cancelled"""
+        print(f"Storage collector started (interval: {self.policy.interval_seconds}s)")
+        while True:
+            try:
+                summary = await asyncio.to_thread(self.run_once)
+                if summary["bytes_freed"]:
+                    print(f"Storage collector freed {summary['bytes_freed']} bytes: {summary}")
+            except Exception as e:
+                print(f"Storage collector run failed: {e}")
+            await asyncio.sleep(self.policy.interval_seconds)
+
+    def _evict_sessions(self, db, session_ids: list, summary: dict, key: str, dry_run: bool):
+        """Delete result files for sessions, clear their output_image_path and mark them expired"""
+        for start in range(0, len(session_ids), COMMIT_CHUNK_SIZE):
+            chunk = session_ids[start:start + COMMIT_CHUNK_SIZE]
+            if not dry_run:
+                # Bulk updates bypass the stats hook, so count the status changes here
+                old_statuses = dict(db.query(TryOnSession.status, func.count(TryOnSession.id)).filter(
+                    TryOnSession.id.in_(chunk)
+                ).group_by(TryOnSession.status).all())
+                stats.record_status_change(db, old_statuses, "expired")
+                # Clear the paths first so the API never hands out a URL to a deleted file
+                db.query(TryOnSession).filter(TryOnSession.id.in_(chunk)).update(
+                    {TryOnSession.output_image_path: None, TryOnSession.status: "expired"},
+                    synchronize_session=False,
+                )
+                db.commit()
+                for session_id in chunk:
+                    summary["bytes_freed"] += delete_result_files(session_id, self.results_dir)
+            summary[key] += len(chunk)
+
+    def _expire_old_results(self, db, summary: dict, dry_run: bool):
+        cutoff = datetime.utcnow() - timedelta(days=self.policy.result_max_age_days)
+        rows = db.query(TryOnSession.id).filter(
+            TryOnSession.output_image_path.isnot(None),
+            TryOnSession.created_at < cutoff,
+        ).all()
+        self._evict_sessions(db, [row.id for row in rows], summary, "expired_results", dry_run)
+
+    def _enforce_per_user_limit(self, db, summary: dict, dry_run: bool):
+        ranked = db.query(
+            TryOnSession.id.label("id"),
+            func.row_number().over(
+                partition_by=TryOnSession.user_id,
+                order_by=(TryOnSession.created_at.desc(), TryOnSession.id.desc()),
+            ).label("rank"),
+        ).filter(TryOnSession.output_image_path.isnot(None)).subquery()
+
+        rows = db.query(ranked.c.id).filter(ranked.c.rank > self.policy.max_results_per_user).all()
+        self._evict_sessions(db, [row.id for row in rows], summary, "per_user_results", dry_run)
+
+    def _remove_orphaned_results(self, db, summary: dict, dry_run: bool):
+        """Remove result directories whose session row no longer exists"""
+        if not self.results_dir.exists():
+            return
+
+        # List directories before querying ids: a session row is always committed
+        # before its result directory is created, so new sessions are never orphans
+        dir_ids = [int(d.name) for d in self.results_dir.iterdir() if d.is_dir() and d.name.isdigit()]
+        existing = set()
+        for start in range(0, len(dir_ids), COMMIT_CHUNK_SIZE):
+            chunk = dir_ids[start:start + COMMIT_CHUNK_SIZE]
+            existing.update(row.id for row in db.query(TryOnSession.id).filter(TryOnSession.id.in_(chunk)))
+
+        for session_id in dir_ids:
+            if session_id in existing:
+                continue
+            if not dry_run:
+                summary["bytes_freed"] += delete_result_files(session_id, self.results_dir)
+            summary["orphaned_results"] += 1
+
+    @staticmethod
+    def _directory_usage(directory: Path):
+        """(last used time, bytes) of the files in a result or outfit step directory"""
+        size = 0
+        last_used = 0.0
+        for f in directory.rglob("*"):
+            if f.is_file():
+                st = f.stat()
+                size += st.st_size
+                last_used = max(last_used, st.st_atime, st.st_mtime)
+        return last_used, size
+
+    def _enforce_byte_budget(self, db, summary: dict, dry_run: bool):
+        """Evict least recently used results and outfit steps until both fit the budget"""
+        entries = []
+        total_bytes = 0
+        if self.results_dir.exists():
+            for session_dir in self.results_dir.iterdir():
+                if not (session_dir.is_dir() and session_dir.name.isdigit()):
+                    continue
+                last_used, size = self._directory_usage(session_dir)
+                entries.append((last_used, "result", int(session_dir.name), size))
+                total_bytes += size
+        if self.outfits_dir.exists():
+            for step_dir in self.outfits_dir.iterdir():
+                if not step_dir.is_dir():
+                    continue
+                last_used, size = self._directory_usage(step_dir)
+                entries.append((last_used, "outfit", step_dir.name, size))
+                total_bytes += size
+
+        if total_bytes <= self.policy.max_storage_bytes:
+            return
+
+        victims = {"result": [], "outfit": []}
+        for last_used, kind, entry_id, size in sorted(entries, key=lambda entry: entry[0]):
+            if total_bytes <= self.policy.max_storage_bytes:
+                break
+            victims[kind].append(entry_id)
+            total_bytes -= size
+
+        self._evict_sessions(db, victims["result"], summary, "budget_results", dry_run)
+        self._evict_outfit_steps(db, victims["outfit"], summary, dry_run)
+
+    def _evict_outfit_steps(self, db, prefix_keys: list, summary: dict, dry_run: bool):
+        """Delete cached outfit steps; later steps don't depend on earlier ones, so any step can go"""
+        for start in range(0, len(prefix_keys), COMMIT_CHUNK_SIZE):
+            chunk = prefix_keys[start:start + COMMIT_CHUNK_SIZE]
+            if not dry_run:
+                # Drop the rows first so the cache never hands out a deleted file
+                db.query(OutfitStep).filter(OutfitStep.prefix_key.in_(chunk)).delete(synchronize_session=False)
+                db.commit()
+                for prefix_key in chunk:
+                    summary["bytes_freed"] += delete_outfit_files(prefix_key, self.outfits_dir)
+            summary["budget_outfit_steps"] += len(chunk)
+
+    def _remove_old_user_photos(self, db, summary: dict, dry_run: bool):
+        """Delete user photos past their max age, always keeping each user's newest photo"""
+        if not self.users_dir.exists():
+            return
+
+        # A near-duplicate re-upload reuses an older file, so a file's age is
+        # measured from the last upload that referenced it
+        # created_at is naive UTC; timestamp() would read it as local time
+        last_uploaded = {
+            filepath: created_at.replace(tzinfo=timezone.utc).timestamp()
+            for filepath, created_at in db.query(UserPhoto.filepath, func.max(UserPhoto.created_at)).group_by(UserPhoto.filepath)
+            if created_at
+        }
+        # Photos still behind a kept or pending result, or a cached outfit step, stay
+        # until retention drops those; reprocessing and session reuse read them
+        in_use = {path for path, in db.query(TryOnSession.input_user_photo_path).filter(
+            TryOnSession.output_image_path.isnot(None) | (TryOnSession.status == "pending")
+        ).distinct()}
+        in_use.update(path for path, in db.query(OutfitStep.base_photo_path).distinct())
+        ranked = db.query(
+            UserPhoto.filepath.label("filepath"),
+            func.row_number().over(
+                partition_by=UserPhoto.user_id,
+                order_by=(UserPhoto.created_at.desc(), UserPhoto.id.desc()),
+            ).label("rank"),
+        ).subquery()
+        current_photos = {row.filepath for row in db.query(ranked.c.filepath).filter(ranked.c.rank == 1)}
+
+        cutoff = time.time() - self.policy.user_photo_max_age_days * 86400
+        for photos_dir in self.users_dir.glob("*/photos"):
+            photos = sorted(
+                (f for f in photos_dir.iterdir() if f.is_file()),
+                key=lambda f: f.stat().st_mtime,
+                reverse=True,
+            )
+            relative_paths = [str(photo.relative_to(self.storage_root)) for photo in photos]
+            # Photos uploaded before user_photos existed have no rows; keep the newest file instead
+            if not any(relative in current_photos for relative in relative_paths):
+                photos, relative_paths = photos[1:], relative_paths[1:]
+
+            for photo, relative in zip(photos, relative_paths):
+                st = photo.stat()
+                if relative in current_photos or relative in in_use or max(st.st_mtime, last_uploaded.get(relative, 0)) >= cutoff:
+                    continue
+                if not dry_run:
+                    # Drop the rows first so uploads never link to a file being deleted
+                    db.query(UserPhoto).filter(UserPhoto.filepath == relative).delete(synchronize_session=False)
+                    db.commit()
+                    perceptual_index.forget_user(int(photos_dir.parent.name))
+                    photo.unlink(missing_ok=True)
+                    summary["bytes_freed"] += st.st_size
+                summary["user_photos"] += 1
+
+    def _purge_idempotency_keys(self, db, summary: dict, dry_run: bool):
+        if dry_run:
+            summary["idempotency_keys"] = db.query(IdempotencyKey).filter(IdempotencyKey.expires_at <= datetime.utcnow()).count()
+        else:
+            summary["idempotency_keys"] = purge_expired(db)
@@ -0,0 +1,173 @@
+"""
+Fair-share scheduler for upstream model calls.
+
+Every generation takes a slot from the scheduler before it runs. Requests carry a
+priority class:
+- interactive: a shopper is waiting on the result
+- batch: bulk work such as merchandisers generating try-ons for a catalog
+- speculative: results that may never be looked at (prefetching, refinements)
+
+Classes are served in strict priority order. Each class also has its own
+concurrency cap below the total, so batch and speculative work can never take
+the slots interactive requests need. Within a class, users share slots through
+weighted fair queuing: each request gets a virtual finish tag based on its
+cost and the user's earlier requests, and the lowest tag runs next. A user
+submitting a thousand requests therefore waits behind everyone else's first
+request instead of in front of it.
+
+Configured with TRYON_MAX_CONCURRENCY (total slots, 0 for no caps at all) and
+TRYON_<CLASS>_MAX_CONCURRENCY (per-class caps). Queue wait per class is reported
+as the queue_wait_seconds.<class> observation at GET /metrics.
+"""
+
+import asyncio
+import heapq
+import itertools
+import os
+import time
+
+import metrics
+from deadline import Deadline, wait_cancellable
+
+PRIORITY_CLASSES = ("interactive", "batch", "speculative")
+DEFAULT_MAX_CONCURRENCY = 8
+# Default share of the total slots each class may use
+DEFAULT_CLASS_SHARES = {"interactive": 1.0, "batch": 0.5, "speculative": 0.25}
+# Cost of one generation per quality tier, in full-tier units
+TIER_COSTS = {"preview": 0.5, "full": 1.0}
+
+class Ticket:
+    def __init__(self, user_id: int, priority: str, cost: float, start_tag: float, finish_tag: float):
+        self.user_id = user_id
+        self.priority = priority
+        self.cost = cost
+        self.start_tag = start_tag
+        self.finish_tag = finish_tag
+        self.submitted_at = time.monotonic()
+        self.granted = asyncio.get_running_loop().create_future()
+        self.cancelled = False
+        self.released = False
+
+class FairScheduler:
+    """
+    Priority classes with per-user weighted fair queuing inside each class.
+
+    All methods run on the event loop thread; worker threads release their slot
+    through a done callback, which asyncio also runs on the loop.
+    """
+
+    def __init__(self, max_concurrency: int = DEFAULT_MAX_CONCURRENCY, class_limits: dict = None):
+        # 0 disables the caps; requests are still ordered, but never wait
+        self.max_concurrency = max_concurrency if max_concurrency > 0 else float("inf")
+        self.class_limits = {
+            priority: max(1, int(self.max_concurrency * DEFAULT_CLASS_SHARES[priority]))
+            if max_concurrency > 0 else float("inf")
+            for priority in PRIORITY_CLASSES
+        }
+        self.class_limits.update(class_limits or {})
+        self.running = {priority: 0 for priority in PRIORITY_CLASSES}
+        self.queues = {priority: [] for priority in PRIORITY_CLASSES}
+        self.queued = {priority: 0 for priority in PRIORITY_CLASSES}
+        # Virtual time per class: the start tag of the request that was granted last
+        self.virtual_time = {priority: 0.0 for priority in PRIORITY_CLASSES}
+        # Finish tag of each user's latest request, per class
+        self.user_finish = {priority: {} for priority in PRIORITY_CLASSES}
+        self.sequence = itertools.count()
+
+    @classmethod
+    def from_env(cls) -> "FairScheduler":
+        max_concurrency = int(os.getenv("TRYON_MAX_CONCURRENCY", str(DEFAULT_MAX_CONCURRENCY)))
+        class_limits = {}
+        for priority in PRIORITY_CLASSES:
+            value = os.getenv(f"TRYON_{priority.upper()}_MAX_CONCURRENCY")
+            if value:
+                class_limits[priority] = int(value)
+        return cls(max_concurrency, class_limits)
+
+    def submit(self, user_id: int, priority: str, cost: float = 1.0, weight: float = 1.0) -> Ticket:
+        """Queue a request; its ticket's `granted` future resolves when it may run"""
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"Unknown priority class: {priority}")
+        user_finish = self.user_finish[priority]
+        start_tag = max(self.virtual_time[priority], user_finish.get(user_id, 0.0))
+        finish_tag = start_tag + cost / weight
+        user_finish[user_id] = finish_tag
+
+        ticket = Ticket(user_id, priority, cost, start_tag, finish_tag)
+        heapq.heappush(self.queues[priority], (finish_tag, next(self.sequence), ticket))
+        self.queued[priority] += 1
+        self._dispatch()
+        return ticket
+
+    async def acquire(self, user_id: int, priority: str, deadline: Deadline, request=None, cost: float = 1.0) -> Ticket:
+        """Wait for a slot; raises RequestCancelled if the client leaves or the deadline passes first"""
+        ticket = self.submit(user_id, priority, cost)
+        await wait_cancellable(request, deadline, ticket.granted, on_abandon=lambda _: self.cancel(ticket))
+        return ticket
+
+    def cancel(self, ticket: Ticket):
+        """Give up a ticket, whether it is still queued or already running"""
+        if ticket.granted.done():
+            self.release(ticket)
+        elif not ticket.cancelled:
+            # Left in the heap and skipped when it comes up
+            ticket.cancelled = True
+            self.queued[ticket.priority] -= 1
+            metrics.increment(f"queue_cancelled.{ticket.priority}")
+
+    def release(self, ticket: Ticket):
+        """Return a granted ticket's slot"""
+        if ticket.released:
+            return
+        ticket.released = True
+        self.running[ticket.priority] -= 1
+        self._dispatch()
+
+    def _total_running(self) -> int:
+        return sum(self.running.values())
+
+    def _next_ticket(self, priority: str):
+        queue = self.queues[priority]
+        while queue:
+            _, _, ticket = heapq.heappop(queue)
+            if not ticket.cancelled:
+                return ticket
+        return None
+
+    def _dispatch(self):
+        """Grant slots in priority order while capacity is free"""
+        while self._total_running() < self.max_concurrency:
+            for priority in PRIORITY_CLASSES:
+                if self.running[priority] >= self.class_limits[priority]:
+                    continue
+                ticket = self._next_ticket(priority)
+                if ticket:
+                    self._grant(ticket)
+                    break
+            else:
+                return
+
+    def _grant(self, ticket: Ticket):
+        priority = ticket.priority
+        self.queued[priority] -= 1
+        self.running[priority] += 1
+        self.virtual_time[priority] = max(self.virtual_time[priority], ticket.start_tag)
+        # Users whose last finish tag is behind virtual time are equivalent to new users
+        user_finish = self.user_finish[priority]
+        if len(user_finish) > 1024:
+            self.user_finish[priority] = {
+                user_id: tag for user_id, tag in user_finish.items() if tag > self.virtual_time[priority]
+            }
+
+        metrics.observe(f"queue_wait_seconds.{priority}", time.monotonic() - ticket.submitted_at)
+        ticket.granted.set_result(ticket)
+
+    def snapshot(self) -> dict:
+        def cap(value):
+            return None if value == float("inf") else value
+        return {
+            "max_concurrency": cap(self.max_concurrency),
+            "class_limits": {priority: cap(limit) for priority, limit in self.class_limits.items()},
+            "running": dict(self.running),
+            "queued": dict(self.queued),
+        }
@@ -0,0 +1,181 @@
+"""
+Materialized database statistics for the admin dashboard.
+
+Row counts live in stat_counters and per-hour session outcomes in
+session_stats_hourly, so reading them never scans the big tables. Both are
+updated from an after_flush hook, inside the same transaction as the user,
+product and session writes they count: a rolled-back write rolls back its
+counts too.
+
+Counters:
+- users, products, tryon_sessions: row count and newest created_at
+- tryon_sessions.<status>: sessions currently in each status
+Hourly buckets count sessions reaching completed or failed, by the hour they
+got there.
+
+Bulk UPDATE/DELETE statements bypass the hook; callers report those with
+record_status_change(). rebuild() recomputes everything from the tables.
+"""
+
+from collections import Counter
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, func, inspect
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from database import User, Product, TryOnSession, StatCounter, SessionStatsHourly
+
+TRACKED_TABLES = {User: "users", Product: "products", TryOnSession: "tryon_sessions"}
+HOURLY_STATUSES = ("completed", "failed")
+# Marks a database whose counters have been built at least once
+VERSION_COUNTER = "stats_version"
+STATS_VERSION = 1
+
+def hour_bucket(at: datetime) -> datetime:
+    return at.replace(minute=0, second=0, microsecond=0)
+
+def _apply(conn, counters: Counter, last_at: dict, hourly: Counter):
+    """Add deltas to the rollup tables on an open connection"""
+    for name in set(counters) | set(last_at):
+        stmt = insert(StatCounter).values(name=name, value=counters[name], last_at=last_at.get(name))
+        conn.execute(stmt.on_conflict_do_update(
+            index_elements=[StatCounter.name],
+            set_={
+                "value": StatCounter.value + stmt.excluded.value,
+                "last_at": func.max(func.coalesce(StatCounter.last_at, stmt.excluded.last_at),
+                                    func.coalesce(stmt.excluded.last_at, StatCounter.last_at)),
+            },
+        ))
+    for (bucket, status), delta in hourly.items():
+        stmt = insert(SessionStatsHourly).values(bucket=bucket, status=status, count=delta)
+        conn.execute(stmt.on_conflict_do_update(
+            index_elements=[SessionStatsHourly.bucket, SessionStatsHourly.status],
+            set_={"count": SessionStatsHourly.count + stmt.excluded.count},
+        ))
+
+def _status_change(counters: Counter, hourly: Counter, old, new, now: datetime, count: int = 1):
+    if old == new:
+        return
+    if old:
+        counters[f"tryon_sessions.{old}"] -= count
+    if new:
+        counters[f"tryon_sessions.{new}"] += count
+        if new in HOURLY_STATUSES:
+            hourly[(hour_bucket(now), new)] += count
+
+@event.listens_for(Session, "after_flush")
+def _count_flushed_rows(session, flush_context):
+    now = datetime.utcnow()
+    counters = Counter()
+    last_at = {}
+    hourly = Counter()
+
+    for obj in session.new:
+        name = TRACKED_TABLES.get(type(obj))
+        if not name:
+            continue
+        counters[name] += 1
+        created_at = obj.created_at or now
+        last_at[name] = max(last_at.get(name, created_at), created_at)
+        if name == "tryon_sessions":
+            _status_change(counters, hourly, None, obj.status, now)
+
+    for obj in session.dirty:
+        if type(obj) is not TryOnSession:
+            continue
+        history = inspect(obj).attrs.status.history
+        if history.added and history.deleted:
+            _status_change(counters, hourly, history.deleted[0], history.added[0], now)
+
+    for obj in session.deleted:
+        name = TRACKED_TABLES.get(type(obj))
+        if not name:
+            continue
+        counters[name] -= 1
+        if name == "tryon_sessions":
+            status = inspect(obj).attrs.status.loaded_value
+            if isinstance(status, str):
+                counters[f"tryon_sessions.{status}"] -= 1
+
+    if counters or hourly:
+        _apply(session.connection(), counters, last_at, hourly)
+
+def record_status_change(db, old_statuses: dict, new_status: str):
+    """Count a bulk status UPDATE; old_statuses maps each previous status to its number of rows"""
+    counters = Counter()
+    hourly = Counter()
+    now = datetime.utcnow()
+    for old, count in old_statuses.items():
+        _status_change(counters, hourly, old, new_status, now, count)
+    _apply(db.connection(), counters, {}, hourly)
+
+def rebuild(db) -> dict:
+    """Recompute every counter from the tables; returns the new counters"""
+    # Deleting first takes SQLite's write lock, so no write can slip in between the counts
+    db.query(StatCounter).delete(synchronize_session=False)
+    db.query(SessionStatsHourly).delete(synchronize_session=False)
+
+    counters = Counter()
+    last_at = {}
+    for model, name in TRACKED_TABLES.items():
+        count, newest = db.query(func.count(model.id), func.max(model.created_at)).one()
+        counters[name] = count
+        if newest:
+            last_at[name] = newest
+    for status, count in db.query(TryOnSession.status, func.count(TryOnSession.id)).group_by(TryOnSession.status):
+        counters[f"tryon_sessions.{status}"] = count
+    counters[VERSION_COUNTER] = STATS_VERSION
+
+    # Completion times aren't stored, so rebuilt buckets use the session's creation hour
+    hourly = Counter()
+    sessions = db.query(TryOnSession.created_at, TryOnSession.status).filter(
+        TryOnSession.status.in_(HOURLY_STATUSES), TryOnSession.created_at.isnot(None)
+    ).yield_per(1000)
+    for created_at, status in sessions:
+        hourly[(hour_bucket(created_at), status)] += 1
+
+    conn = db.connection()
+    # Rows are inserted directly, not through _apply, so zero counts are kept
+    for name, value in counters.items():
+        conn.execute(insert(StatCounter).values(name=name, value=value, last_at=last_at.get(name)))
+    _apply(conn, Counter(), {}, hourly)
+    db.commit()
+    return dict(counters)
+
+def ensure_built(db):
+    """Build the counters for a database that predates them"""
+    if db.query(StatCounter).filter(StatCounter.name == VERSION_COUNTER, StatCounter.value == STATS_VERSION).first():
+        return
+    counters = rebuild(db)
+    print(f"Rebuilt database statistics: {counters}")
+
+def snapshot(db, hours: int = 24) -> dict:
+    """Current counters plus completed/failed sessions for each of the last `hours` hours"""
+    counters = {row.name: row for row in db.query(StatCounter)}
+
+    def table(name: str) -> dict:
+        row = counters.get(name)
+        return {"count": row.value if row else 0, "last_created_at": row.last_at if row else None}
+
+    prefix = "tryon_sessions."
+    sessions = table("tryon_sessions")
+    sessions["by_status"] = {
+        name[len(prefix):]: row.value for name, row in counters.items() if name.startswith(prefix) and row.value
+    }
+
+    since = hour_bucket(datetime.utcnow()) - timedelta(hours=hours - 1)
+    buckets = {}
+    for row in db.query(SessionStatsHourly).filter(SessionStatsHourly.bucket >= since):
+        buckets.setdefault(row.bucket, dict.fromkeys(HOURLY_STATUSES, 0))[row.status] = row.count
+    hourly = [
+        {"hour": bucket, **buckets.get(bucket, dict.fromkeys(HOURLY_STATUSES, 0))}
+        for bucket in (since + timedelta(hours=i) for i in range(hours))
+    ]
+
+    return {
+        "users": table("users"),
+        "products": table("products"),
+        "tryon_sessions": sessions,
+        "hourly": hourly,
+    }
@@ -1,42 +1,65 @@
+import logging
 import os
+import shutil
 import time
 from pathlib import Path
 from PIL import Image
 import uuid
 from io import BytesIO
 
-# Enable AVIF support
-try:
-    import pillow_avif  # This enables AVIF support for PIL
-    print("AVIF support enabled in storage")
-except ImportError:
-    print("AVIF support not available in storage")
+from image_utils import open_image, downscale, fit_size, check_pixel_budget, enable_avif, estimate_decoded_bytes, ImageTooLargeError
+from memory_budget import decode_budget
+
+logger = logging.getLogger(__name__)
 
 # Storage configuration
 STORAGE_ROOT = Path("./storage")
 USERS_DIR = STORAGE_ROOT / "users"
 PRODUCTS_DIR = STORAGE_ROOT / "products"
 RESULTS_DIR = STORAGE_ROOT / "results"
+OUTFITS_DIR = STORAGE_ROOT / "outfits"
+
+# Uploads are downscaled to this longest side; the model only ever sees 1024px
+DEFAULT_MAX_STORED_IMAGE_SIDE = 2048
 
 def ensure_directories():
     """Create storage directories if they don't exist"""
-    for directory in [STORAGE_ROOT, USERS_DIR, PRODUCTS_DIR, RESULTS_DIR]:
+    for directory in [STORAGE_ROOT, USERS_DIR, PRODUCTS_DIR, RESULTS_DIR, OUTFITS_DIR]:
         directory.mkdir(parents=True, exist_ok=True)
 
 def normalize_filename(timestamp: int, file_type: str, extension: str = "jpg") -> str:
     """Generate normalized filename: <timestamp>_<type>.<extension>"""
     return f"{timestamp}_{file_type}.{extension}"
 
+def get_max_stored_image_side() -> int:
+    """Longest side kept for stored uploads from STORAGE_MAX_IMAGE_SIDE (0 keeps originals)"""
+    return int(os.getenv("STORAGE_MAX_IMAGE_SIDE", str(DEFAULT_MAX_STORED_IMAGE_SIDE)))
+
 def convert_to_supported_format(file_content: bytes) -> bytes:
-    """Convert image to a web-supported format (JPEG) if needed"""
+    """Convert image to a web-supported format (JPEG) if needed, downscaling oversized uploads"""
     try:
-        with Image.open(BytesIO(file_content)) as img:
+        # Opening only parses the header, so the format and size checks are cheap
+        enable_avif()
+        with Image.open(BytesIO(file_content)) as header:
             # Check if it's AVIF or other unsupported format
-            original_format = img.format
-            print(f"Image format detected: {original_format}")
+            original_format = header.format
+            original_size = header.size
+        print(f"Image format detected: {original_format}")
+        
+        max_side = get_max_stored_image_side()
+        target_size = (max_side, max_side) if max_side else None
+        oversized = bool(target_size) and fit_size(original_size, target_size) != original_size
+        
+        if original_format in ['AVIF', 'HEIC', 'HEIF'] or oversized:
+            print(f"Converting {original_format} {original_size[0]}x{original_size[1]} to JPEG...")
             
-            if original_format in ['AVIF', 'HEIC', 'HEIF']:
-                print(f"Converting {original_format} to JPEG...")
+            # Decode at reduced scale when the stored size is much smaller than the source.
+            # The decoded image and its downscaled/RGB copy briefly coexist
+            source = BytesIO(file_content)
+            with decode_budget.reserve(2 * estimate_decoded_bytes(source, target_size)):
+                img = open_image(source, target_size=target_size)
+                if target_size:
+                    img = downscale(img, target_size)
                 
                 # Convert to RGB if needed
                 if img.mode in ['RGBA', 'LA']:
@@ -53,10 +76,11 @@ def convert_to_supported_format(file_content: bytes) -> bytes:
                 # Save as JPEG
                 output_buffer = BytesIO()
                 img.save(output_buffer, format='JPEG', quality=90)
-                return output_buffer.getvalue()
-            
-            # For supported formats, return original
-            return file_content
+                del img
+            return output_buffer.getvalue()
+        
+        # For supported formats within the size limit, return original
+        return file_content
             
     except Exception as e:
         print(f"Error converting image format: {e}")
@@ -77,6 +101,10 @@ def save_user_photo(user_id: int, file_content: bytes, original_filename: str) -
     timestamp = int(time.time())
     filename = normalize_filename(timestamp, "user")
     filepath = user_dir / filename
+    if filepath.exists():
+        # Another upload in the same second; never overwrite a photo other rows may link to
+        filename = normalize_filename(timestamp, f"user_{uuid.uuid4().hex[:8]}")
+        filepath = user_dir / filename
     
     # Save the file
     with open(filepath, "wb") as f:
@@ -85,6 +113,10 @@ def save_user_photo(user_id: int, file_content: bytes, original_filename: str) -
     # Return relative path from storage root
     return str(filepath.relative_to(STORAGE_ROOT))
 
+def new_product_id() -> int:
+    """Allocate a product ID (a timestamp, for simplicity)"""
+    return int(time.time())
+
 def save_product_photo(file_content: bytes, original_filename: str) -> tuple[int, str]:
     """Save product photo and return (product_id, filepath)"""
     ensure_directories()
@@ -93,7 +125,7 @@ def save_product_photo(file_content: bytes, original_filename: str) -> tuple[int
     converted_content = convert_to_supported_format(file_content)
     
     # Generate product ID (using timestamp for simplicity)
-    product_id = int(time.time())
+    product_id = new_product_id()
     
     # Create product-specific directory
     product_dir = PRODUCTS_DIR / str(product_id)
@@ -111,32 +143,65 @@ def save_product_photo(file_content: bytes, original_filename: str) -> tuple[int
     # Return relative path from storage root
     return product_id, str(filepath.relative_to(STORAGE_ROOT))
 
-def save_result_image(session_id: int, image_data: bytes) -> str:
+def _save_image(directory: Path, image_data: bytes, filename: str) -> str:
+    """Write image_data to directory/filename and return its path relative to the storage root"""
+    directory.mkdir(parents=True, exist_ok=True)
+    
+    # Write to a temporary file and rename, so readers never see a partial image
+    filepath = directory / filename
+    temp_path = directory / f".{filename}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(image_data)
+    os.replace(temp_path, filepath)
+    
+    # Return relative path from storage root
+    return str(filepath.relative_to(STORAGE_ROOT))
+
+def save_result_image(session_id: int, image_data: bytes, filename: str = "output.png") -> str:
     """Save result image and return the filepath"""
     ensure_directories()
     
     # Create session-specific directory
-    session_dir = RESULTS_DIR / str(session_id)
-    session_dir.mkdir(parents=True, exist_ok=True)
+    return _save_image(RESULTS_DIR / str(session_id), image_data, filename)
+
+def save_outfit_image(prefix_key: str, image_data: bytes, filename: str = "output.png") -> str:
+    """Save the result of one outfit step under its prefix key and return the filepath"""
+    ensure_directories()
+    return _save_image(OUTFITS_DIR / prefix_key, image_data, filename)
+
+def delete_result_files(session_id: int, results_dir: Path = RESULTS_DIR) -> int:
+    """Delete the stored result directory for a session and return the bytes freed"""
+    session_dir = results_dir / str(session_id)
+    if not session_dir.exists():
+        return 0
     
-    # Save the result image
-    filepath = session_dir / "output.png"
-    with open(filepath, "wb") as f:
-        f.write(image_data)
+    freed = sum(f.stat().st_size for f in session_dir.rglob("*") if f.is_file())
+    shutil.rmtree(session_dir, ignore_errors=True)
+    return freed
+
+def delete_outfit_files(prefix_key: str, outfits_dir: Path = OUTFITS_DIR) -> int:
+    """Delete a cached outfit step's directory and return the bytes freed"""
+    step_dir = outfits_dir / prefix_key
+    if not step_dir.exists():
+        return 0
     
-    # Return relative path from storage root
-    return str(filepath.relative_to(STORAGE_ROOT))
+    freed = sum(f.stat().st_size for f in step_dir.rglob("*") if f.is_file())
+    shutil.rmtree(step_dir, ignore_errors=True)
+    return freed
 
 def get_file_extension(filename: str) -> str:
     """Extract file extension from filename"""
     return filename.split('.')[-1].lower()
 
 def validate_image_file(file_content: bytes) -> bool:
-    """Validate that the uploaded file is a valid image"""
+    """Validate that the uploaded file is a valid image within the pixel cap"""
     try:
-        from io import BytesIO
-        Image.open(BytesIO(file_content))
+        enable_avif()
+        with Image.open(BytesIO(file_content)) as img:
+            check_pixel_budget(img)
         return True
+    except ImageTooLargeError as e:
+        logger.info(f"Rejected image: {e}")
+        return False
     except Exception:
         return False
-
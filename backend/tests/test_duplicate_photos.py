@@ -0,0 +1,55 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image, ImageDraw
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database import create_tables, Product
+from phash_index import PerceptualIndex, compute_hash
+
+def shirt(color, quality: int = 95) -> bytes:
+    """The same garment outline in any color, as JPEG bytes"""
+    image = Image.new("RGB", (400, 500), "white")
+    ImageDraw.Draw(image).polygon(
+        [(100, 50), (300, 50), (380, 150), (320, 180), (320, 480), (80, 480), (80, 180), (20, 150)], fill=color
+    )
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    # Product files are resolved against ./storage
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "storage" / "products").mkdir(parents=True)
+    engine = create_engine(f"sqlite:///{tmp_path / 'tryon.db'}")
+    create_tables(engine)
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
+
+@pytest.fixture
+def index(db, tmp_path):
+    """An index holding one red shirt product"""
+    red = shirt((200, 30, 30))
+    (tmp_path / "storage" / "products" / "red.jpg").write_bytes(red)
+    db.add(Product(id=1, name="Red", filepath="products/red.jpg"))
+    db.commit()
+    index = PerceptualIndex()
+    index.add_product(compute_hash(BytesIO(red)), 1)
+    return index
+
+def test_other_color_is_not_a_duplicate(db, index):
+    blue = shirt((30, 40, 200))
+    phash = compute_hash(BytesIO(blue))
+    # Grayscale dHash can't tell the colors apart...
+    assert index.find_product(phash) == [1]
+    # ...the color check can
+    assert index.canonical_product(db, phash, BytesIO(blue)) is None
+
+def test_recompressed_copy_is_a_duplicate(db, index):
+    copy = shirt((200, 30, 30), quality=60)
+    canonical = index.canonical_product(db, compute_hash(BytesIO(copy)), BytesIO(copy))
+    assert canonical is not None and canonical.id == 1
@@ -0,0 +1,77 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database import create_tables, IdempotencyKey
+from idempotency import run_idempotent, REPLAY_HEADER
+from models import TryOnResponse
+
+SCOPE = "tryon"
+KEY = "retry-1"
+REQUEST_HASH = "abc"
+
+@pytest.fixture
+def db(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'tryon.db'}")
+    create_tables(engine)
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
+
+def run(db, handler):
+    return asyncio.run(run_idempotent(db, SCOPE, KEY, REQUEST_HASH, handler))
+
+def counting_handler(status="completed"):
+    calls = []
+
+    async def handler():
+        calls.append(1)
+        return TryOnResponse(session_id=len(calls), output_image_url="/results/1.png",
+                             created_at=datetime.utcnow(), status=status)
+    return handler, calls
+
+def hold_key(db, lease_expires_at):
+    """A key claimed by a request that is (or was) still running"""
+    now = datetime.utcnow()
+    db.add(IdempotencyKey(scope=SCOPE, key=KEY, request_hash=REQUEST_HASH,
+                          expires_at=now + timedelta(hours=1), lease_expires_at=lease_expires_at))
+    db.commit()
+
+def test_completed_response_is_replayed(db):
+    handler, calls = counting_handler()
+    run(db, handler)
+    replay = run(db, handler)
+    assert len(calls) == 1
+    assert replay.headers[REPLAY_HEADER] == "true"
+
+@pytest.mark.parametrize("status", ["failed", "cancelled"])
+def test_unfinished_response_is_not_replayed(db, status):
+    handler, calls = counting_handler(status)
+    assert run(db, handler).status == status
+    assert db.query(IdempotencyKey).count() == 0
+
+    # The retry runs the generation again instead of replaying the failure
+    run(db, handler)
+    assert len(calls) == 2
+
+def test_expired_lease_is_taken_over(db):
+    # The worker holding the key died and stopped renewing its lease
+    hold_key(db, datetime.utcnow() - timedelta(seconds=1))
+    handler, calls = counting_handler()
+    run(db, handler)
+    assert len(calls) == 1
+    assert db.query(IdempotencyKey).one().status == "completed"
+
+def test_live_lease_is_not_taken_over(db, monkeypatch):
+    monkeypatch.setenv("IDEMPOTENCY_WAIT_SECONDS", "0.3")
+    hold_key(db, datetime.utcnow() + timedelta(seconds=30))
+    handler, calls = counting_handler()
+    with pytest.raises(HTTPException) as error:
+        run(db, handler)
+    assert error.value.status_code == 409
+    assert calls == []
@@ -0,0 +1,27 @@
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+import input_quality
+
+def studio_photo(backdrop, figure=(120, 90, 70)) -> BytesIO:
+    """A standing figure in the middle of a plain backdrop"""
+    img = Image.new("RGB", (400, 600), backdrop)
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((150, 60, 250, 560), fill=figure)
+    for y in range(60, 560, 20):
+        draw.line((150, y, 250, y), fill=(90, 60, 40), width=3)
+    buffer = BytesIO()
+    img.save(buffer, format="PNG")
+    buffer.seek(0)
+    return buffer
+
+def test_white_backdrop_is_not_overexposure():
+    scores = input_quality.analyze(studio_photo((255, 255, 255)))
+    assert scores["bright_fraction"] < input_quality.MAX_CLIPPED_FRACTION
+    issues = input_quality.InputQualityGate().evaluate(scores, "person")
+    assert not any("overexposed" in reason for _, reason in issues)
+
+def test_blown_out_subject_is_overexposure():
+    scores = input_quality.analyze(studio_photo((255, 255, 255), figure=(250, 250, 250)))
+    assert scores["bright_fraction"] > input_quality.MAX_CLIPPED_FRACTION
@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+from fastapi.concurrency import run_in_threadpool
+
+from deadline import Deadline, DeadlineExceeded
+from memory_budget import DecodeBudget
+
+def test_waiters_are_served_in_arrival_order():
+    budget = DecodeBudget(100)
+
+    async def scenario():
+        first = await budget.acquire_async(80)
+        # The large request arrived first, so the small one can't overtake it
+        large = asyncio.ensure_future(budget.acquire_async(60))
+        await asyncio.sleep(0)
+        small = asyncio.ensure_future(budget.acquire_async(10))
+        await asyncio.sleep(0.05)
+        assert not large.done() and not small.done()
+
+        # Released from a worker thread, as generations do
+        await run_in_threadpool(first.release)
+        await asyncio.wait_for(asyncio.gather(large, small), 1)
+        assert budget.in_use == 70
+
+    asyncio.run(scenario())
+
+def test_release_is_idempotent():
+    budget = DecodeBudget(100)
+
+    async def scenario():
+        reservation = await budget.acquire_async(40)
+        reservation.release()
+        reservation.release()
+
+    asyncio.run(scenario())
+    assert budget.in_use == 0
+
+def test_threads_inherit_an_async_reservation():
+    budget = DecodeBudget(100)
+    inner = []
+
+    def decode():
+        # Covered by the outer reservation, so this doesn't wait for the 90 bytes
+        with budget.reserve(90):
+            inner.append(budget.in_use)
+
+    async def scenario():
+        async with budget.reserve_async(60):
+            await run_in_threadpool(decode)
+
+    asyncio.run(scenario())
+    assert inner == [60]
+    assert budget.in_use == 0
+
+def test_waiting_respects_the_deadline():
+    budget = DecodeBudget(100)
+
+    async def scenario():
+        await budget.acquire_async(100)
+        with pytest.raises(DeadlineExceeded):
+            await budget.acquire_async(10, Deadline(0.1))
+        # The abandoned waiter no longer holds up the queue
+        assert not budget.waiters
+
+    asyncio.run(scenario())
@@ -0,0 +1,23 @@
+from datetime import datetime
+
+import pytest
+from fastapi import HTTPException
+
+from pagination import encode_cursor, decode_cursor
+
+def test_cursor_round_trip():
+    created_at = datetime(2025, 3, 9, 14, 5, 7, 123456)
+    cursor = encode_cursor(created_at, 42)
+    # Opaque and safe in a query string without escaping
+    assert "=" not in cursor and "/" not in cursor and "+" not in cursor
+    assert decode_cursor(cursor) == (created_at, 42)
+
+@pytest.mark.parametrize("cursor", [
+    "not a cursor",
+    "e30",  # valid base64 of "{}"
+    encode_cursor(datetime(2025, 1, 1), 1)[:-3],
+])
+def test_malformed_cursor_is_400(cursor):
+    with pytest.raises(HTTPException) as error:
+        decode_cursor(cursor)
+    assert error.value.status_code == 400
@@ -0,0 +1,71 @@
+import asyncio
+
+from scheduler import FairScheduler
+
+def granted(tickets) -> list:
+    return [ticket for ticket in tickets if ticket.granted.done()]
+
+def test_class_caps_leave_room_for_interactive():
+    async def scenario():
+        scheduler = FairScheduler(max_concurrency=4)
+        assert scheduler.class_limits == {"interactive": 4, "batch": 2, "speculative": 1}
+
+        batch = [scheduler.submit(1, "batch") for _ in range(4)]
+        speculative = [scheduler.submit(2, "speculative") for _ in range(2)]
+        assert len(granted(batch)) == 2
+        assert len(granted(speculative)) == 1
+
+        # The last free slot goes to a shopper, and nothing else gets in
+        interactive = [scheduler.submit(3, "interactive") for _ in range(2)]
+        assert len(granted(interactive)) == 1
+        assert scheduler.running == {"interactive": 1, "batch": 2, "speculative": 1}
+
+        # A freed slot goes to the highest priority waiting
+        scheduler.release(batch[0])
+        assert len(granted(interactive)) == 2
+        assert len(granted(batch)) == 2
+
+    asyncio.run(scenario())
+
+def test_users_share_a_class_fairly():
+    async def scenario():
+        scheduler = FairScheduler(max_concurrency=1)
+        running = scheduler.submit(0, "interactive")
+        # One user floods the queue, then another asks for a single result
+        flood = [scheduler.submit(1, "interactive") for _ in range(5)]
+        single = scheduler.submit(2, "interactive")
+
+        order = []
+        current = running
+        for _ in range(6):
+            scheduler.release(current)
+            current = next(t for t in flood + [single] if t.granted.done() and t not in order)
+            order.append(current)
+        # The second user runs after the flooder's first request, not after all five
+        assert order.index(single) == 1
+
+    asyncio.run(scenario())
+
+def test_cheaper_requests_get_earlier_finish_tags():
+    async def scenario():
+        scheduler = FairScheduler(max_concurrency=1)
+        scheduler.submit(0, "interactive")
+        full = scheduler.submit(1, "interactive", cost=1.0)
+        previews = [scheduler.submit(2, "interactive", cost=0.5) for _ in range(2)]
+        # Two previews cost as much as one full-quality generation
+        assert previews[1].finish_tag == full.finish_tag
+
+    asyncio.run(scenario())
+
+def test_cancelled_tickets_are_skipped():
+    async def scenario():
+        scheduler = FairScheduler(max_concurrency=1)
+        running = scheduler.submit(1, "interactive")
+        gone = scheduler.submit(2, "interactive")
+        waiting = scheduler.submit(3, "interactive")
+        scheduler.cancel(gone)
+        scheduler.release(running)
+        assert waiting.granted.done() and not gone.granted.done()
+        assert scheduler.queued["interactive"] == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,69 @@
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+from PIL import Image
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database import create_tables, User, Product, TryOnSession
+from gemini_client import GeminiClient
+from main import find_reusable_session
+
+USER_PHOTO = "users/1/photo.png"
+PRODUCT_PHOTO = "products/1.png"
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    # find_reusable_session resolves outputs against ./storage
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "storage" / "results").mkdir(parents=True)
+    engine = create_engine(f"sqlite:///{tmp_path / 'tryon.db'}")
+    create_tables(engine)
+    session = sessionmaker(bind=engine)()
+    session.add_all([User(id=1), Product(id=1, name="Shirt", filepath=PRODUCT_PHOTO)])
+    session.commit()
+    yield session
+    session.close()
+    engine.dispose()
+
+def store_result(db, session_id: int, image_bytes: bytes, status: str = "completed") -> TryOnSession:
+    """Record a full-tier session the way create_tryon does"""
+    output_path = f"results/{session_id}.png"
+    (Path("storage") / output_path).write_bytes(image_bytes)
+    session = TryOnSession(id=session_id, user_id=1, product_id=1, input_user_photo_path=USER_PHOTO,
+                           input_product_photo_path=PRODUCT_PHOTO, output_image_path=output_path,
+                           quality="full", status=status)
+    db.add(session)
+    db.commit()
+    return session
+
+def png_bytes(color) -> bytes:
+    buffer = BytesIO()
+    Image.new("RGB", (64, 64), color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def test_failed_generation_is_regenerated_on_retry(db):
+    # The upstream call failed: the session is failed, with the placeholder as its output
+    error_image = GeminiClient._create_error_image("Try-on failed: upstream timed out")
+    store_result(db, 1, error_image, status="failed")
+
+    # The retry must not be answered with the placeholder...
+    assert find_reusable_session(db, USER_PHOTO, 1, "full") is None
+
+    # ...so it generates again, and that real result is what later requests reuse
+    store_result(db, 2, png_bytes((40, 90, 160)))
+    reused = find_reusable_session(db, USER_PHOTO, 1, "full")
+    assert reused is not None and reused.id == 2
+
+def test_completed_result_is_reused(db):
+    store_result(db, 1, png_bytes((200, 30, 30)))
+    reused = find_reusable_session(db, USER_PHOTO, 1, "preview")
+    assert reused is not None and reused.id == 1
+
+def test_other_product_is_not_reused(db):
+    # A near-duplicate product links to product 1 but has its own results
+    db.add(Product(id=2, name="Shirt in blue", filepath="products/2.png", canonical_id=1))
+    db.commit()
+    store_result(db, 1, png_bytes((200, 30, 30)))
+    assert find_reusable_session(db, USER_PHOTO, 2, "full") is None
@@ -0,0 +1,276 @@
+"""
+Upstream image generation backends.
+
+GeminiClient prepares the prompt and input images; a backend turns them into
+the generated image bytes:
+- GeminiBackend: the Gemini API (TRYON_BACKEND=gemini, the default)
+- StubBackend: a local stand-in that echoes the person photo after a
+  heavy-tailed (lognormal) delay, for load tests and development without an
+  API key (TRYON_BACKEND=stub)
+
+HedgedBackend wraps either one. When a call hasn't finished by the
+TRYON_HEDGE_PERCENTILE of recently observed latency, it sends one duplicate,
+returns whichever attempt succeeds first and cancels the other. Hedges are
+paid for from a budget of TRYON_HEDGE_BUDGET extra calls per call (a token
+bucket), so the extra upstream cost stays bounded even when the upstream is
+slow across the board.
+
+Backends take a per-attempt cancel event. The stub stops as soon as it is
+set; an in-flight Gemini HTTP call can't be interrupted, so a cancelled
+Gemini attempt runs to completion and its result is discarded.
+"""
+
+import base64
+import logging
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import metrics
+from deadline import RequestCancelled
+
+logger = logging.getLogger(__name__)
+
+GEMINI_MODEL = 'gemini-2.5-flash-image-preview'
+BACKENDS = ("gemini", "stub")
+
+DEFAULT_STUB_LATENCY_SECONDS = 1.0
+DEFAULT_STUB_LATENCY_SIGMA = 1.0
+
+DEFAULT_HEDGE_BUDGET = 0.05
+# Latencies needed before the percentile is trusted; until then nothing is hedged
+DEFAULT_HEDGE_MIN_SAMPLES = 20
+HEDGE_WINDOW = 200
+# Unspent hedges saved up for a burst of slow calls
+HEDGE_BURST = 5
+# Threads running attempts for all concurrent hedged calls
+HEDGE_MAX_WORKERS = 64
+# How often a waiting call checks its request's deadline
+CANCEL_POLL_SECONDS = 0.5
+
+class GeminiBackend:
+    def __init__(self):
+        api_key = os.getenv("GEMINI_API_KEY")
+        if not api_key:
+            raise ValueError("GEMINI_API_KEY environment variable is required")
+
+        # The SDK takes about half a second to import, so it is only loaded once a backend is built
+        import google.generativeai as genai
+        genai.configure(api_key=api_key)
+        # Use Gemini 2.5 Flash Image Preview (Nano Banana) for virtual try-on generation
+        self.model = genai.GenerativeModel(GEMINI_MODEL)
+
+    def generate(self, prompt: str, images: list, deadline=None, cancel: threading.Event = None):
+        """Generated image bytes, or None if the response holds no image"""
+        if deadline:
+            # The upstream call gets whatever time the request has left
+            deadline.check()
+            response = self.model.generate_content([prompt, *images], request_options={"timeout": deadline.remaining()})
+        else:
+            response = self.model.generate_content([prompt, *images])
+
+        # Parse response parts to find image data
+        for part in response.candidates[0].content.parts:
+            if part.inline_data is not None:
+                # Gemini 2.5 Flash Image Preview returns Base64-encoded image data
+                mime_type = part.inline_data.mime_type
+                image_data = part.inline_data.data
+
+                print(f"Received image data - MIME type: {mime_type}")
+                print(f"Data type: {type(image_data)}, length: {len(image_data) if image_data else 0}")
+
+                if not image_data:
+                    print("Skipping empty image data part")
+                    continue
+
+                # The data is Base64-encoded, decode it to get raw byte stream
+                if isinstance(image_data, str):
+                    print("Decoding Base64 image data to byte stream...")
+                    return base64.b64decode(image_data)
+                # Already in bytes format
+                return image_data
+
+            elif part.text is not None:
+                print(f"Text response part: {part.text}")
+        return None
+
+    def test_connection(self) -> bool:
+        """Test if Gemini API is working"""
+        try:
+            # Test with a simple text generation request (compatible with all models)
+            response = self.model.generate_content("Say 'API test successful'")
+            return bool(response and response.text)
+        except Exception as e:
+            print(f"Gemini API test failed: {str(e)}")
+            return False
+
+class StubBackend:
+    """Returns the person photo unchanged after a lognormal delay (median latency_seconds)"""
+
+    def __init__(self, latency_seconds: float = DEFAULT_STUB_LATENCY_SECONDS, sigma: float = DEFAULT_STUB_LATENCY_SIGMA,
+                 seed: int = None):
+        self.latency_seconds = latency_seconds
+        self.sigma = sigma
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "StubBackend":
+        return cls(
+            latency_seconds=float(os.getenv("TRYON_STUB_LATENCY_SECONDS", str(DEFAULT_STUB_LATENCY_SECONDS))),
+            sigma=float(os.getenv("TRYON_STUB_LATENCY_SIGMA", str(DEFAULT_STUB_LATENCY_SIGMA))),
+        )
+
+    def sample_latency(self) -> float:
+        if self.latency_seconds <= 0:
+            return 0.0
+        with self.lock:
+            return self.random.lognormvariate(math.log(self.latency_seconds), self.sigma)
+
+    def generate(self, prompt: str, images: list, deadline=None, cancel: threading.Event = None):
+        ends_at = time.monotonic() + self.sample_latency()
+        cancel = cancel or threading.Event()
+        while True:
+            remaining = ends_at - time.monotonic()
+            if remaining <= 0:
+                break
+            if cancel.wait(min(remaining, CANCEL_POLL_SECONDS)):
+                raise RequestCancelled("upstream attempt cancelled")
+            if deadline:
+                deadline.check()
+        return images[0]["data"]
+
+    def test_connection(self) -> bool:
+        return True
+
+class HedgedBackend:
+    def __init__(self, backend, percentile: float = 95, budget: float = DEFAULT_HEDGE_BUDGET,
+                 min_samples: int = DEFAULT_HEDGE_MIN_SAMPLES):
+        self.backend = backend
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=HEDGE_WINDOW)
+        self.credits = 0.0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS, thread_name_prefix="upstream")
+
+    def hedge_delay(self):
+        """Time after which a call gets a duplicate, or None while there are too few samples"""
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))]
+
+    def _earn_credit(self):
+        with self.lock:
+            self.credits = min(HEDGE_BURST, self.credits + self.budget)
+
+    def _spend_credit(self) -> bool:
+        with self.lock:
+            if self.credits < 1:
+                return False
+            self.credits -= 1
+            return True
+
+    def _record(self, seconds: float):
+        with self.lock:
+            self.latencies.append(seconds)
+        metrics.observe("upstream_seconds", seconds)
+
+    def generate(self, prompt: str, images: list, deadline=None, cancel: threading.Event = None):
+        metrics.increment("upstream_requests")
+        self._earn_credit()
+        delay = self.hedge_delay()
+        start = time.monotonic()
+        if delay is None:
+            result = self.backend.generate(prompt, images, deadline=deadline, cancel=cancel)
+            self._record(time.monotonic() - start)
+            return result
+
+        attempts = {}
+        def launch(label: str):
+            attempt_cancel = threading.Event()
+            attempts[self.executor.submit(self.backend.generate, prompt, images, deadline, attempt_cancel)] = (label, attempt_cancel)
+
+        def cancel_all():
+            for future, (_, attempt_cancel) in attempts.items():
+                attempt_cancel.set()
+                future.cancel()
+
+        launch("primary")
+        hedge_at = start + delay
+        failures = []
+        try:
+            while True:
+                pending = [future for future in attempts if not future.done()]
+                timeout = CANCEL_POLL_SECONDS
+                if len(attempts) == 1:
+                    timeout = min(timeout, max(0.0, hedge_at - time.monotonic()))
+                if deadline:
+                    timeout = min(timeout, deadline.remaining())
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    if future.exception() is not None:
+                        failures.append(future.exception())
+                        continue
+                    # First success wins; the other attempt is no longer wanted
+                    elapsed = time.monotonic() - start
+                    self._record(elapsed)
+                    if attempts[future][0] == "hedge":
+                        metrics.increment("upstream_hedges_won")
+                        logger.debug(f"Hedged upstream call won after {elapsed:.2f}s")
+                    return future.result()
+
+                if all(future.done() for future in attempts):
+                    # Every attempt failed; a primary that fails before the hedge is due isn't retried
+                    raise failures[0]
+
+                if cancel is not None and cancel.is_set():
+                    raise RequestCancelled("upstream attempt cancelled")
+                if deadline:
+                    deadline.check()
+
+                if len(attempts) == 1 and time.monotonic() >= hedge_at:
+                    if self._spend_credit():
+                        metrics.increment("upstream_hedges_fired")
+                        logger.debug(f"Upstream call slower than p{self.percentile:g} ({delay:.2f}s), sending a hedge")
+                        launch("hedge")
+                    else:
+                        # Out of budget: wait for the primary alone
+                        metrics.increment("upstream_hedges_skipped")
+                        hedge_at = math.inf
+        finally:
+            cancel_all()
+
+    def test_connection(self) -> bool:
+        return self.backend.test_connection()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            credits = self.credits
+        return {"percentile": self.percentile, "hedge_delay_seconds": self.hedge_delay(), "hedge_credits": round(credits, 2)}
+
+def create_backend():
+    """Backend selected by TRYON_BACKEND, hedged when TRYON_HEDGE_PERCENTILE is set"""
+    name = os.getenv("TRYON_BACKEND", "gemini").lower()
+    if name not in BACKENDS:
+        raise ValueError(f"TRYON_BACKEND must be one of {', '.join(BACKENDS)}")
+    backend = StubBackend.from_env() if name == "stub" else GeminiBackend()
+
+    percentile = float(os.getenv("TRYON_HEDGE_PERCENTILE", "0"))
+    if percentile <= 0:
+        return backend
+    print(f"Hedging upstream calls slower than p{percentile:g}")
+    return HedgedBackend(
+        backend,
+        percentile=percentile,
+        budget=float(os.getenv("TRYON_HEDGE_BUDGET", str(DEFAULT_HEDGE_BUDGET))),
+        min_samples=int(os.getenv("TRYON_HEDGE_MIN_SAMPLES", str(DEFAULT_HEDGE_MIN_SAMPLES))),
+    )